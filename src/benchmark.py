@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Time and memory benchmarks of each stage of the analysis, on synthetic gpr files
+copyright (c) 2012
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+import argparse
+import numpy as np
+
+import deconv
+import gpr_synth
+from gpr import GPR
+from groupby import GroupBy
+from categorical import join_pairs
+from dataframe import DataFrame
+from spotmask import get_file_mask, get_signal_mask
+from pooldesign import get_design
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='benchmark')
+logger.setLevel(logging.INFO)
+
+STAGES = [ 'parse', 'mask', 'zscore', 'group', 'write', 'file', 'pool_hit', 'intersection' ]
+# the setting used by the per-file stages, the one with the most work
+SIGNAL = ('F635 Median', 'B635 Median', 'F532 Median', 'B532 Median')
+DO_NORM = True
+DO_LOG = True
+
+def get_rss():
+    """ current resident memory in bytes, or 0 where /proc is not available """
+    try:
+        fp = open('/proc/self/statm', 'r')
+        pages = int(fp.read().split()[1])
+        fp.close()
+    except IOError:
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def get_peak():
+    """ peak resident memory of this process in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, os x bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_stage(fn, repeat):
+    """
+    run fn repeat times in a forked child process, so that the child's peak memory is that of the stage
+    on top of the inputs already prepared by the parent
+    return (fastest time in seconds, peak memory above the starting memory in MB)
+    """
+    (recv, send) = multiprocessing.Pipe(False)
+    def child():
+        start = get_rss()
+        times = [ ]
+        for r in range(repeat):
+            t = time.time()
+            fn()
+            times.append(time.time() - t)
+        send.send( (min(times), (get_peak() - start) / 1.0e6) )
+    p = multiprocessing.Process(target=child)
+    p.start()
+    ret = recv.recv()
+    p.join()
+    assert(p.exitcode == 0), 'stage failed with exit code %d' % p.exitcode
+    return ret
+
+def get_label():
+    """ the commit being benchmarked, from git describe, or unknown """
+    try:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output([ 'git', 'describe', '--always', '--dirty' ], cwd=src_dir, \
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def get_file_stages(filename, control_dict, work_dir):
+    """ (stage, fn) for the stages that read one gpr file, with the inputs of each stage prepared """
+    (signal_fg, signal_bg, norm_fg, norm_bg) = SIGNAL
+    gpr = GPR(filename)
+    file_mask = get_file_mask(control_dict)
+    signal_mask = get_signal_mask(signal_fg, signal_bg, norm_fg, norm_bg, DO_NORM)
+    def mask_fn():
+        (mask_file, counts_file) = file_mask.evaluate(gpr)
+        (mask_signal, counts_signal) = signal_mask.evaluate(gpr)
+        gpr.copy().delete_rows(mask_file | mask_signal)
+
+    masked = gpr.copy()
+    masked.delete_rows(file_mask.evaluate(gpr)[0] | signal_mask.evaluate(gpr)[0])
+    (name, id, fg, bg, n_fg, n_bg) = masked.get_columns([ 'Name', 'ID', signal_fg, signal_bg, norm_fg, norm_bg ])
+    (ratio, zscore) = deconv.get_ratio_zscore(fg, bg, n_fg, n_bg, DO_NORM, DO_LOG)
+    idname = join_pairs(id, name)[0]
+    def group_fn():
+        groups = GroupBy(idname)
+        deconv.apply_by_group(np.mean, idname, zscore, groups)
+        deconv.apply_by_group(np.mean, idname, ratio, groups)
+
+    setting = (os.path.join(work_dir, 'bench-top.txt'), os.path.join(work_dir, 'bench-summary.txt')) + SIGNAL + (DO_NORM, DO_LOG)
+    return [ ('parse', lambda: GPR(filename)),
+             ('mask', mask_fn),
+             ('zscore', lambda: deconv.get_ratio_zscore(fg, bg, n_fg, n_bg, DO_NORM, DO_LOG)),
+             ('group', group_fn),
+             ('write', lambda: gpr.write(os.path.join(work_dir, 'bench.gpr'))),
+             ('file', lambda: deconv.sweep_gpr_file(filename, [ setting ], control_dict)) ]
+
+def get_pool_stages(run_dir, control_dict, results_dir, truth):
+    """ (stage, fn) for the stages that read the summaries of every pool, after analyzing the run """
+    (signal_fg, signal_bg, norm_fg, norm_bg) = SIGNAL
+    sweep = [ (results_dir, signal_fg, signal_bg, norm_fg, norm_bg, DO_NORM, DO_LOG) ]
+    deconv.run_sweep(run_dir, sweep, control_dict, create_map=True, skip_deconv=True, text=False)
+    pool_to_file = DataFrame(filename=os.path.join(results_dir, 'map_pool_to_file.txt'))
+    full_path = [ os.path.join(results_dir, str(f) + '-summary' + deconv.BINARY_EXT) for f in pool_to_file.data['file'] ]
+    pool_to_file.add_columns( ('full_path', full_path) )
+    pool_hit = deconv.get_pool_hit(pool_to_file)
+    design = get_design()
+    (horizontal, vertical) = (design.get_layer_pools('H'), design.get_layer_pools('V'))
+    (intersection_hit, df) = deconv.get_intersection_hit(pool_hit, horizontal, vertical)
+    found = set(zip(df.data['pair'], df.data['id']))
+    planted = set(zip(truth.data['pair'], truth.data['id']))
+    n_found = len(found & planted)
+    if n_found < len(planted):
+        logger.warn('found %d of %d planted hits', n_found, len(planted))
+    return [ ('pool_hit', lambda: deconv.get_pool_hit(pool_to_file)),
+             ('intersection', lambda: deconv.get_intersection_hit(pool_hit, horizontal, vertical)) ]
+
+def benchmark_size(n_spot, args, work_dir, control_dict):
+    """ run the stages for arrays of n_spot spots, returning a result dict for each stage """
+    design = get_design()
+    run_dir = os.path.join(work_dir, 'gpr_%d' % n_spot)
+    do_pools = n_spot <= args.max_pool_spots
+    pools = None if do_pools else design.pools[:1]
+    print 'writing synthetic arrays of %d spots' % n_spot
+    truth = gpr_synth.write_experiment(run_dir, n_spot, design, args.n_hit, args.seed, pools=pools)
+    filename = os.path.join(run_dir, sorted([ f for f in os.listdir(run_dir) if f.endswith('.gpr') ])[0])
+    stages = get_file_stages(filename, control_dict, work_dir)
+    if do_pools:
+        stages += get_pool_stages(run_dir, control_dict, os.path.join(work_dir, 'results_%d' % n_spot), truth)
+    results = [ ]
+    for (stage, fn) in stages:
+        if stage not in args.stages:
+            continue
+        (seconds, peak_mb) = run_stage(fn, args.repeat)
+        results.append({ 'stage': stage, 'n_spot': n_spot, 'seconds': seconds, 'peak_mb': peak_mb })
+        print '%-12s %8d %10.4f s %10.1f MB' % (stage, n_spot, seconds, peak_mb)
+    return results
+
+def read_results(filename):
+    if not os.path.isfile(filename):
+        return [ ]
+    fp = open(filename, 'r')
+    results = [ json.loads(line) for line in fp if line.strip() ]
+    fp.close()
+    return results
+
+def print_comparison(results, previous, label):
+    """ time and memory of each stage against the latest previous result with the same label """
+    old = dict()
+    for r in previous:
+        if r['label'] == label:
+            old[(r['stage'], r['n_spot'])] = r
+    print '\n%-12s %8s %10s %10s %7s %10s %10s' % ('stage', 'n_spot', 'seconds', label[:10], 'ratio', 'MB', label[:10])
+    for r in results:
+        o = old.get((r['stage'], r['n_spot']))
+        if o is None:
+            print '%-12s %8d %10.4f %10s %7s %10.1f %10s' % (r['stage'], r['n_spot'], r['seconds'], '-', '-', r['peak_mb'], '-')
+        else:
+            print '%-12s %8d %10.4f %10.4f %7.2f %10.1f %10.1f' % (r['stage'], r['n_spot'], r['seconds'], o['seconds'], \
+                  r['seconds'] / max(o['seconds'], 1e-9), r['peak_mb'], o['peak_mb'])
+
+ap = argparse.ArgumentParser(description='Time and memory-profile each stage of the analysis on synthetic gpr files, appending the results to RESULTS so that commits can be compared.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated numbers of spots per array (default: %(default)s)')
+ap.add_argument('--stages', default=','.join(STAGES), help='comma-separated stages to run, from %s (default: all)' % ','.join(STAGES))
+ap.add_argument('--max_pool_spots', type=int, default=100000, help='largest arrays for the pool stages, which write a gpr file for every pool (default: %(default)s)')
+ap.add_argument('--n_hit', type=int, default=24, help='number of planted hits (default: %(default)s)')
+ap.add_argument('--seed', type=int, default=0, help='random seed for the synthetic arrays (default: %(default)s)')
+ap.add_argument('--repeat', type=int, default=3, help='runs of each stage; the fastest is reported (default: %(default)s)')
+ap.add_argument('--results', default='benchmark.jsonl', help='file for appending one json line per stage and size (default: %(default)s)')
+ap.add_argument('--label', default=None, help='label for these results (default: git describe of the source)')
+ap.add_argument('--compare', default=None, help='label of earlier results in RESULTS to compare against')
+ap.add_argument('--work_dir', default=None, help='directory for the synthetic files, kept afterwards (default: a temporary directory, removed afterwards)')
+ap.add_argument('--verbose', action='store_true', help='show the log messages of each stage (default: %(default)s)')
+
+def main(args):
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    args.stages = args.stages.split(',')
+    for s in args.stages:
+        assert(s in STAGES), 'unknown stage %s' % s
+    label = args.label if args.label is not None else get_label()
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='deconv-bench-')
+    elif not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    control_dict = { ('CONTROL', 'IgG'): True, ('BSA', ''): True }
+    previous = read_results(args.results)
+    results = [ ]
+    try:
+        for n_spot in [ int(x) for x in args.sizes.split(',') ]:
+            results += benchmark_size(n_spot, args, work_dir, control_dict)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    info = { 'label': label, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': args.repeat, \
+             'python': sys.version.split()[0], 'numpy': np.__version__ }
+    fp = open(args.results, 'a')
+    for r in results:
+        r.update(info)
+        fp.write(json.dumps(r, sort_keys=True) + '\n')
+    fp.close()
+    if args.compare is not None:
+        print_comparison(results, previous, args.compare)
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    main(args)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Regression background correction: the expected foreground of a spot from its background,
+with the terms bg + sqrt(bg) + ln(bg), fit to every spot of an array
+joel.bader@jhu.edu
+"""
+
+import logging
+import numpy as np
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='bgfit')
+logger.setLevel(logging.INFO)
+
+# simple: ratio is fg / bg
+# regression: ratio is fg over the fitted fg for the spot's bg
+RATIO_MODES = [ 'simple', 'regression' ]
+TERMS = [ '1', 'bg', 'sqrt(bg)', 'ln(bg)' ]
+
+def get_design_matrix(bg):
+    """ one row per spot: 1, bg, sqrt(bg), ln(bg); bg must be positive """
+    bg = np.asarray(bg, dtype=float)
+    return np.column_stack([ np.ones(len(bg)), bg, np.sqrt(bg), np.log(bg) ])
+
+def fit_foreground(bg_list, fg_list):
+    """
+    least-squares fit of fg ~ 1 + bg + sqrt(bg) + ln(bg) for each pair of arrays in bg_list and fg_list,
+    for example the signal and norm channels of every setting of one gpr file
+    the spots of every fit are stacked with a fit code, the normal equations of all the fits
+    are summed by bincount, and the fits are solved together by one batched pseudo-inverse
+    each term is scaled to unit rms within its fit, so the normal equations stay well conditioned
+    return a list with the fitted fg of each spot, for each fit
+    """
+    n_fit = len(bg_list)
+    if n_fit == 0:
+        return [ ]
+    n_term = len(TERMS)
+    n_spot = [ len(x) for x in bg_list ]
+    code = np.repeat(np.arange(n_fit), n_spot)
+    x = get_design_matrix(np.concatenate([ np.asarray(b, dtype=float) for b in bg_list ]))
+    y = np.concatenate([ np.asarray(f, dtype=float) for f in fg_list ])
+    count = np.maximum(np.bincount(code, minlength=n_fit), 1)
+    scale = np.ones((n_fit, n_term))
+    for j in range(n_term):
+        scale[:, j] = np.sqrt(np.bincount(code, weights=x[:, j] * x[:, j], minlength=n_fit) / count)
+    scale[scale == 0] = 1.0
+    x = x / scale[code]
+
+    # normal equations of every fit, each a sum over its own spots
+    xtx = np.zeros((n_fit, n_term, n_term))
+    xty = np.zeros((n_fit, n_term))
+    for j in range(n_term):
+        xty[:, j] = np.bincount(code, weights=x[:, j] * y, minlength=n_fit)
+        for k in range(j, n_term):
+            xtx[:, j, k] = np.bincount(code, weights=x[:, j] * x[:, k], minlength=n_fit)
+            xtx[:, k, j] = xtx[:, j, k]
+    coef = np.matmul(np.linalg.pinv(xtx), xty[:, :, np.newaxis])[:, :, 0]
+    for i in range(n_fit):
+        logger.info('fit %d: %d spots, fg ~ %s', i, n_spot[i], \
+                    ' + '.join([ '%g %s' % (c, t) for (c, t) in zip(coef[i] / scale[i], TERMS) ]))
+    fitted = (x * coef[code]).sum(axis=1)
+    return np.split(fitted, np.cumsum(n_spot)[:-1])
+
+def get_fit_ratio(fg, fg_fit):
+    """
+    the observed over the fitted foreground, the regression equivalent of fg / bg
+    spots with a fitted foreground that is not positive are masked first, see get_fit_mask
+    """
+    fg_fit = np.asarray(fg_fit, dtype=float)
+    assert((fg_fit <= 0).sum() == 0), 'fg_fit has %d values that are not positive' % (fg_fit <= 0).sum()
+    return np.asarray(fg, dtype=float) / fg_fit
+
+def get_fit_mask(fg_fit, n_fg_fit=None):
+    """
+    True for spots whose fitted foreground, or fitted norm foreground, is not positive,
+    which have no ratio, just as spots with a background that is not positive have no fg / bg
+    """
+    mask = np.asarray(fg_fit) <= 0
+    if n_fg_fit is not None:
+        mask |= np.asarray(n_fg_fit) <= 0
+    return mask
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Categorical string columns: integer codes into the sorted distinct values
+joel.bader@jhu.edu
+"""
+
+import logging
+import numpy as np
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='categorical')
+logger.setLevel(logging.INFO)
+
+# string columns read by a DataFrame are categorical when they have at most this fraction of distinct values
+CATEGORY_MAX_FRACTION = 0.5
+
+class Categorical:
+    """
+    a column of strings stored as codes, an int32 array, and categories, the sorted distinct strings
+    the value of row r is categories[codes[r]]; since categories are sorted, comparing or sorting
+    codes gives the same order as the strings, so grouping and masking can work on the codes
+    it reads like the list or string array it replaces: len, iteration, indexing,
+    and np.asarray, which decodes the strings
+    indexing with a slice, mask or index array gives a Categorical with the same categories
+    """
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        categories = self.categories.tolist()
+        return (categories[c] for c in self.codes.tolist())
+
+    def __getitem__(self, index):
+        codes = self.codes[index]
+        if np.ndim(codes) == 0:
+            return self.categories[codes]
+        return Categorical(codes, self.categories)
+
+    def __array__(self, dtype=None):
+        values = self.categories[self.codes]
+        return values if dtype is None else values.astype(dtype)
+
+    def tolist(self):
+        return list(self)
+
+    def isin(self, values):
+        """ boolean array, True for the rows whose value is in values, found by checking only the categories """
+        return np.in1d(self.categories, np.asarray(values))[self.codes]
+
+def factorize(values):
+    """ a Categorical of a list or array of strings; a Categorical is returned as it is """
+    if isinstance(values, Categorical):
+        return values
+    values = np.asarray(values)
+    if values.dtype.kind == 'O':
+        values = values.astype(str)
+    if len(values) == 0:
+        return Categorical(np.zeros(0, dtype=np.int32), values.astype(str))
+    (categories, codes) = np.unique(values, return_inverse=True)
+    return Categorical(codes.astype(np.int32), categories)
+
+def categorize(values, max_fraction=CATEGORY_MAX_FRACTION):
+    """ a Categorical of a string array if few of its values are distinct, otherwise the array """
+    cat = factorize(values)
+    if len(cat.categories) > max_fraction * len(cat):
+        return values
+    return cat
+
+def isin(values, test_values):
+    """ np.in1d for a Categorical, list or array """
+    if isinstance(values, Categorical):
+        return values.isin(test_values)
+    return np.in1d(np.asarray(values), test_values)
+
+def join_pairs(first, second, sep='_'):
+    """
+    a composite key, for example idname from ID and Name, built from the code pairs of two columns:
+    the strings are joined once for each distinct pair, not once for each row
+    return (joined, first_of, second_of): the Categorical of the joined strings, and for each of its categories
+    the first and second values that make it up
+    """
+    (first, second) = (factorize(first), factorize(second))
+    n_second = max(len(second.categories), 1)
+    pair = first.codes.astype(np.int64) * n_second + second.codes
+    (pairs, pair_code) = np.unique(pair, return_inverse=True)
+    (first_of, second_of) = (first.categories[pairs // n_second], second.categories[pairs % n_second])
+    joined = [ sep.join([ a, b ]) for (a, b) in zip(first_of.tolist(), second_of.tolist()) ]
+    if len(joined) == 0:
+        return(factorize(joined), first_of, second_of)
+    # different pairs can join to the same string, for example a_b + c and a + b_c
+    (categories, category_code) = np.unique(joined, return_inverse=True)
+    (cat_first, cat_second) = (np.empty(len(categories), dtype=first_of.dtype), np.empty(len(categories), dtype=second_of.dtype))
+    cat_first[category_code] = first_of
+    cat_second[category_code] = second_of
+    return(Categorical(category_code[pair_code].astype(np.int32), categories), cat_first, cat_second)
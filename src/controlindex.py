@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Compiled index of control (id, name) pairs, built once from a control table and cached next to it
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import json
+import shutil
+import tempfile
+import hashlib
+import zipfile
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+
+from gpr_cache import get_sha1
+from dataframe import DataFrame, convert_column
+from get_controls import get_id_names
+from categorical import Categorical
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='controlindex')
+logger.setLevel(logging.INFO)
+
+INDEX_VERSION = 2
+INDEX_EXT = '.index'
+META_FILENAME = 'meta.json'
+# arrays of the index, each stored as <name>.npy
+INDEX_ARRAYS = [ 'ids', 'names', 'control_ids' ]
+# arrays of the id to names table of a counts index, written to ID_NAMES_FILENAME on every load
+ID_NAMES_ARRAYS = [ 'name_ids', 'name_cnts', 'name_lists' ]
+ID_NAMES_FILENAME = 'id_to_names.txt'
+
+# excel files are zipped xml; the first worksheet is read with the standard library
+XLSX_EXTENSIONS = [ '.xlsx', '.XLSX' ]
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+def get_column_number(cell_ref):
+    """ zero-based column of an excel cell reference, for example B7 -> 1 """
+    col = 0
+    for c in cell_ref:
+        if not c.isalpha():
+            break
+        col = 26 * col + (ord(c.upper()) - ord('A') + 1)
+    return(col - 1)
+
+def read_xlsx(filename):
+    """ rows of the first worksheet of an excel file, each a list of strings, with blanks for empty cells """
+    zf = zipfile.ZipFile(filename, 'r')
+    shared = [ ]
+    if 'xl/sharedStrings.xml' in zf.namelist():
+        root = ElementTree.fromstring(zf.read('xl/sharedStrings.xml'))
+        for si in root.iter(XLSX_NS + 'si'):
+            # rich text is split into runs, each with its own t element
+            shared.append(''.join([ t.text or '' for t in si.iter(XLSX_NS + 't') ]))
+    sheets = sorted([ n for n in zf.namelist() if n.startswith('xl/worksheets/sheet') and n.endswith('.xml') ], \
+                    key=lambda n: int(n[len('xl/worksheets/sheet'):-len('.xml')]))
+    assert(len(sheets) > 0), 'no worksheet in %s' % filename
+    root = ElementTree.fromstring(zf.read(sheets[0]))
+    zf.close()
+    rows = [ ]
+    for row in root.iter(XLSX_NS + 'row'):
+        values = dict()
+        for (k, cell) in enumerate(row.findall(XLSX_NS + 'c')):
+            col = get_column_number(cell.get('r')) if cell.get('r') is not None else k
+            cell_type = cell.get('t')
+            if cell_type == 'inlineStr':
+                text = ''.join([ t.text or '' for t in cell.iter(XLSX_NS + 't') ])
+            else:
+                v = cell.find(XLSX_NS + 'v')
+                text = v.text if (v is not None) and (v.text is not None) else ''
+                if cell_type == 's':
+                    text = shared[int(text)]
+            values[col] = text.encode('utf-8').strip() if isinstance(text, unicode) else text.strip()
+        n_col = (max(values.keys()) + 1) if len(values) > 0 else 0
+        rows.append([ values.get(j, '') for j in range(n_col) ])
+    return(rows)
+
+def read_control_table(filename):
+    """
+    the control table as a data frame, from a tab-delimited file or the first sheet of an excel file
+    the first row has the headers; excel headers are lower-cased so that ID and Name match id and name
+    """
+    (base, ext) = os.path.splitext(filename)
+    if ext not in XLSX_EXTENSIONS:
+        return DataFrame(filename=filename)
+    logger.info('reading from %s', filename)
+    rows = [ r for r in read_xlsx(filename) if any(r) ]
+    assert(len(rows) > 0), 'no rows in %s' % filename
+    headers = [ h.lower() for h in rows[0] ]
+    n_column = len(headers)
+    rows = [ (r + [''] * n_column)[:n_column] for r in rows[1:] ]
+    columns = zip(*rows) if len(rows) > 0 else [ () for h in headers ]
+    return DataFrame(data=[ (h, convert_column(list(toks))) for (h, toks) in zip(headers, columns) ])
+
+def get_control_pairs(control, simple=True):
+    """
+    the (id, name) pairs of the controls in the data frame, as two string arrays
+    simple: every row is a control
+    otherwise the table has control and exptl counts from get_controls, and a pair is a control
+    if it is a control at least as often as not, or its name is nd, or it is CONTROL or IgG
+    """
+    if (simple):
+        (ids, names) = control.get_columns('id', 'name')
+    else:
+        (id, name, n_control, exptl) = [ np.asarray(x) for x in control.get_columns('id', 'name', 'control', 'exptl') ]
+        isND = np.in1d(name, [ 'ND', 'nd', 'N.D.' ])
+        isControl = (id == 'CONTROL')
+        isIgg = (name == 'IgG')
+        is_control = (n_control >= exptl) | isND | isControl | isIgg
+        # insert some special cases
+        ids = np.append(id[is_control].astype(str), 'CONTROL')
+        names = np.append(name[is_control].astype(str), 'IgG')
+    return(np.asarray(ids).astype(str), np.asarray(names).astype(str))
+
+def get_id_names_table(control):
+    """ (ids, cnts, names) for each distinct id of a counts table, as get_controls.get_id_names, as arrays """
+    (id, name) = [ np.asarray(x) for x in control.get_columns('id', 'name') ]
+    (id_list, cnts, name_list) = get_id_names(id, name)
+    return(np.asarray(id_list).astype(str), np.asarray(cnts, dtype=int), np.asarray(name_list, dtype=str))
+
+def write_id_names(id_names, filename=ID_NAMES_FILENAME):
+    """ write the id to names table of get_id_names_table """
+    (id_list, cnts, name_list) = id_names
+    df = DataFrame(data=[ ('id', id_list.tolist()), ('cnt', cnts.tolist()), ('names', name_list.tolist()) ])
+    df.write(filename)
+
+class ControlIndex:
+    """
+    the distinct control (id, name) pairs as string arrays sorted by id then name,
+    and control_ids, the sorted distinct ids used for masking spots
+    spots are looked up by binary search of control_ids, so no dict is built for each file
+    an index loaded by load_control_index is memory-mapped read-only; worker processes share the pages,
+    and pickling sends only the directory name, which the worker maps again
+    keys, len and in work as for the older dict of (id, name) -> True
+    """
+    def __init__(self, ids, names, control_ids, sha1, dirname=None):
+        self.ids = ids
+        self.names = names
+        self.control_ids = control_ids
+        self.sha1 = sha1
+        self.dirname = dirname
+
+    def keys(self):
+        return zip(self.ids, self.names)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pair):
+        (i, n) = pair
+        lo = np.searchsorted(self.ids, i, side='left')
+        hi = np.searchsorted(self.ids, i, side='right')
+        return bool(np.any(self.names[lo:hi] == n))
+
+    def is_control_id(self, ids):
+        """ boolean array, True where an id is a control id; a Categorical only has its categories looked up """
+        if isinstance(ids, Categorical):
+            return self.is_control_id(ids.categories)[ids.codes]
+        ids = np.asarray(ids)
+        if (len(ids) == 0) or (len(self.control_ids) == 0):
+            return np.zeros(len(ids), dtype=bool)
+        if ids.dtype.kind == 'O':
+            ids = ids.astype(str)
+        pos = np.minimum(np.searchsorted(self.control_ids, ids), len(self.control_ids) - 1)
+        return self.control_ids[pos] == ids
+
+    def __getstate__(self):
+        if self.dirname is not None:
+            return { 'dirname': self.dirname }
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        if 'ids' not in state:
+            (arrays, meta) = read_index(state['dirname'])
+            state = dict(arrays, sha1=meta['pairs_sha1'], dirname=state['dirname'])
+        self.__dict__.update(state)
+
+def get_pairs_sha1(ids, names):
+    """ hash of the sorted (id, name) pairs, the same as manifest.get_control_sha1 of the equivalent dict """
+    sha1 = hashlib.sha1()
+    for (i, n) in zip(ids, names):
+        sha1.update(('%s\t%s\n' % (i, n)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def make_control_index(ids, names):
+    """ ControlIndex of the distinct (id, name) pairs, in memory """
+    ids = np.asarray(ids).astype(str)
+    names = np.asarray(names).astype(str)
+    order = np.lexsort((names, ids))
+    (ids, names) = (ids[order], names[order])
+    is_new = np.ones(len(ids), dtype=bool)
+    is_new[1:] = (ids[1:] != ids[:-1]) | (names[1:] != names[:-1])
+    (ids, names) = (ids[is_new], names[is_new])
+    return ControlIndex(ids, names, np.unique(ids), get_pairs_sha1(ids, names))
+
+def get_control_index(control_dict):
+    """ a ControlIndex as it is, or an index of the keys of a dict of (id, name) pairs """
+    if isinstance(control_dict, ControlIndex):
+        return(control_dict)
+    keys = list(control_dict.keys())
+    return make_control_index([ i for (i, n) in keys ], [ n for (i, n) in keys ])
+
+def get_index_name(filename, simple=True):
+    """ directory of the compiled index for a control file, for example control.xlsx -> control.xlsx.index """
+    return filename + ('' if simple else '.counts') + INDEX_EXT
+
+def get_source_stat(filename):
+    st = os.stat(filename)
+    return { 'size': st.st_size, 'mtime': st.st_mtime }
+
+def read_index(dirname):
+    """ (arrays, meta) of a compiled index, with the arrays memory-mapped read-only """
+    fp = open(os.path.join(dirname, META_FILENAME), 'r')
+    meta = json.load(fp)
+    fp.close()
+    arrays = dict()
+    for a in INDEX_ARRAYS:
+        arrays[a] = np.load(os.path.join(dirname, a + '.npy'), mmap_mode='r')
+    return(arrays, meta)
+
+def read_id_names(dirname):
+    """ the id to names table saved with a counts index """
+    return tuple([ np.load(os.path.join(dirname, a + '.npy')) for a in ID_NAMES_ARRAYS ])
+
+def write_index(dirname, index, meta, id_names=None):
+    """
+    write the index under a temporary name and rename it, replacing any earlier copy
+    id_names, the table of get_id_names_table, is saved with it for a counts index
+    """
+    parent = os.path.dirname(dirname) or '.'
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    os.chmod(tmp_dir, 0o755)
+    for a in INDEX_ARRAYS:
+        np.save(os.path.join(tmp_dir, a + '.npy'), getattr(index, a))
+    if id_names is not None:
+        for (a, x) in zip(ID_NAMES_ARRAYS, id_names):
+            np.save(os.path.join(tmp_dir, a + '.npy'), x)
+    fp = open(os.path.join(tmp_dir, META_FILENAME), 'w')
+    json.dump(meta, fp)
+    fp.close()
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname, ignore_errors=True)
+    os.rename(tmp_dir, dirname)
+    logger.info('wrote %d control pairs to %s', len(index), dirname)
+
+def is_current(meta, filename, simple, stat):
+    """
+    True if the index meta matches the control file: same version and mode,
+    and the same size and modification time, or failing those the same content hash
+    """
+    if (meta.get('version') != INDEX_VERSION) or (meta.get('simple') != simple):
+        return False
+    if (meta.get('size') == stat['size']) and (meta.get('mtime') == stat['mtime']):
+        return True
+    return meta.get('source_sha1') == get_sha1(filename)
+
+def load_control_index(filename, simple=True):
+    """
+    the ControlIndex for a tab-delimited or excel control file
+    the index compiled next to the file is memory-mapped if it is newer than the file;
+    otherwise the file is read, and the index is compiled and saved for the next run
+    an index that cannot be saved, for example in a read-only directory, is kept in memory
+    simple=False also writes id_to_names.txt, from the index when it is current
+    """
+    dirname = get_index_name(filename, simple)
+    stat = get_source_stat(filename)
+    if os.path.isfile(os.path.join(dirname, META_FILENAME)):
+        (arrays, meta) = read_index(dirname)
+        if is_current(meta, filename, simple, stat):
+            logger.info('loading %d control pairs from %s', len(arrays['ids']), dirname)
+            if (meta['size'] != stat['size']) or (meta['mtime'] != stat['mtime']):
+                # same contents, new time stamp: record it so that the file is not hashed again
+                meta.update(stat)
+                fp = open(os.path.join(dirname, META_FILENAME), 'w')
+                json.dump(meta, fp)
+                fp.close()
+            if not simple:
+                write_id_names(read_id_names(dirname))
+            return ControlIndex(arrays['ids'], arrays['names'], arrays['control_ids'], meta['pairs_sha1'], dirname)
+        logger.info('%s is out of date for %s, rebuilding', dirname, filename)
+
+    logger.info('reading controls from %s', filename)
+    control = read_control_table(filename)
+    (ids, names) = get_control_pairs(control, simple)
+    id_names = None if simple else get_id_names_table(control)
+    if id_names is not None:
+        write_id_names(id_names)
+    index = make_control_index(ids, names)
+    meta = { 'version': INDEX_VERSION, 'simple': simple, 'source_sha1': get_sha1(filename), \
+             'pairs_sha1': index.sha1, 'n_pair': len(index) }
+    meta.update(stat)
+    try:
+        write_index(dirname, index, meta, id_names)
+    except (IOError, OSError) as e:
+        logger.warn('could not save control index %s: %s', dirname, str(e))
+        return(index)
+    (arrays, meta) = read_index(dirname)
+    return ControlIndex(arrays['ids'], arrays['names'], arrays['control_ids'], meta['pairs_sha1'], dirname)
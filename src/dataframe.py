@@ -6,13 +6,149 @@ joel.bader@jhu.edu
 
 import logging
 import os
+import json
+import shutil
+import tempfile
 import numpy as np
 
+from categorical import Categorical, categorize
+
 #logging.basicConfig(format='%(levelname)s %(name)s.%(funcName)s: %(message)s')
 logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
 logger = logging.getLogger(name='dataframe')
 logger.setLevel(logging.INFO)
 
+# rows formatted and written per block by write_table
+WRITE_BLOCK_ROWS = 10000
+# buffer size for files written by write_table
+WRITE_BUFFER_BYTES = 1 << 20
+
+# binary data frames are directories with a schema and one .npy file per column
+# version 2 adds categorical columns, stored as codes plus a .categories.npy file
+BINARY_EXT = '.df'
+BINARY_VERSION = 2
+CATEGORY_DTYPE = 'category'
+SCHEMA_FILENAME = 'schema.json'
+
+def is_binary(filename):
+    """ True if filename is a data frame saved by DataFrame.save """
+    return os.path.isfile(os.path.join(filename, SCHEMA_FILENAME))
+
+def get_binary_name(filename):
+    """ name of the binary data frame that goes with a text file, for example x-summary.txt -> x-summary.df """
+    return os.path.splitext(filename)[0] + BINARY_EXT
+
+def get_text_name(filename):
+    """ name of the text export that goes with a binary data frame """
+    return os.path.splitext(filename)[0] + '.txt'
+
+def read_binary(dirname, mmap=True):
+    """
+    list of (header, array) from a data frame saved by DataFrame.save
+    numeric and string columns, and the codes of categorical columns, are memory-mapped copy-on-write unless mmap is False
+    """
+    fp = open(os.path.join(dirname, SCHEMA_FILENAME), 'r')
+    schema = json.load(fp)
+    fp.close()
+    assert(schema['version'] <= BINARY_VERSION), '%s has version %s, expected at most %d' % (dirname, schema['version'], BINARY_VERSION)
+    mmap_mode = 'c' if mmap else None
+    data = [ ]
+    for (j, h) in enumerate(schema['headers']):
+        values = np.load(os.path.join(dirname, '%03d.npy' % j), mmap_mode=mmap_mode)
+        if schema['dtypes'][j] == CATEGORY_DTYPE:
+            values = Categorical(values, np.load(os.path.join(dirname, '%03d.categories.npy' % j)))
+        data.append( (str(h), values) )
+    return data
+
+# number of values used to guess the type of a column read from a file
+INFER_SAMPLE_ROWS = 100
+# types a column can be converted to, in the order they are tried
+COLUMN_TYPES = [ int, float, str ]
+COLUMN_DTYPES = { int: np.int64, float: np.float64, str: str }
+
+def infer_type(toks):
+    """ the first of COLUMN_TYPES that every value in toks converts to """
+    for c_type in COLUMN_TYPES[:-1]:
+        try:
+            for t in toks:
+                c_type(t)
+            return c_type
+        except (ValueError, OverflowError):
+            pass
+    return str
+
+def convert_column(toks, c_type=None):
+    """
+    convert a column of strings to an int64, float64 or string array in one step
+    c_type is int, float or str, or None to infer the type from the first INFER_SAMPLE_ROWS values;
+    if the rest of an inferred column does not convert, the next type in COLUMN_TYPES is tried
+    """
+    if len(toks) == 0:
+        return np.array(toks)
+    toks = np.array(toks, dtype=str)
+    if c_type is not None:
+        assert(c_type in COLUMN_DTYPES), 'bad column type %s' % str(c_type)
+        return toks.astype(COLUMN_DTYPES[c_type])
+    c_type = infer_type(toks[:INFER_SAMPLE_ROWS])
+    for c_type in COLUMN_TYPES[COLUMN_TYPES.index(c_type):]:
+        try:
+            return toks.astype(COLUMN_DTYPES[c_type])
+        except (ValueError, OverflowError):
+            logger.debug('column is not %s after the first %d rows', c_type.__name__, INFER_SAMPLE_ROWS)
+    return toks
+
+def format_column(values, precision=None):
+    """
+    list of strings for the values of one column
+    floats use str(), the shortest string that reads back as the same value,
+    or %g with precision significant digits
+    categorical columns format each category once, unless there are more categories than values
+    """
+    if isinstance(values, Categorical):
+        if len(values.categories) > len(values):
+            return map(str, np.asarray(values).tolist())
+        categories = map(str, values.categories.tolist())
+        return [ categories[c] for c in values.codes.tolist() ]
+    if isinstance(values, np.ndarray):
+        if (values.dtype.kind == 'f') and (precision is not None):
+            return map(('%.' + str(precision) + 'g').__mod__, values.tolist())
+        if values.dtype.kind in 'iub':
+            # python ints format faster than numpy scalars, and the same way
+            return map(str, values.tolist())
+    return map(str, values)
+
+def write_table(filename, headers, columns, rows=None, sep='\t', precision=None, preamble=None):
+    """
+    write a tab-delimited table, formatting each column a block of rows at a time
+    headers is the list of column names and columns the corresponding list of arrays or lists
+    rows is a list of row numbers, with the first list element being row 1 (not row 0)
+    precision is the number of significant digits for floats, or None for full precision
+    preamble, if given, is text written before the header line, for example the header records of a gpr file
+    """
+    n_row = len(columns[0]) if len(columns) > 0 else 0
+    index = None
+    if rows is not None:
+        index = np.asarray(rows, dtype=int) - 1
+        n_row = len(index)
+    # lists, for example string columns, are indexed as object arrays
+    columns = [ c if isinstance(c, (np.ndarray, Categorical)) or (index is None) else np.array(c, dtype=object) for c in columns ]
+    logger.info('writing %d by %d table to %s', n_row, len(headers), filename)
+    fp = open(filename, 'w', WRITE_BUFFER_BYTES)
+    if preamble is not None:
+        fp.write(preamble)
+    fp.write(sep.join(headers) + '\n')
+    for start in range(0, n_row, WRITE_BLOCK_ROWS):
+        if start > 0:
+            logger.info('... %d', start)
+        end = min(start + WRITE_BLOCK_ROWS, n_row)
+        if index is None:
+            block = [ c[start:end] for c in columns ]
+        else:
+            block = [ c[index[start:end]] for c in columns ]
+        toks = [ format_column(c, precision) for c in block ]
+        fp.write('\n'.join(map(sep.join, zip(*toks))) + '\n')
+    fp.close()
+
 class DataFrame:
     """
     somewhat like an R data frame
@@ -20,28 +156,17 @@ class DataFrame:
     each array must be the same length
     the column order is stored in the headers list
     """
-    def __init__(self, data=None, filename=None, headers=None, sep='\t'):
+    def __init__(self, data=None, filename=None, headers=None, sep='\t', schema=None):
         """
         initialize either from data or from a file
         if from data, data is a list of tuples (header_name, data_list)
         if from a file, extract the headers as the first line unless headers is not null
+        schema is an optional dict from header to int, float or str for columns read from a file;
+        other columns are int64 if every value is an int, else float64 if every value is a float, else strings;
+        string columns with few distinct values, at most CATEGORY_MAX_FRACTION of the rows, are Categoricals
+        if filename is a binary data frame from save, it is read with its saved types and memory-mapped
         """
         
-        def is_type(str_val, typecast):
-            try:
-                typecast(str_val)
-                return True
-            except ValueError:
-                return False
-            
-        def try_to_convert(str_val):
-            new_val = str_val
-            if is_type(str_val, int):
-                new_val = int(str_val)
-            elif is_type(str_val, float):
-                new_val = float(str_val)
-            return(new_val)
-        
         n_err = 0
         if (data is None) and (filename is None):
             logger.error('data and filename both none')
@@ -56,6 +181,14 @@ class DataFrame:
             logger.error('stopping after %d errors', n_err)
             assert(1==0)
         
+        mapped = False
+        if (filename is not None) and is_binary(filename):
+            assert(headers is None), 'headers are stored with binary data frame %s' % filename
+            logger.info('reading from %s', filename)
+            data = read_binary(filename)
+            filename = None
+            mapped = True
+
         # initialize from a file by creating the same data format
         if filename is not None:
             logger.info('reading from %s', filename)
@@ -71,12 +204,15 @@ class DataFrame:
                 assert(h not in header_dict), 'reused header %s' % h
                 header_dict[h] = True
 
+            if schema is None:
+                schema = dict()
+            for h in schema:
+                assert(h in header_dict), 'schema column %s is not in the headers' % h
+
             # read the data        
             data_lines = fp.readlines()
             fp.close()
-            data_tmp = dict()
-            for h in headers:
-                data_tmp[h] = [ ]
+            rows = [ ]
             for data_line in data_lines:
                 toks = data_line.strip().split(sep)
                 # pad with blanks if too few values
@@ -84,12 +220,15 @@ class DataFrame:
                     logger.warn('expected %d columns found %d: %s' , n_column, len(toks), data_line)
                     toks += [''] * (n_column - len(toks))
                 assert(len(toks)==n_column), 'expected %d columns found %d: %s' % (n_column, len(toks), data_line)
-                for (j, h) in enumerate(headers):
-                    new_val = try_to_convert(toks[j])
-                    data_tmp[h].append(new_val)
+                rows.append(toks)
+            # transpose to columns and convert each column at once
+            columns = zip(*rows) if len(rows) > 0 else [ () for h in headers ]
             data = [ ]
-            for h in headers:
-                data.append( (h, data_tmp[h]))
+            for (h, toks) in zip(headers, columns):
+                values = convert_column(list(toks), schema.get(h))
+                if values.dtype.kind == 'S':
+                    values = categorize(values)
+                data.append( (h, values) )
         
         # initialize from data
         self.headers = [ ]
@@ -102,7 +241,8 @@ class DataFrame:
                 self.n_row = len(data_list)
             else:
                 assert(self.n_row == len(data_list)), 'column %s expected %d rows found %d' % (h, self.n_row, len(data_list))
-            self.data[h] = np.array(data_list)
+            # memory-mapped and categorical columns are used as they are, without a copy
+            self.data[h] = data_list if mapped or isinstance(data_list, Categorical) else np.array(data_list)
         self.n_column = len(self.headers)
 
     def get_columns(self, *args):
@@ -133,29 +273,54 @@ class DataFrame:
             assert(len(data_list) == self.n_row), 'expected %d rows but found %d' % (self.n_row, len(this_data))
             self.n_column += 1
             self.headers.append(hdr)
-            self.data[hdr] = np.array(data_list)
+            self.data[hdr] = data_list if isinstance(data_list, Categorical) else np.array(data_list)
         n_new = len(args)
         logger.info('added %d columns: %s', n_new, ' '.join(self.headers[-n_new:]))
         
-    def write(self, filename, rows=None, columns=None, sep='\t'):
+    def write(self, filename, rows=None, columns=None, sep='\t', precision=None):
         """
         rows is a list of row numbers, with the first list element being row 1 (not row 0)
         columns is a list of column headers
+        precision is the number of significant digits for floats, or None for full precision
         """
-        if rows is None:
-            rows = range(1, self.n_row + 1)
         if columns is None:
             columns = self.headers
-        fp = open(filename, 'w')
-        n_col = len(columns)
-        logger.info('writing %d by %d data frame to %s', len(rows), n_col, filename)
-        fp.write('\t'.join(columns) + '\n')
-        for i in rows:
-            if i % 10000 == 0:
-                logger.info('... %d', i+1)
-            toks = [ str(self.data[c][i-1]) for c in columns ]
-            fp.write('\t'.join(toks) + '\n')
-        fp.close()         
+        write_table(filename, columns, [ self.data[c] for c in columns ], rows, sep, precision)
+
+    def save(self, dirname):
+        """
+        save in the binary columnar format read back by DataFrame(filename=dirname):
+        a directory with schema.json and one .npy file per column
+        the directory is written under a temporary name and then renamed, replacing any earlier copy
+        """
+        parent = os.path.dirname(dirname) or '.'
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        os.chmod(tmp_dir, 0o755)
+        dtypes = [ ]
+        for (j, h) in enumerate(self.headers):
+            values = self.data[h]
+            if isinstance(values, Categorical):
+                np.save(os.path.join(tmp_dir, '%03d.categories.npy' % j), values.categories)
+                np.save(os.path.join(tmp_dir, '%03d.npy' % j), values.codes)
+                dtypes.append(CATEGORY_DTYPE)
+                continue
+            # object columns, for example mixed strings, are stored as strings so that they can be mapped
+            if values.dtype.kind == 'O':
+                values = values.astype(str)
+            np.save(os.path.join(tmp_dir, '%03d.npy' % j), values)
+            dtypes.append(values.dtype.str)
+        fp = open(os.path.join(tmp_dir, SCHEMA_FILENAME), 'w')
+        json.dump({ 'version': BINARY_VERSION, 'n_row': self.n_row, 'headers': self.headers, 'dtypes': dtypes }, fp)
+        fp.close()
+        logger.info('saving %d by %d data frame to %s', self.n_row or 0, self.n_column, dirname)
+        if os.path.exists(dirname):
+            old_dir = tempfile.mkdtemp(prefix='.old-', dir=parent)
+            os.rmdir(old_dir)
+            os.rename(dirname, old_dir)
+            os.rename(tmp_dir, dirname)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(tmp_dir, dirname)
 
 def main():
     return 1
@@ -7,11 +7,24 @@ joel.bader@jhu.edu
 
 import logging
 import os
-from gpr import GPR
-from dataframe import DataFrame
+from gpr import GPR, read_chunks, CHUNK_ROWS, split_gpr_name, GPR_EXTENSIONS
+from dataframe import DataFrame, BINARY_EXT, get_binary_name, write_table
+from groupby import GroupBy
+from categorical import Categorical, factorize, join_pairs
+from spotmask import get_file_mask, get_signal_mask, log_counts
+from gpr_cache import add_cache_arguments, get_cache_from_args, get_sha1
+from manifest import RunManifest, get_control_sha1
+from controlindex import load_control_index
+from pooldesign import PoolDesign, PoolHit, grid_design, get_design, DEFAULT_DESIGN
+from bgfit import RATIO_MODES, fit_foreground, get_fit_ratio, get_fit_mask
+from profiler import StageProfiler, NO_PROFILE, write_report, PROFILE_FILENAME, PROFILE_DUMP_FILENAME
 import numpy as np
 import numpy.ma
 import re
+import multiprocessing
+import traceback
+import signal
+import cProfile
 
 import argparse # command line arguments
 
@@ -28,61 +41,34 @@ ap.add_argument('--control_filename', default='/Users/joel/Dropbox/deconv/src/co
                 help='file with controls, header "id name" then one row for each id and name (default: %(default)s)')
 ap.add_argument('--create_map', action='store_true', help='create pool-to-file map by parsing gpr filenames (default: %(default)s)')
 ap.add_argument('--map_filename', default = 'map_pool_to_file.txt', help='RESULTS_DIR/POOL_FILENAME has the pool-to-file map (default: %(default)s)')
+ap.add_argument('--design', default=DEFAULT_DESIGN, help='pooling design: grid:N[:DIRECTIONS] for N pools in each direction, e.g. grid:24 or grid:12:HVD for 3-D, or std:N_CLONE:Q:N_LAYER for a shifted transversal design (default: %(default)s)')
 ap.add_argument('--signal_fg', default = 'F635 Median', help='gpr signal foreground (default: %(default)s)')
 ap.add_argument('--signal_bg', default = 'B635 Median', help='gpr signal background (default: %(default)s)')
 ap.add_argument('--norm_fg', default = 'F532 Median', help='gpr normalization foreground (default: %(default)s)')
 ap.add_argument('--norm_bg', default = 'B532 Median', help='gpr normalization background (default: %(default)s)')
 ap.add_argument('--do_norm', action='store_true', help='normalize signal fg/bg by norm fg/bg (default: %(default)s)')
 ap.add_argument('--do_log', action='store_true', help='take log2 before calculating z-scores (default: %(default)s)')
+ap.add_argument('--sweep', action='store_true', help='parse once and run every combination of --do_norm and --do_log, writing to RESULTS_DIR, RESULTS_DIR_norm, RESULTS_DIR_log and RESULTS_DIR_norm_log (default: %(default)s)')
+ap.add_argument('--no_text', action='store_true', help='save gpr results only in the binary format, without the -top.txt and -summary.txt exports (default: %(default)s)')
 ap.add_argument('--skip_gpr', action='store_true', help='skip the gpr analysis (default: %(default)s)')
 ap.add_argument('--skip_deconv', action='store_true', help='skip the deconvolution (default: %(default)s)')
+ap.add_argument('--force', action='store_true', help='redo every gpr file and the deconvolution even if the manifest says they are up to date (default: %(default)s)')
+ap.add_argument('--jobs', type=int, default=1, help='number of worker processes for the gpr files (default: %(default)s)')
+ap.add_argument('--profile', action='store_true', help='write the wall time, cpu time and peak memory of each stage of each file to RESULTS_DIR/%s (default: %%(default)s)' % PROFILE_FILENAME)
+ap.add_argument('--profile_dump', action='store_true', help='also rerun the slowest gpr file under cProfile and write the statistics to RESULTS_DIR/%s (default: %%(default)s)' % PROFILE_DUMP_FILENAME)
+ap.add_argument('--ratio_mode', default='simple', choices=RATIO_MODES, help='simple: ratio is fg / bg; regression: fit fg ~ bg + sqrt(bg) + ln(bg) for each array and use fg over the fitted fg (default: %(default)s)')
+ap.add_argument('--stream', action='store_true', help='read each gpr file in blocks of CHUNK_ROWS rows, in two passes, so that memory is bounded by the block size rather than the file size; parsed columns are not cached (default: %(default)s)')
+ap.add_argument('--chunk_rows', type=int, default=CHUNK_ROWS, help='rows per block for --stream (default: %(default)s)')
+add_cache_arguments(ap)
 
 def get_control_from_file(filename, simple=True):
     """
-    read the file as a data frame
-    for each id, check how many times it occurs as control or experimental
-    make a dict with (id, name) as key where pair is often as controls, or name is nd
+    the controls of a tab-delimited or excel file, as a ControlIndex of (id, name) pairs
+    with simple, every row is a control; otherwise the file has counts from get_controls,
+    and a pair is a control if it is often a control, or its name is nd
+    the index is compiled once and cached next to the file, see controlindex.load_control_index
     """
-    logger.info('reading controls from %s', filename)
-    control = DataFrame(filename=filename)
-    control_dict = dict()
-    
-    if (simple):
-        (ids, names) = control.get_columns('id','name')
-        for (id, name) in zip(ids, names):
-            control_dict[(id,name)] = True
-    else:
-        (id, name, control, exptl) = control.get_columns('id', 'name', 'control', 'exptl')
-        id_to_name = dict()
-        for (i, n, c, e) in zip(id, name, control, exptl):
-            isND = n in [ 'ND', 'nd', 'N.D.' ]
-            isControl = (i == 'CONTROL')
-            isIgg = (n == 'IgG')
-            if ((c >= e) or isND or isControl or isIgg):
-                control_dict[(i, n)] = True
-                
-        # insert some special cases
-        control_dict[('CONTROL', 'IgG')] = True
-    
-        for (i, n) in zip(id, name):
-            if i not in id_to_name:
-                id_to_name[i] = dict()
-            id_to_name[i][n] = True
-        
-        id_to_names = dict()
-        for i in id_to_name:
-            names = sorted(id_to_name[i].keys())
-            cnt = len(names)
-            name_str = ','.join(names)
-            id_to_names[i] = dict()
-            id_to_names[i]['cnt'] = cnt
-            id_to_names[i]['names'] = name_str
-        ids = sorted(id_to_names.keys())
-        cnts = [ id_to_names[x]['cnt'] for x in ids ]
-        names = [ id_to_names[x]['names'] for x in ids ]
-        df = DataFrame(data=[ ('id', ids), ('cnt', cnts), ('names', names)])
-        df.write('id_to_names.txt')
-    return(control_dict)
+    return load_control_index(filename, simple)
 
 def print_control_dict(control_dict, control_dict_filename):
     keys = sorted(control_dict.keys())
@@ -92,19 +78,34 @@ def print_control_dict(control_dict, control_dict_filename):
     df.write(filename=control_dict_filename)
     
 
-def get_ratio_zscore(fg, bg, n_fg, n_bg, do_norm, do_log):
+def get_ratio(fg, bg, n_fg, n_bg, do_norm, do_log, fg_fit=None, n_fg_fit=None):
     """
-    calculate ratio as fg / bg
-    calculate mean and stdev of ratio
-    calculate z-score as (ratio - mean)/stdev
-    return ratio and zscore
+    calculate ratio as fg / bg, divided by n_fg / n_bg if do_norm, then log2 if do_log
+    if fg_fit is given, the regression ratio fg / fg_fit is used instead of fg / bg,
+    and n_fg / n_fg_fit for the norm channel, see bgfit.get_fit_ratio
     """
-    ratio = np.array(fg, dtype=float) / np.array(bg, dtype=float)
+    if fg_fit is None:
+        ratio = np.array(fg, dtype=float) / np.array(bg, dtype=float)
+    else:
+        ratio = get_fit_ratio(fg, fg_fit)
     if do_norm:
-        ratio_norm = np.array(n_fg, dtype=float) / np.array(n_bg, dtype=float)
+        if n_fg_fit is None:
+            ratio_norm = np.array(n_fg, dtype=float) / np.array(n_bg, dtype=float)
+        else:
+            ratio_norm = get_fit_ratio(n_fg, n_fg_fit)
         ratio = ratio / ratio_norm
     if do_log:
         ratio = np.log2(ratio)
+    return ratio
+
+def get_ratio_zscore(fg, bg, n_fg, n_bg, do_norm, do_log, fg_fit=None, n_fg_fit=None):
+    """
+    calculate ratio as fg / bg, or from the fitted foreground as for get_ratio
+    calculate mean and stdev of ratio
+    calculate z-score as (ratio - mean)/stdev
+    return ratio and zscore
+    """
+    ratio = get_ratio(fg, bg, n_fg, n_bg, do_norm, do_log, fg_fit, n_fg_fit)
     mean = ratio.mean()
     stdev = ratio.std(ddof = 1) # subtract 1 ddof for mean to be consistent with excel stdev
     zscore = (ratio - mean)/stdev
@@ -118,68 +119,64 @@ def get_mean_by_group(group_list, data_list):
     the means for each key (len = number of distinct keys)
     the corresponding mean for each row
     """
-    group_to_sum = dict()
-    group_to_cnt = dict()
-    for (i, grp) in group_list.iteritems():
-        group_to_sum[grp] = group_to_sum.get(grp, 0) + data_list[i]
-        group_to_cnt[grp] = group_to_
-        for i in range(len(zscore_naive)):
-            if not mask[i]:
-                this_id = id[i]
-                id_to_sum[this_id] = id_to_sum.get(this_id, 0) + zscore_naive[i]
-                id_to_cnt[this_id] = id_to_cnt.get(this_id, 0) + zscore_naive[i]
-        id_to_mean = dict()
-        for this_id in id_to_sum.keys():
-            id_to_mean[this_id] = float(id_to_sum[this_id]) / float(id_to_cnt[this_id])
-    
-        zscore_mean = [ id_to_mean.get(this_id, np.nan) for this_id in id ]
+    groups = GroupBy(group_list)
+    (mean_by_group, mean_by_row) = groups.aggregate(data_list, ['mean'])['mean']
+    return(dict(zip(groups.keys, mean_by_group)), mean_by_row)
 
-def extract_by_group(row_group, row_data):
+def extract_by_group(row_group, row_data, groups=None):
     """
     return a dict indexed by unique values in row_group
     dict value = list of values in row_data belonging to this group
+    groups is an optional GroupBy for row_group
     """
+    if groups is None:
+        groups = GroupBy(row_group)
     data_by_group = dict()
-    for (g, d) in zip(row_group, row_data):
-        if g not in data_by_group:
-            data_by_group[g] = [ ]
-        # data_by_group[g] = data_by_group.get(g, [ ]) + [ d ]
-        data_by_group[g].append(d)
+    for (g, d) in zip(groups.keys, groups.split(row_data)):
+        data_by_group[g] = list(d)
     return(data_by_group)
-        
-def apply_by_group(fn, row_group, row_data):
+
+# functions with a vectorized GroupBy equivalent
+GROUP_FN_STATS = { np.mean: 'mean', np.sum: 'sum', len: 'count' }
+
+def apply_by_group(fn, row_group, row_data, groups=None):
     """
     apply function fn to groups defined by row_group with data row_data
     fn reduces list to a scalar
+    np.mean, np.sum and len are computed by GroupBy, with data_by_group None;
+    other functions are called once per group on the lists of extract_by_group
+    groups is an optional GroupBy for row_group
     """
-    data_by_group = extract_by_group(row_group, row_data)
-    fn_by_group = dict()
-    for (grp, data_list) in data_by_group.items():
-        fn_by_group[grp] = fn(data_list)
-    fn_by_row = [ fn_by_group[x] for x in row_group ]
+    if groups is None:
+        groups = GroupBy(row_group)
+    data_by_group = None
+    if fn in GROUP_FN_STATS:
+        (value_by_group, fn_by_row) = groups.aggregate(row_data, [ GROUP_FN_STATS[fn] ])[GROUP_FN_STATS[fn]]
+    else:
+        data_by_group = extract_by_group(row_group, row_data, groups)
+        value_by_group = [ fn(data_by_group[g]) for g in groups.keys ]
+        fn_by_row = groups.broadcast(value_by_group)
+    fn_by_group = dict(zip(groups.keys, value_by_group))
     return(fn_by_group, fn_by_row, data_by_group)
 
 def get_good_ids_rows(id_list, zscore_list, z_threshold = 2.5):
     """
     ad hoc definition: retain rows where mask is good and zscore is above a threshold of 2.5
-    then retain the ids corresponding to these rows
-    """
-    n_row = len(id_list)
-    row_num = range(1, n_row + 1)
-    id_subset = [ ]
-    row_subset = [ ]
-    for (r, i, z) in zip(row_num, id_list, zscore_list):
-        if z < z_threshold:
-            continue
-        row_subset.append(r)
-        if i not in id_subset:
-            id_subset.append(i)
+    then retain the ids corresponding to these rows, in order of their first retained row
+    rows are numbered from 1, and a nan zscore is not below the threshold
+    """
+    ids = factorize(id_list)
+    with np.errstate(invalid='ignore'):
+        rows = np.flatnonzero(~(np.asarray(zscore_list, dtype=float) < z_threshold))
+    (codes, first) = np.unique(ids.codes[rows], return_index=True)
+    id_subset = ids.categories[codes[np.argsort(first)]].tolist()
+    row_subset = (rows + 1).tolist()
     return(id_subset, row_subset)
 
 def process_gpr_file(input_file, output_file, summary_file, \
                      signal_fg, signal_bg, norm_fg, norm_bg, \
                      do_norm, do_log, \
-                     control_dict=None):
+                     control_dict=None, cache=None, text=True):
     """
     open input_file as a gpr
     extract columns corresponding to F635 Median and B635 Median (fore- and back-ground)
@@ -191,143 +188,558 @@ def process_gpr_file(input_file, output_file, summary_file, \
     else:
         mask out values based on control_dict
     
+    if cache is not None, parsed columns are read from and added to the cache
+    the summary is saved as a binary data frame next to summary_file;
+    if text is True, the top rows and summary are also exported as text to output_file and summary_file
+    
     calculate mean and standard deviation of the ratio
     calculate z-score for each row
     calculate stouffer's z-score ?or mean z-score? for probes with same ID
     print probes with (mean) z-score >= 2.5
     """
-    FLAG_BAD = -100
-    logger.info('%s => %s', input_file, output_file)
-    gpr = GPR(input_file)
-    # print debug information for a gpr file
-    # gpr.print_summary()
+    setting = (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log)
+    sweep_gpr_file(input_file, [ setting ], control_dict, cache, text=text)
+
+def sweep_gpr_file(input_file, settings, control_dict=None, cache=None, file_mask=None, text=True, \
+                   profiler=NO_PROFILE, chunk_rows=None, ratio_mode='simple', sha1=None):
+    """
+    parse input_file once and write results for each setting
+    each setting is a tuple
+    (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log)
+    file_mask is a SpotMask from get_file_mask(control_dict), made here if not given;
+    masks that do not depend on the setting are computed once
+    profiler records the whole file and each of its stages
+    if chunk_rows is given, the file is read in blocks of chunk_rows rows by stream_gpr_file
+    ratio_mode is simple for fg / bg or regression for fg over the fg fitted from bg;
+    the regression fits of every setting are solved together by fit_foreground
+    sha1, if given, is the content hash of input_file already computed for the manifest, used for the cache key
+    """
+    assert(ratio_mode in RATIO_MODES), 'unknown ratio mode %s' % ratio_mode
+    if chunk_rows is not None:
+        assert(ratio_mode == 'simple'), 'the %s ratio needs the whole file, and is not available when streaming' % ratio_mode
+        return stream_gpr_file(input_file, settings, control_dict, file_mask, text, chunk_rows, profiler)
+    with profiler.stage('file', file=input_file):
+        if file_mask is None:
+            file_mask = get_file_mask(control_dict)
+        # only decode the columns used by some setting
+        columns_used = ['Flags', 'ID', 'Name'] + file_mask.get_columns()
+        for (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) in settings:
+            columns_used += get_signal_mask(signal_fg, signal_bg, norm_fg, norm_bg, do_norm).get_columns()
+        columns_used = [ c for (i, c) in enumerate(columns_used) if c not in columns_used[:i] ]
+        with profiler.stage('parse', file=input_file):
+            gpr = GPR(input_file, columns=columns_used, cache=cache, sha1=sha1)
+        # print debug information for a gpr file
+        # qc.print_summary(qc.get_summary(gpr, input_file))
+
+        # add an index for the original row number
+        n_row_orig = gpr.n_row
+        logger.info('n_row_orig %d', n_row_orig)
+        row_number_orig = np.array(range(1, n_row_orig + 1))
+        
+        gpr.add_columns( ('row_number_orig', row_number_orig))
+
+        # identify rows with bad flags, controls, and bad signal, and delete them
+        with profiler.stage('mask', file=input_file):
+            (mask_file, counts_file) = file_mask.evaluate(gpr)
+        
+        masks = [ ]
+        for (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) in settings:
+            logger.info('%s => %s', input_file, output_file)
+            with profiler.stage('mask', file=input_file, results_dir=os.path.dirname(summary_file)):
+                signal_mask = get_signal_mask(signal_fg, signal_bg, norm_fg, norm_bg, do_norm)
+                (mask_signal, counts_signal) = signal_mask.evaluate(gpr)
+                mask = mask_file | mask_signal
+            log_counts(counts_file + counts_signal, mask.sum(), n_row_orig)
+            masks.append(mask)
+        
+        fg_fits = [ (None, None) for s in settings ]
+        if ratio_mode == 'regression':
+            with profiler.stage('fit', file=input_file):
+                fg_fits = get_fg_fits(gpr, settings, masks)
+        
+        for (setting, mask, (fg_fit, n_fg_fit)) in zip(settings, masks, fg_fits):
+            (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) = setting
+            score_gpr(gpr.copy(), mask, output_file, summary_file, \
+                      signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log, text, profiler, input_file, \
+                      fg_fit, n_fg_fit)
+
+def get_fg_fits(gpr, settings, masks):
+    """
+    regression fits of the foreground on the background of the unmasked rows, for the signal
+    and, with do_norm, the norm channel of each setting, all solved in one batch
+    return a (fg_fit, n_fg_fit) pair for each setting, n_fg_fit None without do_norm,
+    with the fitted fg of each row that is kept
+    rows with a fitted fg or norm fg that is not positive are added to the masks, as for get_fit_mask
+    """
+    bg_list = [ ]
+    fg_list = [ ]
+    for ((output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log), mask) in zip(settings, masks):
+        channels = [ (signal_fg, signal_bg) ] + ([ (norm_fg, norm_bg) ] if do_norm else [ ])
+        for (fg, bg) in [ gpr.get_columns(c) for c in channels ]:
+            fg_list.append(np.asarray(fg)[~mask])
+            bg_list.append(np.asarray(bg)[~mask])
+    fits = fit_foreground(bg_list, fg_list)
+    fg_fits = [ ]
+    for ((output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log), mask) in zip(settings, masks):
+        fg_fit = fits.pop(0)
+        n_fg_fit = fits.pop(0) if do_norm else None
+        fit_mask = get_fit_mask(fg_fit, n_fg_fit)
+        if fit_mask.any():
+            logger.info('%s: masked %d spots with a fitted fg that is not positive', output_file, fit_mask.sum())
+            mask[np.flatnonzero(~mask)[fit_mask]] = True
+            fg_fit = fg_fit[~fit_mask]
+            n_fg_fit = n_fg_fit[~fit_mask] if do_norm else None
+        fg_fits.append( (fg_fit, n_fg_fit) )
+    return fg_fits
 
+def score_gpr(gpr, mask, output_file, summary_file, \
+              signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log, text=True, \
+              profiler=NO_PROFILE, input_file=None, fg_fit=None, n_fg_fit=None):
+    """
+    delete the masked rows of gpr, which already has a row_number_orig column
+    calculate ratios and z-scores, with the regression ratio if the fitted fg_fit
+    and n_fg_fit of the rows that are kept are given
+    save the summary for each good id as a binary data frame, read by deconv_pools
+    if text is True, also write the top rows to output_file and the summary to summary_file
+    profiler records the delete, score, group and write stages for input_file
+    """
+    context = { 'file': input_file, 'results_dir': os.path.dirname(summary_file) }
     # keep track of which columns we've added
-    columns_added = [ ]
+    columns_added = [ 'row_number_orig' ]
 
-    # start by extracting the flags and adding an index for the original row number
-    (flags, ids, names, fg, bg) = gpr.get_columns(['Flags', 'ID', 'Name', signal_fg, signal_bg])
-    if do_norm:
-        (n_fg, n_bg) = gpr.get_columns([norm_fg, norm_bg])
-    n_row_orig = len(flags)
-    logger.info('n_row_orig %d', n_row_orig)
-    row_number_orig = np.array(range(1, n_row_orig + 1))
-    
-    gpr.add_columns( ('row_number_orig', row_number_orig))
-    columns_added += ['row_number_orig']
+    with profiler.stage('delete', **context):
+        logger.info('deleting %d control rows', sum(mask))
+        gpr.delete_rows(mask)
 
-    # identify rows with bad flags and delete them
-    # follow the semantics of a numpy masked array: delete where mask is True
-    
-    # controls from a dictionary
-    mask_control = [ False for x in ids ]
-    if (control_dict is not None):
-        control_ids = dict()
-        # for controls, just worry about ID, not name
-        for (i, n) in control_dict.keys():
-            control_ids[i] = True
-        mask_control = [ i in control_ids for i in ids ]
+
+    with profiler.stage('score', **context):
+        # re-extract just the good columns
+        columns_extracted = [ 'Name', 'ID', signal_fg, signal_bg ]
+        (name, id, fg, bg) = gpr.get_columns(columns_extracted)
+        n_fg = None
+        n_bg = None
+        if do_norm:
+            columns_norm = [norm_fg, norm_bg]
+            columns_extracted = columns_extracted + columns_norm
+            (n_fg, n_bg) = gpr.get_columns(columns_norm)
+        n_row = len(name)
+        assert(sum(bg == 0) == 0), 'bg has %d zero values' % sum(bg==0)
         
-    # user interface permits manual flagging of bad data, usually -100
-    mask_flag = flags <= FLAG_BAD
-    
-    # some text values are clearly controls
-    mask_text = [ id == 'CONTROL' for id in ids ]
-    
-    # bad signal
-    mask_signal = [ (x[0] <= 0) or (x[1] <= 0) for x in zip(fg, bg) ]
-    
-    mask_norm = [ False for x in fg ]
-    if do_norm:
-        mask_norm = [ (x[0] <= 0) or (x[1] <= 0) for x in zip(n_fg, n_bg) ]
-    
-    mask = [ x[0] or x[1] or x[2] or x[3] or x[4] for x in zip(mask_control, mask_flag, mask_text, mask_signal, mask_norm) ]
-    logger.info('deleting %d control rows', sum(mask))
-    gpr.delete_rows(mask)
+        # create a new index, idname, combining id with name
+        # this avoids having one id map to multiple names, which could reflect a difference in probes, etc.
+        # idname is categorical, joined once for each distinct (id, name) code pair
+        (idname, idname_id, idname_name) = join_pairs(id, name)
+        idname_to_id = dict(zip(idname.categories, idname_id))
+        idname_to_name = dict(zip(idname.categories, idname_name))
+        
+        gpr.add_columns( ('idname', idname))
+        columns_added += ['idname']
+        
+        (ratio, zscore) = get_ratio_zscore(fg, bg, n_fg, n_bg, do_norm, do_log, fg_fit, n_fg_fit)
 
+    with profiler.stage('group', **context):
+        groups = GroupBy(idname)
+        (id_to_mean_zscore, row_to_mean_zscore, _) = apply_by_group(np.mean, idname, zscore, groups)
+        (id_to_mean_ratio, row_to_mean_ratio, _) = apply_by_group(np.mean, idname, ratio, groups)
 
-    # re-extract just the good columns
-    columns_extracted = [ 'Name', 'ID', signal_fg, signal_bg ]
-    (name, id, fg, bg) = gpr.get_columns(columns_extracted)
-    n_fg = None
-    n_bg = None
-    if do_norm:
-        columns_norm = [norm_fg, norm_bg]
-        columns_extracted = columns_extracted + columns_norm
-        (n_fg, n_bg) = gpr.get_columns(columns_norm)
-    n_row = len(name)
-    assert(sum(bg == 0) == 0), 'bg has %d zero values' % sum(bg==0)
-    
-    # create a new index, idname, combining id with name
-    # this avoids having one id map to multiple names, which could reflect a difference in probes, etc.
-    idname = [ '_'.join([i,n]) for (i, n) in zip(id, name) ]
-    idname_to_id = dict()
-    idname_to_name = dict()
-    for (idn, i, n) in zip(idname, id, name):
-        idname_to_id[idn] = i
-        idname_to_name[idn] = n
-    
-    gpr.add_columns( ('idname', idname))
-    columns_added += ['idname']
-    
-    (ratio, zscore) = get_ratio_zscore(fg, bg, n_fg, n_bg, do_norm, do_log)    
-    (id_to_mean_zscore, row_to_mean_zscore, id_to_zscores) = apply_by_group(np.mean, idname, zscore)
-    (id_to_mean_ratio, row_to_mean_ratio, id_to_ratios) = apply_by_group(np.mean, idname, ratio)
-
-    gpr.add_columns(('ratio', ratio),
-        ('zscore', zscore),
-        ('zscore_mean', row_to_mean_zscore))
-    columns_added += ['ratio', 'zscore', 'zscore_mean' ]
-    
-    # collect rows where flag is good and either zscore is above a threshold
-    (id_subset, row_subset) = get_good_ids_rows(idname, zscore)
-    
-    columns_display = columns_extracted + columns_added
-    gpr.write(output_file, rows=row_subset, columns=columns_display)
+        gpr.add_columns(('ratio', ratio),
+            ('zscore', zscore),
+            ('zscore_mean', row_to_mean_zscore))
+        columns_added += ['ratio', 'zscore', 'zscore_mean' ]
+        
+        # collect rows where flag is good and either zscore is above a threshold
+        (id_subset, row_subset) = get_good_ids_rows(idname, zscore)
     
+    with profiler.stage('write', **context):
+        columns_display = columns_extracted + columns_added
+        if text:
+            gpr.write(output_file, rows=row_subset, columns=columns_display)
+        
+        write_id_data(summary_file, id_subset, idname_to_id, idname_to_name, \
+                      id_to_mean_zscore, id_to_mean_ratio, groups, zscore, ratio, text)
+
+def write_id_data(summary_file, id_subset, idname_to_id, idname_to_name, \
+                  id_to_mean_zscore, id_to_mean_ratio, groups, zscore, ratio, text=True):
+    """
+    save the summary for each good idname in id_subset as a binary data frame next to summary_file,
+    and if text is True also write it to summary_file
+    groups is the GroupBy of the idname of each row of zscore and ratio;
+    only the replicates of the groups in id_subset are split out
+    """
     # gather data for each good id:
     # id, name, zscore_mean, zscores
     id_list = [ idname_to_id[i] for i in id_subset ]
     name_list = [ idname_to_name[i] for i in id_subset ]
     zscore_list = [ id_to_mean_zscore[i] for i in id_subset ]
     ratio_list = [ id_to_mean_ratio[i] for i in id_subset ]
-    zscores_list = [ ';'.join([ str(x) for x in id_to_zscores[i] ]) for i in id_subset]
-    ratios_list = [ ';'.join([ str(x) for x in id_to_ratios[i] ]) for i in id_subset]
+    subset_groups = groups.lookup(id_subset)
+    zscores_list = [ ';'.join([ str(x) for x in z ]) for z in groups.split(zscore, subset_groups) ]
+    ratios_list = [ ';'.join([ str(x) for x in r ]) for r in groups.split(ratio, subset_groups) ]
     id_data = DataFrame( data=[('IDName', id_subset),
         ('ID', id_list), ('Name', name_list),
         ('zscore', zscore_list), ('ratio', ratio_list),
         ('zscores', zscores_list), ('ratios', ratios_list)] )
-    id_data.write(summary_file)
+    id_data.save(get_binary_name(summary_file))
+    if text:
+        id_data.write(summary_file)
+
+class RunningStats:
+    """
+    count, mean and sum of squared deviations of values seen a block at a time,
+    merging the mean and deviations of each block (Welford, Chan et al.)
+    so that the standard deviation of a whole file is found without keeping its values
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        n_block = len(values)
+        if n_block == 0:
+            return
+        mean_block = values.mean()
+        dev = values - mean_block
+        m2_block = np.dot(dev, dev)
+        n = self.n + n_block
+        delta = mean_block - self.mean
+        self.mean = self.mean + delta * n_block / n
+        self.m2 = self.m2 + m2_block + delta * delta * self.n * n_block / n
+        self.n = n
+
+    def std(self, ddof=1):
+        return np.sqrt(self.m2 / (self.n - ddof))
+
+def get_chunk_rows(chunk, keep, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log):
+    """
+    the rows of a GPRChunk where keep is True, for one setting
+    return (columns, data, idname, ratio): the display columns as in score_gpr and their values, the categorical idnames,
+    and the ratios before the z-score, which needs the mean and standard deviation of the whole file
+    """
+    columns = [ 'Name', 'ID', signal_fg, signal_bg ]
+    if do_norm:
+        columns += [ norm_fg, norm_bg ]
+    data = [ x[keep] if isinstance(x, Categorical) else np.asarray(x)[keep] for x in chunk.get_columns(columns) ]
+    (name, id, fg, bg) = data[:4]
+    (n_fg, n_bg) = data[4:] if do_norm else (None, None)
+    assert((bg == 0).sum() == 0), 'bg has %d zero values' % (bg == 0).sum()
+    idname = join_pairs(id, name)[0]
+    # the chunks have different categories, so the rows kept across chunks are strings
+    data = [ np.asarray(x) for x in data ]
+    ratio = get_ratio(fg, bg, n_fg, n_bg, do_norm, do_log)
+    row_number_orig = chunk.first_row + np.flatnonzero(keep) + 1
+    return(columns + [ 'row_number_orig' ], data + [ row_number_orig ], idname, ratio)
+
+def stream_gpr_file(input_file, settings, control_dict=None, file_mask=None, text=True, \
+                    chunk_rows=CHUNK_ROWS, profiler=NO_PROFILE, z_threshold=2.5):
+    """
+    the same results as sweep_gpr_file, reading input_file a block of chunk_rows rows at a time
+    so that memory is bounded by the block size and the number of idnames rather than the file size
+    the first pass masks each block and accumulates the running mean and variance of the ratio,
+    and the largest ratio of each idname, which decides before the second pass which idnames
+    have a row with zscore at least z_threshold, as for get_good_ids_rows
+    the second pass computes z-scores and keeps only those top rows and every row of their idnames
+    the mean and standard deviation are merged block by block, so z-scores agree with
+    sweep_gpr_file to rounding; the parse cache is not used
+    """
+    with profiler.stage('file', file=input_file):
+        if file_mask is None:
+            file_mask = get_file_mask(control_dict)
+        signal_masks = [ get_signal_mask(signal_fg, signal_bg, norm_fg, norm_bg, do_norm) \
+                         for (output_file, summary_file, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) in settings ]
+        columns_used = ['Flags', 'ID', 'Name'] + file_mask.get_columns()
+        for signal_mask in signal_masks:
+            columns_used += signal_mask.get_columns()
+        columns_used = [ c for (i, c) in enumerate(columns_used) if c not in columns_used[:i] ]
+        
+        def get_kept_rows(chunk):
+            """ for each setting, the rows of chunk that are not masked, and the mask counts """
+            (mask_file, counts_file) = file_mask.evaluate(chunk)
+            for (setting, signal_mask) in zip(settings, signal_masks):
+                (mask_signal, counts_signal) = signal_mask.evaluate(chunk)
+                mask = mask_file | mask_signal
+                yield(get_chunk_rows(chunk, ~mask, *setting[2:]), counts_file + counts_signal, mask.sum())
+        
+        # first pass: running statistics of the ratio, and the largest ratio of each idname
+        stats = [ RunningStats() for s in settings ]
+        max_ratio = [ dict() for s in settings ]
+        counts = [ [ ] for s in settings ]
+        n_mask = [ 0 for s in settings ]
+        n_row_orig = 0
+        with profiler.stage('stats', file=input_file):
+            for chunk in read_chunks(input_file, columns_used, chunk_rows):
+                n_row_orig += chunk.n_row
+                for (k, ((columns, data, idname, ratio), chunk_counts, chunk_mask)) in enumerate(get_kept_rows(chunk)):
+                    stats[k].add(ratio)
+                    if len(idname) > 0:
+                        groups = GroupBy(idname)
+                        for (idn, r) in zip(groups.keys, groups.max(ratio)):
+                            if (idn not in max_ratio[k]) or (r > max_ratio[k][idn]) or np.isnan(r):
+                                max_ratio[k][idn] = r
+                    counts[k] = chunk_counts if len(counts[k]) == 0 else \
+                                [ (name, c + d) for ((name, c), (other, d)) in zip(counts[k], chunk_counts) ]
+                    n_mask[k] += chunk_mask
+        logger.info('n_row_orig %d', n_row_orig)
+        
+        # idnames with a z-score above the threshold on some row; nan is not below it
+        mean_stdev = [ (s.mean, s.std(ddof=1)) for s in stats ]
+        hit_idnames = [ ]
+        for (k, setting) in enumerate(settings):
+            (mean, stdev) = mean_stdev[k]
+            log_counts(counts[k], n_mask[k], n_row_orig)
+            logger.info('%s => %s: %d rows, ratio mean %f stdev %f', input_file, setting[0], stats[k].n, mean, stdev)
+            keys = sorted(max_ratio[k].keys())
+            max_zscore = (np.array([ max_ratio[k][idn] for idn in keys ], dtype=float) - mean) / stdev
+            hit_idnames.append(np.array([ idn for (idn, z) in zip(keys, max_zscore) if not (z < z_threshold) ], dtype=str))
+        max_ratio = None
+        
+        # second pass: z-scores, keeping the top rows and every row of a hit idname
+        top_rows = [ [ ] for s in settings ]
+        hit_rows = [ [ ] for s in settings ]
+        with profiler.stage('score', file=input_file):
+            for chunk in read_chunks(input_file, columns_used, chunk_rows):
+                for (k, ((columns, data, idname, ratio), chunk_counts, chunk_mask)) in enumerate(get_kept_rows(chunk)):
+                    (mean, stdev) = mean_stdev[k]
+                    zscore = (ratio - mean)/stdev
+                    idname = np.array(idname, dtype=str)
+                    data = data + [ idname, ratio, zscore ]
+                    with np.errstate(invalid='ignore'):
+                        is_top = ~(zscore < z_threshold)
+                    top_rows[k].append([ x[is_top] for x in data ])
+                    is_hit = np.in1d(idname, hit_idnames[k])
+                    hit_rows[k].append([ x[is_hit] for x in data ])
+        
+        for (k, setting) in enumerate(settings):
+            (output_file, summary_file) = setting[:2]
+            with profiler.stage('write', file=input_file, results_dir=os.path.dirname(summary_file)):
+                columns_display = [ 'Name', 'ID' ] + list(setting[2:6 if setting[6] else 4]) + \
+                                  [ 'row_number_orig', 'idname', 'ratio', 'zscore' ]
+                top = [ np.concatenate(x) for x in zip(*top_rows[k]) ]
+                hit = [ np.concatenate(x) for x in zip(*hit_rows[k]) ]
+                (name, id, idname, ratio, zscore) = [ hit[columns_display.index(c)] for c in [ 'Name', 'ID', 'idname', 'ratio', 'zscore' ] ]
+                idname = list(idname)
+                idname_to_id = dict(zip(idname, id))
+                idname_to_name = dict(zip(idname, name))
+                groups = GroupBy(idname)
+                (id_to_mean_zscore, row_to_mean_zscore, _) = apply_by_group(np.mean, idname, zscore, groups)
+                (id_to_mean_ratio, row_to_mean_ratio, _) = apply_by_group(np.mean, idname, ratio, groups)
+                
+                top_idname = list(top[columns_display.index('idname')])
+                (id_subset, row_subset) = get_good_ids_rows(top_idname, top[columns_display.index('zscore')], z_threshold)
+                if text:
+                    zscore_mean = np.array([ id_to_mean_zscore[i] for i in top_idname ], dtype=float)
+                    top_data = dict(zip(columns_display, top))
+                    top_data['idname'] = np.array(top_idname)
+                    top_data['zscore_mean'] = zscore_mean
+                    columns_display += [ 'zscore_mean' ]
+                    write_table(output_file, columns_display, [ top_data[c] for c in columns_display ])
+                write_id_data(summary_file, id_subset, idname_to_id, idname_to_name, \
+                              id_to_mean_zscore, id_to_mean_ratio, groups, zscore, ratio, text)
         
 
 
-def process_gpr_dir(data_dir, results_dir, signal_fg, signal_bg, \
-                    norm_fg, norm_bg, do_norm, do_log, \
-                    control_dict):
-    """ process each gpr file in the data_dir, writing results to results_dir """
+class BufferHandler(logging.Handler):
+    """ keep log records in memory so that a worker process can return them with its result """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = [ ]
+        
+    def emit(self, record):
+        # format the message now so that the record can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.msg = record.msg + '\n' + ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        self.records.append(record)
+
+# state of a worker process, set once per worker by init_worker
+worker_state = dict()
+
+def init_worker(control_dict, cache):
+    """
+    pool initializer: the control dictionary is sent to each worker once, not with every file
+    log records are buffered and sent back with each result, so that the parent can print
+    them in file order
+    """
+    worker_state['control_dict'] = control_dict
+    worker_state['file_mask'] = get_file_mask(control_dict)
+    worker_state['cache'] = cache
+    worker_state['handler'] = BufferHandler()
+    # ctrl-c goes to the whole process group; let the parent decide how to shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(worker_state['handler'])
+
+def process_gpr_task(task):
+    """
+    worker function for one gpr file
+    task is (input_file, settings, text, sha1, profile, chunk_rows, ratio_mode) with the others as for sweep_gpr_file
+    return (input_file, traceback string or None, log records, profile records)
+    """
+    handler = worker_state['handler']
+    handler.records = [ ]
+    error = None
+    (input_file, settings, text, sha1, profile, chunk_rows, ratio_mode) = task
+    profiler = StageProfiler(profile)
+    try:
+        sweep_gpr_file(input_file, settings, worker_state['control_dict'], worker_state['cache'], \
+                       worker_state['file_mask'], text, profiler, chunk_rows, ratio_mode, sha1)
+    except Exception:
+        error = traceback.format_exc()
+    return(input_file, error, handler.records, profiler.records)
+
+def make_pool(jobs, control_dict, cache=None):
+    """ pool of worker processes for run_gpr_tasks, with the controls and cache already loaded """
+    return multiprocessing.Pool(processes=jobs, initializer=init_worker, initargs=(control_dict, cache))
+
+def run_gpr_tasks(tasks, control_dict, cache=None, jobs=1, done_fn=None, pool=None, profiler=NO_PROFILE, \
+                  chunk_rows=None, ratio_mode='simple'):
+    """
+    run sweep_gpr_file for each (input_file, settings, text, sha1) task, sha1 None if the file has not been hashed
+    if jobs > 1, files are processed by a pool of worker processes,
+    a file that fails is logged and the others continue
+    pool, if given, is a pool from make_pool that stays open after the tasks are done
+    done_fn(input_file), if given, is called after each file that succeeds
+    profiler collects the stage records of every file, including those from worker processes
+    chunk_rows, if given, streams each file in blocks of that many rows
+    ratio_mode is as for sweep_gpr_file
+    return a list of (input_file, error) for files that failed
+    """
+    failures = [ ]
+    if (jobs <= 1) and (pool is None):
+        file_mask = get_file_mask(control_dict)
+        for (input_file, settings, text, sha1) in tasks:
+            sweep_gpr_file(input_file, settings, control_dict, cache, file_mask, text, profiler, chunk_rows, ratio_mode, sha1)
+            if done_fn is not None:
+                done_fn(input_file)
+        return failures
+    
+    own_pool = pool is None
+    if own_pool:
+        logger.info('processing %d files with %d jobs', len(tasks), jobs)
+        pool = make_pool(jobs, control_dict, cache)
+    try:
+        # imap returns results in file order, so each file's log stays together
+        worker_tasks = [ task + (profiler.enabled, chunk_rows, ratio_mode) for task in tasks ]
+        for (input_file, error, records, profile_records) in pool.imap(process_gpr_task, worker_tasks):
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            profiler.records += profile_records
+            if error is not None:
+                logger.error('%s failed:\n%s', input_file, error)
+                failures.append( (input_file, error) )
+            elif done_fn is not None:
+                done_fn(input_file)
+        if own_pool:
+            pool.close()
+    except:
+        if own_pool:
+            pool.terminate()
+        raise
+    finally:
+        if own_pool:
+            pool.join()
+    if len(failures) > 0:
+        logger.error('%d of %d files failed', len(failures), len(tasks))
+    return failures
+
+def get_sweep_tasks(data_dir, sweep, manifests=None, text=True):
+    """
+    tasks for run_gpr_tasks that process each gpr file in data_dir once for all the settings in sweep
+    if manifests is given, settings where the file is up to date are skipped
+    return (tasks, file_to_entries, names): file_to_entries has, for each input file,
+    the (setting index, file name, sha1, outputs) manifest entries to set once it succeeds,
+    and names are the gpr file names in data_dir
+    a file is hashed once, for the manifest, and the hash is passed on in its task for the cache key
+    """
     file_list = sorted(os.listdir(data_dir))
+    tasks = [ ]
+    file_to_entries = dict()
+    names = [ ]
     for file_name in file_list:
-        (base, ext) = os.path.splitext(file_name)
-        if (ext == '.gpr') or (ext == '.GPR'):
+        (base, ext) = split_gpr_name(file_name)
+        if ext in GPR_EXTENSIONS:
             logger.info('dir %s file %s base %s ext %s', data_dir, file_name, base, ext)
             input_file = os.path.join(data_dir, file_name)
-            output_file = os.path.join(results_dir, base + '-top.txt')
-            summary_file = os.path.join(results_dir, base + '-summary.txt')
-            logger.info('input %s output %s summary %s', input_file, output_file, summary_file)
-            process_gpr_file(input_file, output_file, summary_file, signal_fg, signal_bg, \
-                             norm_fg, norm_bg, do_norm, do_log,
-                             control_dict)
+            names.append(file_name)
+            sha1 = None
+            if manifests is not None:
+                sha1 = get_sha1(input_file)
+            settings = [ ]
+            file_to_entries[input_file] = [ ]
+            for (i, (results_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log)) in enumerate(sweep):
+                output_file = os.path.join(results_dir, base + '-top.txt')
+                summary_file = os.path.join(results_dir, base + '-summary.txt')
+                outputs = [ get_binary_name(summary_file) ]
+                if text:
+                    outputs += [ output_file, summary_file ]
+                if (manifests is not None) and manifests[i].is_current(file_name, sha1, outputs):
+                    logger.info('%s is up to date in %s', file_name, results_dir)
+                    continue
+                logger.info('input %s output %s summary %s', input_file, output_file, summary_file)
+                settings.append( (output_file, summary_file, signal_fg, signal_bg, \
+                                  norm_fg, norm_bg, do_norm, do_log) )
+                file_to_entries[input_file].append( (i, file_name, sha1, outputs) )
+            if len(settings) > 0:
+                tasks.append( (input_file, settings, text, sha1) )
+    return(tasks, file_to_entries, names)
 
-POOL_DIRECTIONS = ['H', 'V']
-POOL_RANGE = range(1, 13)
+def sweep_gpr_dir(data_dir, sweep, control_dict, cache=None, jobs=1, manifests=None, pool=None, text=True, \
+                  profiler=NO_PROFILE, chunk_rows=None, ratio_mode='simple'):
+    """
+    process each gpr file in the data_dir once for all the settings in sweep
+    each element of sweep is a tuple
+    (results_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log)
+    if manifests is given, it has a RunManifest for each setting;
+    settings where the file is up to date are skipped, and the manifests are updated and written
+    if text is False, the -top.txt and -summary.txt exports are not written
+    profiler records the stages of each file
+    chunk_rows, if given, streams each file in blocks of that many rows
+    ratio_mode is as for sweep_gpr_file
+    return a list of (input_file, error) for files that failed
+    """
+    (tasks, file_to_entries, names) = get_sweep_tasks(data_dir, sweep, manifests, text)
+    if manifests is None:
+        return run_gpr_tasks(tasks, control_dict, cache, jobs, pool=pool, profiler=profiler, chunk_rows=chunk_rows, \
+                             ratio_mode=ratio_mode)
+    
+    def done_fn(input_file):
+        for (i, file_name, sha1, outputs) in file_to_entries[input_file]:
+            manifests[i].set_file(file_name, sha1, outputs)
+    try:
+        failures = run_gpr_tasks(tasks, control_dict, cache, jobs, done_fn, pool, profiler, chunk_rows, ratio_mode)
+    finally:
+        # record the files that finished, even if a serial run stopped on an error
+        for manifest in manifests:
+            manifest.keep_files(names)
+            manifest.write()
+    return failures
 
-def create_map_file(data_dir, map_filename):
+def process_gpr_dir(data_dir, results_dir, signal_fg, signal_bg, \
+                    norm_fg, norm_bg, do_norm, do_log, \
+                    control_dict, cache=None, jobs=1):
+    """
+    process each gpr file in the data_dir, writing results to results_dir
+    if jobs > 1, files are processed by a pool of worker processes
+    return a list of (input_file, error) for files that failed
+    """
+    sweep = [ (results_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) ]
+    return sweep_gpr_dir(data_dir, sweep, control_dict, cache, jobs)
+
+# the standard design is 12 horizontal and 12 vertical pools, H1..H12 and V1..V12
+STANDARD_DESIGN = grid_design(12)
+
+def create_map_file(data_dir, map_filename, design=STANDARD_DESIGN):
     file_list = sorted(os.listdir(data_dir))
     pool_list = [ ]
     base_list = [ ]
     for file_name in file_list:
-        (base, ext) = os.path.splitext(file_name)
-        if (ext == '.gpr') or (ext == '.GPR'):
+        (base, ext) = split_gpr_name(file_name)
+        if ext in GPR_EXTENSIONS:
             logger.info('dir %s file %s base %s ext %s', data_dir, file_name, base, ext)
             toks = re.split('_|-', base) # split on underscore or dash
             
@@ -335,10 +747,10 @@ def create_map_file(data_dir, map_filename):
             toks.reverse()
             pool_str = ''
             for tok in toks:
-                if is_valid_pool_name(tok):
-                    pool_str = tok
+                if design.is_valid_pool_name(tok):
+                    pool_str = design.get_pool_name(tok)
                     break
-            if not is_valid_pool_name(pool_str):
+            if not design.is_valid_pool_name(pool_str):
                 logger.warn('%s has no valid pool name, skipping %s', ext, file_name)
                 continue
             if pool_str in pool_list:
@@ -356,175 +768,307 @@ def is_int(str_val):
     except ValueError:
         return False
 
-def is_valid_pool_name(p):
-    ret = True
-    if len(p) < 2:
-        return False
-    direction = p[0]
-    number_str = p[1:]
-    if direction not in ['H', 'V']:
-        return False
-    if not is_int(number_str):
-        return False
-    else:
-        number_val = int(number_str)
-        if number_val not in POOL_RANGE:
-            return False
-    return True
+def is_valid_pool_name(p, design=STANDARD_DESIGN):
+    return design.is_valid_pool_name(p)
     
 def is_available(f):
-    ret = os.path.isfile(f)
+    ret = os.path.exists(f)
     return(ret)
 
-def validate_pools(pool_to_file):
-    """ check that pool names are valid and that all the summary files exist """
+def validate_pools(pool_to_file, design=STANDARD_DESIGN):
+    """ check that pool names are valid for the design and that all the summary files exist """
     for (p, f) in zip(pool_to_file.data['pool'], pool_to_file.data['full_path']):
-        assert(is_valid_pool_name(p)), 'bad pool name: %s' % p
+        assert(design.is_valid_pool_name(p)), 'bad pool name for design %s: %s' % (design.name, p)
         assert(is_available(f)), 'results unavailable: %s' % f
         logger.info('pool %s file %s validated', p, f)
     return True
 
 def write_pool_hit(pool_to_file, pool_hit):
-    pool_list = [ ]
-    file_list = [ ]
-    id_list = [ ]
-    zscore_list = [ ]
-    ratio_list = [ ]
-    for (p, f) in zip(pool_to_file.data['pool'], pool_to_file.data['file']):
-        # some pools have no hits
-        if p not in pool_hit:
-            continue
-        for h in pool_hit[p]:
-            pool_list.append(p)
-            file_list.append(f)
-            id_list.append(h)
-            zscore_list.append(pool_hit[p][h]['zscore'])
-            ratio_list.append(pool_hit[p][h]['ratio'])
-    df = DataFrame( data=[('pool', pool_list), ('file', file_list), ('id', id_list), ('zscore', zscore_list), ('ratio', ratio_list)] )
+    """ write each hit of pool_hit, a PoolHit, with its pool and file, in the order of pool_to_file """
+    (pools, files) = [ np.asarray(pool_to_file.data[c]) for c in ('pool', 'file') ]
+    df = DataFrame( data=[('pool', pools[pool_hit.pool_index]), ('file', files[pool_hit.pool_index]), ('id', pool_hit.ids), \
+                          ('zscore', pool_hit.zscore), ('ratio', pool_hit.ratio)] )
     df.write('pool_hit.txt')
 
 def get_pool_hit(pool_to_file):
-    pool_hit = dict()
-    for (p, f) in zip(pool_to_file.data['pool'], pool_to_file.data['full_path']):
+    """
+    the hits of every pool as a PoolHit: the IDName, zscore and ratio columns of each summary file,
+    concatenated with the index of the file's row in pool_to_file
+    """
+    pools = [ str(p) for p in pool_to_file.data['pool'] ]
+    columns = [ [ ], [ ], [ ], [ ] ]
+    for (k, f) in enumerate(pool_to_file.data['full_path']):
         pool_data = DataFrame(filename=f)
-        for (idname, zscore, ratio) in zip(pool_data.data['IDName'], pool_data.data['zscore'], pool_data.data['ratio']):
-            if p not in pool_hit:
-                pool_hit[p] = dict()
-            assert(idname not in pool_hit[p]), 'pool %s file %f duplicated id %s' % (p, f, idname)
-            pool_hit[p][idname] = dict()
-            pool_hit[p][idname]['zscore'] = zscore
-            pool_hit[p][idname]['ratio'] = ratio
-    return pool_hit
+        (idname, zscore, ratio) = pool_data.get_columns('IDName', 'zscore', 'ratio')
+        for (c, x) in zip(columns, [ np.repeat(k, len(idname)), np.asarray(idname).astype(str), zscore, ratio ]):
+            c.append(np.asarray(x))
+    if len(pools) == 0:
+        return PoolHit(pools, [ ], np.array([ ], dtype=str), [ ], [ ])
+    (pool_index, ids, zscore, ratio) = [ np.concatenate(c) for c in columns ]
+    # an id may be a hit only once in each pool, counting every file of the pool
+    (pool_names, pool_code) = np.unique(pools, return_inverse=True)
+    (id_names, id_code) = np.unique(ids, return_inverse=True)
+    key = pool_code[pool_index].astype(np.int64) * max(len(id_names), 1) + id_code
+    order = np.argsort(key, kind='mergesort')
+    dup = np.flatnonzero(key[order][1:] == key[order][:-1])
+    if len(dup) > 0:
+        r = order[dup[0] + 1]
+        assert(False), 'pool %s file %s duplicated id %s' % (pools[pool_index[r]], pool_to_file.data['full_path'][pool_index[r]], ids[r])
+    return PoolHit(pools, pool_index, ids, zscore, ratio)
 
 def get_intersection_hit(pool_hit, horizontal_pools, vertical_pools):
-    intersection_hit = dict()
-    pair_order = [ ]
-    THRESHOLD = 2.5
-    for h in horizontal_pools:
-        if h not in pool_hit:
-            continue
-        
-        for v in vertical_pools:
-            if v not in pool_hit:
-                continue
-            pair = h + ' x ' + v
-            for id in pool_hit[h].keys():
-                if id not in pool_hit[v].keys():
-                    continue
-                (zscoreh, zscorev) = [pool_hit[x][id]['zscore'] for x in [h, v]]
-                (ratioh, ratiov) = [ pool_hit[x][id]['ratio'] for x in [h, v]]
-                if (zscoreh < THRESHOLD) or (zscorev < THRESHOLD):
-                    continue
-                logger.info('%s %s %f %f', pair, id, zscoreh, zscorev)
-                if pair not in pair_order:
-                    pair_order.append(pair)
-                if pair not in intersection_hit:
-                    intersection_hit[pair] = dict()
-                intersection_hit[pair][id] = dict()
-                ptr = intersection_hit[pair][id]
-                ptr['zscore_H'] = zscoreh
-                ptr['zscore_V'] = zscorev
-                ptr['ratio_H'] = ratioh
-                ptr['ratio_V'] = ratiov
-                        
-    # convert to a data frame
-    pair_list = [ ]
-    id_list = [ ]
-    zscoreh_list = [ ]
-    zscorev_list = [ ]
-    ratioh_list = [ ]
-    ratiov_list = [ ]
-    for pair in pair_order:
-        for id in sorted(intersection_hit[pair].keys()):
-            ptr = intersection_hit[pair][id]
-            (zscoreh, zscorev, ratioh, ratiov) = (ptr['zscore_H'],
-                                                  ptr['zscore_V'],
-                                                  ptr['ratio_H'],
-                                                  ptr['ratio_V'])
-            pair_list.append(pair)
-            id_list.append(id)
-            zscoreh_list.append(zscoreh)
-            zscorev_list.append(zscorev)
-            ratioh_list.append(ratioh)
-            ratiov_list.append(ratiov)
-    intersection_hit_df = DataFrame(data = [ ('pair', pair_list), ('id', id_list),
-        ('zscore_h', zscoreh_list), ('zscore_v', zscorev_list),
-        ('ratio_h', ratioh_list), ('ratio_v', ratiov_list) ])
-    
-    return(intersection_hit, intersection_hit_df)
-                        
-                    
+    """
+    ids that are hits in both a horizontal and a vertical pool, with zscore above THRESHOLD in each
+    this is decoding with a two-way grid design, see PoolDesign.decode
+    """
+    design = PoolDesign([ ('H', horizontal_pools), ('V', vertical_pools) ])
+    return design.decode(pool_hit)
                     
-def deconv_pools(results_dir, pool_to_file):
+def deconv_pools(results_dir, pool_to_file, design=STANDARD_DESIGN, profiler=NO_PROFILE):
     # create full path to file
-    full_path = [ os.path.join(results_dir, str(f) + '-summary.txt') for f in pool_to_file.data['file'] ]
+    full_path = [ os.path.join(results_dir, str(f) + '-summary' + BINARY_EXT) for f in pool_to_file.data['file'] ]
     pool_to_file.add_columns( ('full_path', full_path) )
     
-    # check that pool names are correct and that summary files exist
-    validate_pools(pool_to_file)
+    with profiler.stage('pool_hit', results_dir=results_dir):
+        # check that pool names are correct and that summary files exist
+        validate_pools(pool_to_file, design)
+        
+        # for each pool, get the hits' zscore and ratio
+        pool_hit = get_pool_hit(pool_to_file)
+        write_pool_hit(pool_to_file, pool_hit)
     
-    # for each pool, get the hits' zscore and ratio
-    pool_hit = get_pool_hit(pool_to_file)
-    write_pool_hit(pool_to_file, pool_hit)
+    with profiler.stage('intersect', results_dir=results_dir):
+        (intersection_hit_dict, intersection_hit_df) = design.decode(pool_hit)
     
-    HORIZONTAL = [ 'H' + str(i) for i in range(1, 13) ]
-    VERTICAL = ['V' + str(i) for i in range(1, 13) ]
-    (intersection_hit_dict, intersection_hit_df) = get_intersection_hit(pool_hit, HORIZONTAL, VERTICAL)
-    filename = os.path.join(results_dir, 'intersection_hit.txt')
-    intersection_hit_df.write(filename=filename)
+    with profiler.stage('write', results_dir=results_dir):
+        filename = os.path.join(results_dir, 'intersection_hit.txt')
+        intersection_hit_df.write(filename=filename)
+        
+        # and now write a copy to the directory above the results directory
+        (head_path, sub_dir) = os.path.split(results_dir)
+        filename_copy = os.path.join(head_path, 'intersection_hit_' + sub_dir + '.txt')
+        intersection_hit_df.write(filename=filename_copy)
+        # list_to_grid reads the binary copy
+        intersection_hit_df.save(get_binary_name(filename_copy))
+    return [ filename, filename_copy, get_binary_name(filename_copy) ]
+
+def get_sweep(results_dir, channels, norm_values=(False, True), log_values=(False, True)):
+    """
+    settings for every combination of channel and norm/log flags, as used by sweep_gpr_dir
+    channels is a list of (label, signal_fg, signal_bg, norm_fg, norm_bg)
+    the results directory is results_dir + label with _norm and _log suffixes,
+    the same layout as separate runs of deconv.py with --do_norm and --do_log
+    """
+    sweep = [ ]
+    for (label, signal_fg, signal_bg, norm_fg, norm_bg) in channels:
+        for do_norm in norm_values:
+            for do_log in log_values:
+                this_dir = results_dir + label
+                if do_norm:
+                    this_dir = this_dir + '_norm'
+                if do_log:
+                    this_dir = this_dir + '_log'
+                sweep.append( (this_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) )
+    return sweep
+
+def get_sweep_manifests(sweep, control_dict, force=False, ratio_mode='simple'):
+    """
+    make the results directory of each setting in sweep, and return its RunManifest with the params set
+    the ratio mode is a param only when it is not simple, so results from before it existed stay current
+    """
+    control_sha1 = get_control_sha1(control_dict)
+    manifests = [ ]
+    for (results_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log) in sweep:
+        # create the results directory (if needed)
+        if not os.path.exists(results_dir):
+            logger.info('making results directory %s', results_dir)
+            os.makedirs(results_dir)
+        control_dict_filename = os.path.join(results_dir, 'control_dict.txt')
+        print_control_dict(control_dict, control_dict_filename)
+        manifest = RunManifest(results_dir)
+        params = { 'signal_fg': signal_fg, 'signal_bg': signal_bg, 'norm_fg': norm_fg, 'norm_bg': norm_bg,
+                   'do_norm': do_norm, 'do_log': do_log, 'control_sha1': control_sha1 }
+        if ratio_mode != 'simple':
+            params['ratio_mode'] = ratio_mode
+        manifest.set_params(params, force)
+        manifests.append(manifest)
+    return manifests
+
+def deconv_sweep(data_dir, sweep, manifests, failures, create_map=False, map_filename='map_pool_to_file.txt', \
+                 skip_deconv=False, design=STANDARD_DESIGN, profiler=NO_PROFILE):
+    """ pool-to-file map and deconvolution for each setting in sweep, after its gpr files are processed """
+    for ((results_dir, signal_fg, signal_bg, norm_fg, norm_bg, do_norm, do_log), manifest) in zip(sweep, manifests):
+        map_fullpath = os.path.join(results_dir, map_filename)
+        if create_map:
+            create_map_file(data_dir, map_fullpath, design)
+
+        if (not skip_deconv) and (len(failures) > 0):
+            logger.error('skipping the deconvolution because %d gpr files failed', len(failures))
+        elif not skip_deconv:
+            map_dataframe = DataFrame(filename=map_fullpath)
+            summary_files = [ os.path.join(results_dir, str(f) + '-summary' + BINARY_EXT) for f in map_dataframe.data['file'] ]
+            inputs = manifest.get_deconv_inputs([ map_fullpath ] + summary_files)
+            inputs['design'] = design.name
+            if manifest.is_deconv_current(inputs):
+                logger.info('deconvolution is up to date in %s', results_dir)
+                continue
+            outputs = deconv_pools(results_dir, map_dataframe, design, profiler)
+            manifest.set_deconv(inputs, outputs)
+            manifest.write()
+
+def run_sweep(data_dir, sweep, control_dict, cache=None, jobs=1, \
+              skip_gpr=False, create_map=False, map_filename='map_pool_to_file.txt', skip_deconv=False, \
+              force=False, pool=None, text=True, design=STANDARD_DESIGN, profile=False, profile_dump=False, \
+              chunk_rows=None, ratio_mode='simple'):
+    """
+    gpr analysis and deconvolution of data_dir for each setting in sweep
+    each gpr file is parsed and masked once for all the settings
+    each results directory has a manifest, and only gpr files and deconvolutions
+    whose inputs changed are redone, unless force is True
+    pool, if given, is a worker pool from make_pool that is reused rather than created for this run
+    if text is False, gpr results are saved only in the binary format
+    design is the pooling design used to parse pool names and decode the hits
+    if profile is True, the time and memory of each stage are written to PROFILE_FILENAME in each results directory,
+    and if profile_dump is True, the slowest gpr file is rerun under cProfile, see write_profile_dump
+    chunk_rows, if given, streams each gpr file in blocks of that many rows, see stream_gpr_file
+    ratio_mode is simple for fg / bg or regression for a fit of fg on bg, see sweep_gpr_file
+    return a list of (input_file, error) for gpr files that failed
+    """
+    manifests = get_sweep_manifests(sweep, control_dict, force, ratio_mode)
+    profiler = StageProfiler(profile or profile_dump)
     
-    # and now write a copy to the directory above the results directory
-    (head_path, sub_dir) = os.path.split(results_dir)
-    filename = os.path.join(head_path, 'intersection_hit_' + sub_dir + '.txt')
-    intersection_hit_df.write(filename=filename)
+    # for each gpr file in the data directory,
+    #   analyze the file and generate results for each setting
+    failures = [ ]
+    if not skip_gpr:
+        failures = sweep_gpr_dir(data_dir, sweep, control_dict, cache, jobs, manifests, pool, text, profiler, \
+                                 chunk_rows, ratio_mode)
 
-def main(args):
+    deconv_sweep(data_dir, sweep, manifests, failures, create_map, map_filename, skip_deconv, design, profiler)
     
-    # create the results directory (if needed)
-    if not os.path.exists(args.results_dir):
-        logger.info('making results directory %s', args.results_dir)
-        os.makedirs(args.results_dir)    
+    if profiler.enabled:
+        for setting in sweep:
+            results_dir = setting[0]
+            write_report(os.path.join(results_dir, PROFILE_FILENAME), profiler.get_records(results_dir))
+    if profile_dump:
+        write_profile_dump(profiler, data_dir, sweep, control_dict, cache, text, chunk_rows, ratio_mode)
+    return failures
+
+def write_profile_dump(profiler, data_dir, sweep, control_dict, cache=None, text=True, chunk_rows=None, \
+                       ratio_mode='simple'):
+    """
+    rerun the slowest gpr file in profiler serially under cProfile, for every setting in sweep,
+    and dump the statistics to PROFILE_DUMP_FILENAME in each results directory, for reading with pstats
+    the rerun rewrites that file's results with the same contents
+    """
+    input_file = profiler.get_slowest('file', 'file')
+    if input_file is None:
+        logger.info('no gpr files were processed, so there is no profile dump')
+        return
+    (tasks, file_to_entries, names) = get_sweep_tasks(data_dir, sweep, None, text)
+    settings = [ task[1] for task in tasks if task[0] == input_file ][0]
+    logger.info('profiling the slowest file %s', input_file)
+    prof = cProfile.Profile()
+    prof.runcall(sweep_gpr_file, input_file, settings, control_dict, cache, None, text, NO_PROFILE, chunk_rows, ratio_mode)
+    for setting in sweep:
+        filename = os.path.join(setting[0], PROFILE_DUMP_FILENAME)
+        prof.dump_stats(filename)
+        logger.info('wrote cProfile statistics for %s to %s', input_file, filename)
+
+def run_batch(runs, control_dict, cache=None, jobs=1, \
+              skip_gpr=False, create_map=False, map_filename='map_pool_to_file.txt', skip_deconv=False, \
+              force=False, pool=None, text=True, design=STANDARD_DESIGN, chunk_rows=None, ratio_mode='simple'):
+    """
+    run_sweep for several runs, each a (data_dir, sweep), in one process
+    the gpr files of every run are scheduled together, so with jobs > 1 one worker pool
+    stays busy across runs instead of draining at the end of each run
+    each run is deconvoluted once its own gpr files are done, and a run with failures is not deconvoluted
+    return a list with the (input_file, error) failures of each run
+    """
+    manifests = [ get_sweep_manifests(sweep, control_dict, force, ratio_mode) for (data_dir, sweep) in runs ]
     
-    # get a dictionary of controls
-    control_dict = get_control_from_file(args.control_filename)
-    control_dict_filename = os.path.join(args.results_dir, 'control_dict.txt')
-    print_control_dict(control_dict, control_dict_filename)
+    tasks = [ ]
+    # input file -> (run index, manifest entries)
+    file_to_entries = dict()
+    run_names = [ ]
+    if not skip_gpr:
+        for (r, ((data_dir, sweep), run_manifests)) in enumerate(zip(runs, manifests)):
+            (run_tasks, run_entries, names) = get_sweep_tasks(data_dir, sweep, run_manifests, text)
+            tasks += run_tasks
+            for (input_file, entries) in run_entries.items():
+                file_to_entries[input_file] = (r, entries)
+            run_names.append(names)
     
-    # for each gpr file in the data directory,
-    #   analyze the file and generate results for that file
-    if not args.skip_gpr:
-        process_gpr_dir(args.data_dir, args.results_dir, args.signal_fg, args.signal_bg, \
-                        args.norm_fg, args.norm_bg, args.do_norm, args.do_log, \
-                        control_dict)
+    def done_fn(input_file):
+        (r, entries) = file_to_entries[input_file]
+        for (i, file_name, sha1, outputs) in entries:
+            manifests[r][i].set_file(file_name, sha1, outputs)
+    failures = [ ]
+    if not skip_gpr:
+        try:
+            failures = run_gpr_tasks(tasks, control_dict, cache, jobs, done_fn, pool, chunk_rows=chunk_rows, \
+                                     ratio_mode=ratio_mode)
+        finally:
+            for (names, run_manifests) in zip(run_names, manifests):
+                for manifest in run_manifests:
+                    manifest.keep_files(names)
+                    manifest.write()
+    
+    run_failures = [ [ ] for x in runs ]
+    for (input_file, error) in failures:
+        run_failures[file_to_entries[input_file][0]].append( (input_file, error) )
+    for ((data_dir, sweep), run_manifests, this_failures) in zip(runs, manifests, run_failures):
+        deconv_sweep(data_dir, sweep, run_manifests, this_failures, create_map, map_filename, skip_deconv, design)
+    return run_failures
 
-    map_fullpath = os.path.join(args.results_dir, args.map_filename)
-    if args.create_map:
-        create_map_file(args.data_dir, map_fullpath)
+def get_batch_hit(results_dirs):
+    """
+    consolidated hit table for several results directories: the intersection hits of each,
+    from the binary copy written by deconv_pools, with a first column run naming the results directory
+    results directories without a deconvolution are skipped
+    """
+    frames = [ ]
+    runs = [ ]
+    for results_dir in results_dirs:
+        (head_path, sub_dir) = os.path.split(results_dir)
+        filename = get_binary_name(os.path.join(head_path, 'intersection_hit_' + sub_dir + '.txt'))
+        if not os.path.exists(filename):
+            logger.warn('no intersection hits for %s', results_dir)
+            continue
+        frames.append(DataFrame(filename=filename))
+        runs.append(sub_dir)
+    if len(frames) == 0:
+        return DataFrame(data=[ ('run', [ ]) ])
+    headers = frames[0].headers
+    for (df, run) in zip(frames, runs):
+        assert(df.headers == headers), 'run %s has columns %s, expected %s' % (run, ' '.join(df.headers), ' '.join(headers))
+    # empty frames have no column types to contribute
+    nonempty = [ df for df in frames if df.n_row > 0 ] or frames[:1]
+    data = [ ('run', [ run for (df, run) in zip(frames, runs) for k in range(df.n_row) ]) ]
+    data += [ (h, np.concatenate([ np.asarray(df.data[h]) for df in nonempty ])) for h in headers ]
+    logger.info('%d hits from %d runs', len(data[0][1]), len(frames))
+    return DataFrame(data=data)
 
-    if not args.skip_deconv:
-        map_dataframe = DataFrame(filename=map_fullpath)
-        deconv_pools(args.results_dir, map_dataframe)
+def main(args):
+    
+    # get a dictionary of controls
+    control_dict = get_control_from_file(args.control_filename)
+    
+    # parsed gpr columns are cached unless --no_cache
+    cache = get_cache_from_args(args)
+    
+    channels = [ ('', args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg) ]
+    if args.sweep:
+        sweep = get_sweep(args.results_dir, channels)
+    else:
+        sweep = [ (args.results_dir, args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg, \
+                   args.do_norm, args.do_log) ]
+    run_sweep(args.data_dir, sweep, control_dict, cache, args.jobs, \
+              args.skip_gpr, args.create_map, args.map_filename, args.skip_deconv, args.force, \
+              text=(not args.no_text), design=get_design(args.design), \
+              profile=args.profile, profile_dump=args.profile_dump, \
+              chunk_rows=(args.chunk_rows if args.stream else None), ratio_mode=args.ratio_mode)
 
 if __name__ == '__main__':
     args = ap.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
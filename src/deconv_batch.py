@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Deconvolute several runs of gpr files in one process
+copyright (c) 2012
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import glob
+import argparse
+
+import deconv
+from pooldesign import get_design
+from dataframe import get_binary_name
+from gpr_cache import add_cache_arguments, get_cache_from_args
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='deconv_batch')
+logger.setLevel(logging.INFO)
+
+ap = argparse.ArgumentParser(description='Deconvolute each DATA_DIR into RESULTS_ROOT/<data dir name>, loading the controls once and sharing one worker pool across runs, then write a table of the hits from every run.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('results_root', help='directory for writing the results of each run')
+ap.add_argument('data_dirs', nargs='+', help='directories of gpr files, one per run; quoted glob patterns such as "GPR_files/2012-06-*" are expanded')
+ap.add_argument('--control_filename', default=deconv.ap.get_default('control_filename'), \
+                help='file with controls, header "id name" then one row for each id and name (default: %(default)s)')
+ap.add_argument('--signal_fg', default = 'F635 Median', help='gpr signal foreground (default: %(default)s)')
+ap.add_argument('--signal_bg', default = 'B635 Median', help='gpr signal background (default: %(default)s)')
+ap.add_argument('--norm_fg', default = 'F532 Median', help='gpr normalization foreground (default: %(default)s)')
+ap.add_argument('--norm_bg', default = 'B532 Median', help='gpr normalization background (default: %(default)s)')
+ap.add_argument('--do_norm', action='store_true', help='normalize signal fg/bg by norm fg/bg (default: %(default)s)')
+ap.add_argument('--do_log', action='store_true', help='take log2 before calculating z-scores (default: %(default)s)')
+ap.add_argument('--sweep', action='store_true', help='run every combination of --do_norm and --do_log for each run (default: %(default)s)')
+ap.add_argument('--design', default=deconv.DEFAULT_DESIGN, help='pooling design, as for deconv.py (default: %(default)s)')
+ap.add_argument('--no_text', action='store_true', help='save gpr results only in the binary format (default: %(default)s)')
+ap.add_argument('--force', action='store_true', help='redo every gpr file and deconvolution even if the manifests say they are up to date (default: %(default)s)')
+ap.add_argument('--jobs', type=int, default=1, help='number of worker processes for the gpr files of all runs (default: %(default)s)')
+ap.add_argument('--batch_filename', default='intersection_hit_batch.txt', help='RESULTS_ROOT/BATCH_FILENAME has the hits of every run (default: %(default)s)')
+ap.add_argument('--ratio_mode', default='simple', choices=deconv.RATIO_MODES, help='ratio from fg / bg or a regression fit of fg on bg, as for deconv.py (default: %(default)s)')
+ap.add_argument('--stream', action='store_true', help='read each gpr file in blocks of CHUNK_ROWS rows, as for deconv.py (default: %(default)s)')
+ap.add_argument('--chunk_rows', type=int, default=deconv.CHUNK_ROWS, help='rows per block for --stream (default: %(default)s)')
+add_cache_arguments(ap)
+
+def get_data_dirs(patterns):
+    """ directories matching each pattern, in order, without repeats """
+    data_dirs = [ ]
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            logger.warn('no directories match %s', pattern)
+        for d in matches:
+            d = os.path.normpath(d)
+            if os.path.isdir(d) and (d not in data_dirs):
+                data_dirs.append(d)
+    return data_dirs
+
+def get_runs(args, data_dirs):
+    """ (data_dir, sweep) for each run, with settings as for deconv.py """
+    channels = [ ('', args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg) ]
+    runs = [ ]
+    for data_dir in data_dirs:
+        results_dir = os.path.join(args.results_root, os.path.basename(data_dir))
+        if args.sweep:
+            sweep = deconv.get_sweep(results_dir, channels)
+        else:
+            sweep = [ (results_dir, args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg, args.do_norm, args.do_log) ]
+        runs.append( (data_dir, sweep) )
+    return runs
+
+def main(args):
+    data_dirs = get_data_dirs(args.data_dirs)
+    assert(len(data_dirs) > 0), 'no data directories'
+    names = [ os.path.basename(d) for d in data_dirs ]
+    assert(len(set(names)) == len(names)), 'data directories must have different names: %s' % ' '.join(names)
+    runs = get_runs(args, data_dirs)
+    for (data_dir, sweep) in runs:
+        logger.info('run %s -> %s', data_dir, ', '.join([ x[0] for x in sweep ]))
+    
+    control_dict = deconv.get_control_from_file(args.control_filename)
+    cache = get_cache_from_args(args)
+    run_failures = deconv.run_batch(runs, control_dict, cache, args.jobs, create_map=True, \
+                                    force=args.force, text=(not args.no_text), design=get_design(args.design), \
+                                    chunk_rows=(args.chunk_rows if args.stream else None), ratio_mode=args.ratio_mode)
+    # runs with failures were not deconvoluted, so their old hits are left out of the table
+    results_dirs = [ ]
+    for ((data_dir, sweep), failures) in zip(runs, run_failures):
+        logger.info('%s: %d failures', data_dir, len(failures))
+        if len(failures) == 0:
+            results_dirs += [ x[0] for x in sweep ]
+    batch_hit = deconv.get_batch_hit(results_dirs)
+    filename = os.path.join(args.results_root, args.batch_filename)
+    batch_hit.write(filename)
+    batch_hit.save(get_binary_name(filename))
+    logger.info('wrote %s', filename)
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    main(args)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Watch a directory of gpr runs and deconvolute new or changed runs as they arrive
+copyright (c) 2012
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import time
+import signal
+import collections
+import argparse
+
+import deconv
+from gpr import split_gpr_name, GPR_EXTENSIONS
+from pooldesign import get_design
+from gpr_cache import add_cache_arguments, get_cache_from_args
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='deconv_watch')
+logger.setLevel(logging.INFO)
+
+ap = argparse.ArgumentParser(description='Watch GPR_ROOT for run directories with new or changed gpr files, and deconvolute each run into RESULTS_ROOT/<run>.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('gpr_root', help='directory with one subdirectory of gpr files for each run')
+ap.add_argument('results_root', help='directory for writing the results of each run')
+ap.add_argument('--control_filename', default=deconv.ap.get_default('control_filename'), \
+                help='file with controls, header "id name" then one row for each id and name (default: %(default)s)')
+ap.add_argument('--signal_fg', default = 'F635 Median', help='gpr signal foreground (default: %(default)s)')
+ap.add_argument('--signal_bg', default = 'B635 Median', help='gpr signal background (default: %(default)s)')
+ap.add_argument('--norm_fg', default = 'F532 Median', help='gpr normalization foreground (default: %(default)s)')
+ap.add_argument('--norm_bg', default = 'B532 Median', help='gpr normalization background (default: %(default)s)')
+ap.add_argument('--do_norm', action='store_true', help='normalize signal fg/bg by norm fg/bg (default: %(default)s)')
+ap.add_argument('--do_log', action='store_true', help='take log2 before calculating z-scores (default: %(default)s)')
+ap.add_argument('--sweep', action='store_true', help='run every combination of --do_norm and --do_log for each run (default: %(default)s)')
+ap.add_argument('--design', default=deconv.DEFAULT_DESIGN, help='pooling design, as for deconv.py (default: %(default)s)')
+ap.add_argument('--interval', type=float, default=10.0, help='seconds between scans of GPR_ROOT (default: %(default)s)')
+ap.add_argument('--settle', type=float, default=30.0, help='seconds a gpr file must keep the same size and time stamp before it is read (default: %(default)s)')
+ap.add_argument('--jobs', type=int, default=1, help='number of worker processes for the gpr files (default: %(default)s)')
+ap.add_argument('--once', action='store_true', help='process whatever is ready and exit instead of watching (default: %(default)s)')
+add_cache_arguments(ap)
+
+class GPRWatcher:
+    """
+    poll gpr_root for run directories with new or changed gpr files
+    a file is ready once its size and modification time have not changed for settle seconds,
+    which is how a file still being written by the scanner or a copy is recognized
+    a run is ready once it has ready files and no files that are still changing
+    """
+    def __init__(self, gpr_root, settle):
+        self.gpr_root = gpr_root
+        self.settle = settle
+        # file -> (size, mtime) when it was last processed
+        self.done = dict()
+        # file -> ((size, mtime), time first seen with that size and mtime), for the files listed by the last scan
+        self.pending = dict()
+
+    def get_stat(self, filename):
+        st = os.stat(filename)
+        return (st.st_size, st.st_mtime)
+
+    def scan(self, now=None):
+        """
+        return a list of (run directory, {file: (size, mtime)}) for the runs that are ready
+        pending is rebuilt from the files listed, so files that were removed or renamed are dropped
+        """
+        if now is None:
+            now = time.time()
+        ready = [ ]
+        pending = dict()
+        if not os.path.isdir(self.gpr_root):
+            logger.warn('%s does not exist', self.gpr_root)
+            self.pending = pending
+            return ready
+        for subdir in sorted(os.listdir(self.gpr_root)):
+            run_dir = os.path.join(self.gpr_root, subdir)
+            if not os.path.isdir(run_dir):
+                continue
+            files_ready = dict()
+            unsettled = 0
+            for file_name in sorted(os.listdir(run_dir)):
+                (base, ext) = split_gpr_name(file_name)
+                if ext not in GPR_EXTENSIONS:
+                    continue
+                filename = os.path.join(run_dir, file_name)
+                try:
+                    stat = self.get_stat(filename)
+                except OSError:
+                    # removed between listdir and stat
+                    continue
+                if self.done.get(filename) == stat:
+                    continue
+                prev = self.pending.get(filename)
+                if (prev is None) or (prev[0] != stat):
+                    pending[filename] = (stat, now)
+                    unsettled += 1
+                elif now - prev[1] < self.settle:
+                    pending[filename] = prev
+                    unsettled += 1
+                else:
+                    pending[filename] = prev
+                    files_ready[filename] = stat
+            if len(files_ready) == 0:
+                continue
+            if unsettled > 0:
+                logger.info('%s: waiting for %d files still being written', subdir, unsettled)
+                continue
+            ready.append( (run_dir, files_ready) )
+        self.pending = pending
+        return ready
+
+    def set_done(self, files):
+        for (filename, stat) in files.items():
+            self.done[filename] = stat
+            self.pending.pop(filename, None)
+
+# set by the signal handler; the current run is finished before shutting down
+stop_state = dict(stop=False)
+
+def request_stop(signum, frame):
+    if not stop_state['stop']:
+        logger.info('signal %d, stopping after the current run', signum)
+    stop_state['stop'] = True
+
+def get_run_sweep(args, results_dir):
+    """ settings for one run, as for deconv.py """
+    channels = [ ('', args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg) ]
+    if args.sweep:
+        return deconv.get_sweep(results_dir, channels)
+    return [ (results_dir, args.signal_fg, args.signal_bg, args.norm_fg, args.norm_bg, args.do_norm, args.do_log) ]
+
+def process_run(run_dir, args, control_dict, cache, pool):
+    """
+    gpr analysis and deconvolution for one run directory
+    the run manifest means only the new or changed gpr files are analyzed
+    return True if the run succeeded
+    """
+    results_dir = os.path.join(args.results_root, os.path.basename(run_dir))
+    sweep = get_run_sweep(args, results_dir)
+    logger.info('run %s -> %s', run_dir, ', '.join([ x[0] for x in sweep ]))
+    try:
+        failures = deconv.run_sweep(run_dir, sweep, control_dict, cache, args.jobs, \
+                                    create_map=True, pool=pool, design=get_design(args.design))
+    except Exception:
+        logger.exception('run %s failed', run_dir)
+        return False
+    return len(failures) == 0
+
+def watch(args, control_dict, cache, pool=None):
+    """
+    scan for ready runs and process them in order until stopped
+    a run that fails is logged and marked done like any other, so it is retried when one of its files changes again
+    with --once, stop when no file listed by the last scan is still waiting
+    """
+    watcher = GPRWatcher(args.gpr_root, args.settle)
+    queue = collections.deque()
+    while not stop_state['stop']:
+        for (run_dir, files) in watcher.scan():
+            logger.info('queueing %s, %d new or changed files', run_dir, len(files))
+            queue.append( (run_dir, files) )
+        while (len(queue) > 0) and not stop_state['stop']:
+            (run_dir, files) = queue.popleft()
+            if not process_run(run_dir, args, control_dict, cache, pool):
+                logger.warn('run %s failed, it is retried when one of its %d files changes', run_dir, len(files))
+            watcher.set_done(files)
+        if args.once and (len(watcher.pending) == 0):
+            break
+        # sleep in short steps so that a signal is noticed promptly
+        wake = time.time() + args.interval
+        while (time.time() < wake) and not stop_state['stop']:
+            time.sleep(min(1.0, args.interval))
+
+def main(args):
+    # controls, the cache, and the worker pool are loaded once and reused for every run
+    control_dict = deconv.get_control_from_file(args.control_filename)
+    cache = get_cache_from_args(args)
+    pool = None
+    if args.jobs > 1:
+        pool = deconv.make_pool(args.jobs, control_dict, cache)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    try:
+        watch(args, control_dict, cache, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info('stopped')
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    main(args)
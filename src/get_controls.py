@@ -6,8 +6,13 @@ joel.bader@jhu.edu
 
 import logging
 import os
-from gpr import GPR
+import signal
+import multiprocessing
+import argparse
+from gpr import GPR, split_gpr_name, GPR_EXTENSIONS
+from gpr_cache import add_cache_arguments, get_cache_from_args
 from dataframe import DataFrame
+from categorical import Categorical
 import numpy as np
 import numpy.ma
 
@@ -24,69 +29,149 @@ def get_data_dir():
     logger.info('data_dir %s', data_dir)
     return(data_dir)
     
-def process_gpr_file(input_file, control_cnt):
+# user interface permits manual flagging of bad data, usually -100; get_controls counts these as controls
+FLAG_BAD = -100
+
+def get_pair_index(ids, names):
+    """
+    factorize (id, name) pairs
+    return (pair_ids, pair_names, codes): the distinct pairs sorted by id then name,
+    and for each row the index of its pair
+    Categorical ids and names are paired on their codes, which sort in the same order as the strings
+    """
+    if isinstance(ids, Categorical) and isinstance(names, Categorical):
+        n_name = max(len(names.categories), 1)
+        (pairs, codes) = np.unique(ids.codes.astype(np.int64) * n_name + names.codes, return_inverse=True)
+        return(ids.categories[pairs // n_name], names.categories[pairs % n_name], codes)
+    ids = np.asarray(ids)
+    names = np.asarray(names)
+    if len(ids) == 0:
+        return(ids, names, np.zeros(0, dtype=int))
+    order = np.lexsort((names, ids))
+    (sorted_ids, sorted_names) = (ids[order], names[order])
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_ids[1:] != sorted_ids[:-1]) | (sorted_names[1:] != sorted_names[:-1])
+    codes = np.empty(len(order), dtype=int)
+    codes[order] = np.cumsum(is_new) - 1
+    return(sorted_ids[is_new], sorted_names[is_new], codes)
+
+def count_controls(ids, names, flags):
+    """
+    compact count table (ids, names, control, exptl) with one entry for each (id, name) pair:
+    how often the pair is flagged as a control, and how often it is not
+    """
+    (pair_ids, pair_names, codes) = get_pair_index(ids, names)
+    is_control = np.asarray(flags) <= FLAG_BAD
+    n_pair = len(pair_ids)
+    control = np.bincount(codes[is_control], minlength=n_pair)
+    exptl = np.bincount(codes[~is_control], minlength=n_pair)
+    return(pair_ids, pair_names, control, exptl)
+
+def merge_counts(tables):
+    """ sum count tables from count_controls into one table """
+    if len(tables) == 0:
+        return(np.array([ ]), np.array([ ]), np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    ids = np.concatenate([ t[0] for t in tables ])
+    names = np.concatenate([ t[1] for t in tables ])
+    (pair_ids, pair_names, codes) = get_pair_index(ids, names)
+    n_pair = len(pair_ids)
+    control = np.bincount(codes, weights=np.concatenate([ t[2] for t in tables ]), minlength=n_pair)
+    exptl = np.bincount(codes, weights=np.concatenate([ t[3] for t in tables ]), minlength=n_pair)
+    return(pair_ids, pair_names, control.astype(int), exptl.astype(int))
+
+def get_id_names(ids, names):
+    """
+    for each distinct id, the number of distinct names it has and the sorted names joined by commas
+    return (ids, cnts, names), sorted by id
     """
-    open input_file as a gpr
+    (pair_ids, pair_names, codes) = get_pair_index(ids, names)
+    is_new = np.ones(len(pair_ids), dtype=bool)
+    is_new[1:] = pair_ids[1:] != pair_ids[:-1]
+    starts = np.flatnonzero(is_new)
+    cnts = np.diff(np.append(starts, len(pair_ids)))
+    name_strs = [ ','.join([ str(x) for x in pair_names[a:(a + c)] ]) for (a, c) in zip(starts, cnts) ]
+    return(pair_ids[starts], cnts, name_strs)
+
+def process_gpr_file(input_file, cache=None):
+    """
+    open input_file as a gpr, using cached columns if cache is not None
     columns Flags == -100 marks a control
-    update control_cnt to count how often each (id, name) pair is/isnot a control
+    return the count table from count_controls
     """
-    FLAG_BAD = -100
     logger.info('%s', input_file)
-    gpr = GPR(input_file)
-    gpr.print_summary()
-
-    # extract the columns we need: id, name, flags
+    gpr = GPR(input_file, columns=['ID', 'Name', 'Flags'], cache=cache)
     (ids, names, flags) = gpr.get_columns(['ID', 'Name', 'Flags'])
-    n_row_orig = len(flags)
-    logger.info('n_row_orig %d', n_row_orig)
-
-    # do all the work
-    for (id, name, flag) in zip(ids, names, flags):
-        status = 'control' if flag <= FLAG_BAD else 'exptl'
-        key = (id, name)
-        if key not in control_cnt:
-            control_cnt[key] = dict()
-            control_cnt[key]['control'] = 0
-            control_cnt[key]['exptl'] = 0
-        control_cnt[key][status] = control_cnt[key][status] + 1
-        
-def process_gpr_dir(data_dir):
+    logger.info('n_row_orig %d', len(flags))
+    return count_controls(ids, names, flags)
+
+# state of a worker process, set once per worker by init_worker
+worker_state = dict()
+
+def init_worker(cache):
+    """ pool initializer: the cache is sent once, and the parent logs each file as its result arrives """
+    worker_state['cache'] = cache
+    logging.disable(logging.INFO)
+    # ctrl-c goes to the whole process group; let the parent shut the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def process_gpr_task(input_file):
+    return(input_file, process_gpr_file(input_file, worker_state['cache']))
+
+def process_gpr_dir(data_dir, cache=None, jobs=1):
     """
-    process each gpr file in the data_dir, writing results to results_dir
+    process each gpr file in the data_dir
     keep track of ids and names that are used as controls
     for each (id, name) pair
         count how often the id is/isnot a control
         count how often name is/isnot a control
+    each file gives a count table, in parallel if jobs > 1, and the tables are merged at the end
     """
     file_list = sorted(os.listdir(data_dir))
-    control_cnt = dict()
+    input_files = [ ]
     for file_name in file_list:
-        (base, ext) = os.path.splitext(file_name)
-        if (ext == '.gpr') or (ext == '.GPR'):
+        (base, ext) = split_gpr_name(file_name)
+        if ext in GPR_EXTENSIONS:
             logger.info('dir %s file %s base %s ext %s', data_dir, file_name, base, ext)
-            input_file = os.path.join(data_dir, file_name)
-            logger.info('input %s', input_file)
-            process_gpr_file(input_file, control_cnt)
-            
+            input_files.append(os.path.join(data_dir, file_name))
+    
+    if jobs <= 1:
+        tables = [ process_gpr_file(f, cache) for f in input_files ]
+    else:
+        logger.info('counting %d files with %d jobs', len(input_files), jobs)
+        tables = [ ]
+        pool = multiprocessing.Pool(processes=jobs, initializer=init_worker, initargs=(cache,))
+        try:
+            for (input_file, table) in pool.imap(process_gpr_task, input_files):
+                logger.info('%s: %d pairs', input_file, len(table[0]))
+                tables.append(table)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
     # create a dataframe
-    keys = sorted(control_cnt.keys())
-    id = [ x[0] for x in keys ]
-    name = [ x[1] for x in keys ]
-    control = [ control_cnt[x]['control'] for x in keys ]
-    exptl = [ control_cnt[x]['exptl'] for x in keys ]
+    (id, name, control, exptl) = merge_counts(tables)
     control_df = DataFrame(data= [ ('id', id), ('name', name), ('control', control), ('exptl', exptl) ] )
     return(control_df)
-       
 
+ap = argparse.ArgumentParser(description='Count how often each (id, name) pair is flagged as a control in the gpr files of DATA_DIR.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('data_dir', nargs='?', help='directory for reading gpr data files (default: from get_data_dir)')
+ap.add_argument('--output', default='control.txt', help='file for writing the counts (default: %(default)s)')
+ap.add_argument('--jobs', type=int, default=1, help='number of worker processes for the gpr files (default: %(default)s)')
+add_cache_arguments(ap)
 
-def main():
+def main(args):
     
     # for each gpr file in the data directory,
-    #   analyze the file and generate results for that file
-    data_dir = get_data_dir()
-    control_list = process_gpr_dir(data_dir)
-    control_list.write('control.txt')
+    #   count the controls in that file
+    data_dir = args.data_dir if args.data_dir is not None else get_data_dir()
+    control_list = process_gpr_dir(data_dir, get_cache_from_args(args), args.jobs)
+    control_list.write(args.output)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = ap.parse_args()
+    main(args)
@@ -6,19 +6,60 @@ joel.bader@jhu.edu
 
 import logging
 import os
+import io
+import copy
+import gzip
+import signal
+import itertools
+import subprocess
+import distutils.spawn
 import numpy as np
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from dataframe import write_table
+from categorical import Categorical, factorize
 
 #logging.basicConfig(format='%(levelname)s %(name)s.%(funcName)s: %(message)s')
 logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
 logger = logging.getLogger(name='gpr')
 logger.setLevel(logging.INFO)
 
+# change the parser version whenever parsed values change, so that cached columns are not reused
+PARSER_VERSION = 3
+
+def open_zstd(filename, mode='rb'):
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+
+# compression extension -> (python opener, or None if its module is not installed,
+# and the command that decompresses to standard output, used when there is no python opener)
+CODECS = {
+    '.gz': (gzip.open, [ 'gzip', '-dc' ]),
+    '.xz': (lzma.open if lzma is not None else None, [ 'xz', '-dc' ]),
+    '.zst': (open_zstd if zstandard is not None else None, [ 'zstd', '-dc' ]),
+}
+# gpr files, plain or compressed, as split by split_gpr_name
+GPR_EXTENSIONS = [ e + c for e in [ '.gpr', '.GPR' ] for c in [ '' ] + sorted(CODECS.keys()) ]
+
 class GPR:
     """
     Utilities for GenePix Results (GPR) files
     """
-    def __init__(self, filename):
+    def __init__(self, filename, columns=None, lazy=False, cache=None, sha1=None):
         """
+        columns is a list of column headers to keep, or None for all columns
+        if lazy is True, each column is decoded the first time it is used
+        cache is a GPRCache holding previously parsed columns, or None to always parse the text
+        sha1, if given, is the content hash of the file for the cache key, so that it is not hashed again
         components:
         file_type 'ATF'
         version_number '1.0'
@@ -28,113 +69,160 @@ class GPR:
         column_list
         column_type
         n_row
-        data
+        data (columns not yet decoded in lazy mode are missing)
         """
         logger.info('reading from %s', filename)
-        fp = open(filename, 'r')
-        
-        # line 1 should be 'ATF 1.0'
-        line1 = fp.readline()
-        toks = line1.strip().split()
-        assert(len(toks) == 2), 'gpr line 1 should be ATF 1.0, got %s' % line1
-        (self.file_type, self.version_number) = toks
-        assert(self.file_type == 'ATF'), 'expecting file_type ATF got %s' % self.file_type
-        assert(self.version_number == '1.0'), 'expecting version_number 1.0 got %s' % self.version_number
-        
-        # line 2 has number of optional header records and data fields (columns)
-        line2 = fp.readline()
-        toks = line2.strip().split()
-        assert(len(toks) == 2), 'gpr line 2 should be <n_header> <n_column>, got %s' % line2
-        (self.n_header, self.n_column) = (int(toks[0]), int(toks[1]))
+        fp = open_gpr(filename)
+        (self.file_type, self.version_number, self.header_list, self.header_dict, file_column_list) = read_header(fp)
+        self.n_header = len(self.header_list)
         
-        # process the header lines
-        # expected format is "<key>=<value>" with double quotes and value possibly empty
-        
-        self.header_list = list() # to remember the order of the header keys
-        self.header_dict = dict()
-        for cnt in range(self.n_header):
-            header_line = fp.readline()
-            toks = header_line.strip().strip('"').split('=')
-            assert(len(toks) == 2), 'header expected "<key>=<value>" got %s' % header_line
-            (k, v) = toks
-            self.header_list.append(k)
-            self.header_dict[k] = v
-            logger.debug('header line %d %s = %s', cnt + 1, k, v)
-            
-        column_line = fp.readline()
-        toks = column_line.strip().split('\t')
-        assert(len(toks) == self.n_column), 'expected %d columns got %d: %s' % (self.n_column, len(toks), column_line)
-        
-        self.column_list = [ x.strip('"') for x in toks ]
-        
-        self.column_type = dict()
-        str_columns = ['Name', 'ID']
-        int_columns = ['Block', 'Column', 'Row', 'X', 'Y', 'Dia.', 'F Pixels', 'B Pixels', 'Circularity', 'Flags', 'Normalize', 'Autoflag']
-        for c in self.column_list:
-            c_type = np.float
-            if c in str_columns:
-                c_type = type('')
-            elif c in int_columns:
-                c_type = np.int
-            self.column_type[c] = c_type
+        self.column_list = file_column_list
+        if columns is not None:
+            for c in columns:
+                assert(c in file_column_list), 'requested column %s missing' % c
+            self.column_list = [ c for c in file_column_list if c in columns ]
+        self.n_column = len(self.column_list)
         
+        self.column_type = get_column_type(self.column_list)
         for (i, c) in enumerate(self.column_list):
             logger.debug('%d\t%s\t%s', i+1, c, str(self.column_type[c]))
         
         # store each column as a separate object in a dict
-        # most objects will be numpy int arrays, a few will be numpy float arrays
+        # most objects will be numpy int arrays, a few will be numpy float arrays,
+        # and the string columns, Name and ID, are Categoricals of codes into their distinct values
+        # columns are decoded from the cache or the text by decode_columns
+        # delete_rows only records the index of the rows kept; a column is indexed
+        # by decode_columns the next time it is used, so unused columns are never copied
+        self._filename = filename
+        # compressed files are read again from the start, since they cannot seek
+        self._data_offset = None if get_compression(filename) is not None else fp.tell()
+        fp.close()
         self.data = dict()
-        rows = fp.readlines()
-        self.n_row = len(rows)
-        logger.info('%d data rows', self.n_row)
+        self._text = None
+        self._file_column_list = file_column_list
+        self._pending = list(self.column_list)
+        self._keep = [ ]
+        self._column_gen = dict()
+        self._cache = cache
+        self._cache_key = None
         
-        # initialize the data matrix
-        for c in self.column_list:
-            c_type = self.column_type[c]
-            if c_type == type(''):
-                self.data[c] = [''] * self.n_row
-            elif c_type == np.int:
-                self.data[c] = np.zeros(self.n_row, dtype=c_type)
-            elif c_type == np.float:
-                self.data[c] = np.array([np.nan] * self.n_row, dtype=c_type)
-            else:
-                assert 1 == 0, 'column %s has bad data type %s' % (c, str(c_type))
-                
-        # read the data
-        for (i, row) in enumerate(rows):
-            if (i + 1) % 10000 == 0:
-                logger.info('... %d', i+1)
-            toks = row.strip().split('\t')
-            assert(len(toks) == self.n_column), 'expected %d columns got %d: %s' % (self.n_column, len(toks), row)
-            for (j, c) in enumerate(self.column_list):
-                c_type = self.column_type[c]
-                tok = toks[j]
-                if c_type == type(''):
-                    value = tok.strip('"')
-                elif c_type == np.int:
-                    value = c_type(tok)
-                elif c_type == np.float:
-                    value = np.nan if tok == 'Error' else c_type(tok)
-                else:
-                    assert 1 == 0, 'column %s has bad data type %s' % (c, str(c_type))
-                self.data[c][i] = value
+        self.n_row = None
+        if cache is not None:
+            self._cache_key = cache.get_key(filename, sha1)
+            meta = cache.get_meta(self._cache_key)
+            if meta is not None:
+                self.n_row = meta['n_row']
+        if self.n_row is None:
+            self._text = self.read_text()
+            self.n_row = count_rows(self._text)
+        if not lazy:
+            self.decode_columns(self.column_list)
+        logger.info('%d data rows', self.n_row)
                 
         return None
     
+    def decode_columns(self, request_list):
+        """
+        decode the requested columns that have not been decoded yet
+        columns come from the cache when possible, the rest from a single pass over the text
+        newly parsed columns are added to the cache
+        rows deleted since a requested column was last used are removed from it
+        """
+        decode = [ c for c in self._pending if c in request_list ]
+        if len(decode) > 0:
+            self.parse_columns(decode)
+        for c in request_list:
+            self.select_rows(c)
+        return None
+
+    def parse_columns(self, decode):
+        """ decode columns from the cache or the text, as they are in the file """
+        logger.debug('decoding %d columns: %s', len(decode), ' '.join(decode))
+        new_data = dict()
+        if self._cache is not None:
+            new_data = self._cache.load_columns(self._cache_key, self._file_column_list, decode)
+        parse = [ c for c in decode if c not in new_data ]
+        if len(parse) > 0:
+            if self._text is None:
+                self._text = self.read_text()
+            # the bulk parser is used when every column in the file is needed
+            parse_arg = None if (len(parse) == len(self._file_column_list)) else parse
+            (n_row, parsed) = parse_data(self._text, self._file_column_list, self.column_type, parse_arg)
+            if self._cache is not None:
+                self._cache.store_columns(self._cache_key, self._file_column_list, n_row, parsed)
+            new_data.update(parsed)
+        for c in decode:
+            self.data[c] = new_data[c]
+            self._column_gen[c] = 0
+            self._pending.remove(c)
+        if len(self._pending) == 0:
+            self._text = None
+        return None
+
+    def get_row_index(self, gen):
+        """ index of the current rows within the rows present after the first gen calls to delete_rows """
+        index = self._keep[gen]
+        for keep in self._keep[(gen + 1):]:
+            index = index[keep]
+        return index
+
+    def select_rows(self, c):
+        """ apply the deletions made since column c was last used """
+        gen = self._column_gen.get(c)
+        if (gen is None) or (gen == len(self._keep)):
+            return None
+        this_data = self.data[c]
+        if not isinstance(this_data, Categorical):
+            this_data = np.asarray(this_data, dtype=self.column_type[c])
+        self.data[c] = this_data[self.get_row_index(gen)]
+        self._column_gen[c] = len(self._keep)
+        return None
+    
+    def copy(self):
+        """
+        return a copy that can have rows deleted and columns added independently of this one
+        the column data itself is shared, not copied
+        """
+        other = copy.copy(self)
+        other.column_list = list(self.column_list)
+        other.column_type = dict(self.column_type)
+        other.data = dict(self.data)
+        other._pending = list(self._pending)
+        other._keep = list(self._keep)
+        other._column_gen = dict(self._column_gen)
+        return other
+    
+    def read_text(self):
+        """ read the data section of the file as a single string, decompressing it if needed """
+        fp = open_gpr(self._filename)
+        if self._data_offset is None:
+            read_header(fp)
+        else:
+            fp.seek(self._data_offset)
+        text = fp.read()
+        fp.close()
+        return text
+    
     def delete_rows(self, mask):
-        """ delete rows where mask is true """
+        """
+        delete rows where mask is true
+        only the index of the remaining rows is stored here; columns are indexed when next used
+        """
         assert(len(mask) == self.n_row), 'expected mask with %d rows but found %d' % (self.n_row, len(mask))
-        row_subset = [ i for i in range(self.n_row) if not mask[i] ]
-        for c in self.column_list:
-            self.data[c] = np.array([ self.data[c][r] for r in row_subset ], dtype=self.column_type[c])
-        self.n_row = len(row_subset)
-        logger.info('%d rows deleted, new length is %d', sum(mask), self.n_row)        
+        keep = np.flatnonzero(~np.asarray(mask, dtype=bool))
+        n_delete = self.n_row - len(keep)
+        if n_delete > 0:
+            self._keep.append(keep)
+        self.n_row = len(keep)
+        logger.info('%d rows deleted, new length is %d', n_delete, self.n_row)
         
     
     def get_columns(self, request_list):
+        for c in request_list:
+            assert c in self.column_list, 'requested column %s missing' % c
+        self.decode_columns(request_list)
         ret = [ ]
         for c in request_list:
-            assert c in self.data, 'requested column %s missing' % c
             ret.append(self.data[c])
         return(ret)
         
@@ -154,12 +242,18 @@ class GPR:
             assert(len(this_data) == self.n_row), 'expected %d rows but found %d' % (self.n_row, len(this_data))
             self.n_column += 1
             self.column_list.append(this_name)
-            self.column_type[this_name] = type(this_data[0])
-            self.data[this_name] = np.array(this_data)
+            if isinstance(this_data, Categorical):
+                self.column_type[this_name] = type('')
+                self.data[this_name] = this_data
+            else:
+                self.column_type[this_name] = type(this_data[0])
+                self.data[this_name] = np.array(this_data)
+            self._column_gen[this_name] = len(self._keep)
         n_new = len(args)
         logger.info('added %d columns: %s', n_new, ' '.join(self.column_list[-n_new:]))
     
     def get_id_to_name(self):
+        self.decode_columns(['ID', 'Name'])
         id_to_name = dict()
         for (i, n) in zip(self.data['ID'], self.data['Name']):
             if i not in id_to_name:
@@ -171,94 +265,405 @@ class GPR:
         return id_to_name
         
         
-    def print_summary(self):
-        # count how many ids for each name, how many rows for each name and id
-        
-        def create_hist(value_list):
-            cnt = dict()
-            for v in value_list:
-                cnt[v] = cnt.get(v, 0) + 1
-            return cnt
-        
-        def print_hist(hist, key_str, value_str):
-            print '%s\t%s' % (key_str, value_str)
-            for k in sorted(hist.keys()):
-                v = hist[k]
-                print '%d\t%d' % (k, v)
-
-        id_to_mask = dict()
-        id_to_name = dict()
-
-        for masked in (False, True):       
-            name_cnt = dict()
-            id_cnt = dict()
-            name_to_id = dict()
-            for i in range(self.n_row):
-                (name, id, flag) = (self.data['Name'][i], self.data['ID'][i], self.data['Flags'][i])
-                mymask = flag <= -100
-                if (mymask == masked):
-                    if id not in id_to_mask:
-                        id_to_mask[id] = dict()
-                    id_to_mask[id][masked] = True
-                    id_to_name[id] = name
-                    name_cnt[name] = name_cnt.get(name, 0) + 1
-                    id_cnt[id] = id_cnt.get(id, 0) + 1
-                    if name not in name_to_id:
-                        name_to_id[name] = dict()
-                    name_to_id[name][id] = True
-            name_to_idcnt = dict()
-            for name in name_to_id.keys():
-                name_to_idcnt[name] = len(name_to_id[name].keys())
-            nameid_hist = create_hist(name_to_idcnt.values())
-            name_hist = create_hist(name_cnt.values())
-            id_hist = create_hist(id_cnt.values())
-            print '\nhistogram for mask = ' + str(masked)
-            print_hist(nameid_hist, 'ids_per_name', 'number_of_names')
-            print_hist(name_hist, 'rows_per_name', 'number_of_names')
-            print_hist(id_hist, 'rows_per_id', 'number_of_ids')
-            
-            print '\nnames with many ids for mask = ' + str(masked)
-            for name in sorted(name_to_idcnt.keys()):
-                cnt = name_to_idcnt[name]
-                if (cnt < 6):
-                    continue
-                print '%s\t%d' % (name, cnt)
-            
-            print '\nids with many rows for mask = ' + str(masked)
-            for id in sorted(id_cnt.keys()):
-                cnt = id_cnt[id]
-                if (cnt < 6):
-                    continue
-                print '%s\t%s\t%d' % (id_to_name[id], id, cnt)
-        
-        print 'checking for ids with multiple mask values'
-        for id in sorted(id_to_mask.keys()):
-            nkey = len(id_to_mask[id].keys())
-            if (nkey != 1):
-                name = id_to_name[id]
-                print 'id %s named %s has %d masks' % (id, name, nkey)
-                
-    
-    def write(self, filename, rows=None, columns=None):
+    def write(self, filename, rows=None, columns=None, precision=None):
         """
         rows is a list of row numbers, with the first list element being row 1 (not row 0)
         columns is a list of column headers
+        precision is the number of significant digits for floats, or None for full precision
         """
-        if rows is None:
-            rows = range(1, self.n_row + 1)
         if columns is None:
             columns = self.column_list
-        fp = open(filename, 'w')
-        n_col = len(columns)
-        logger.info('writing %d by %d data matrix to %s', len(rows), n_col, filename)
-        fp.write('\t'.join(columns) + '\n')
-        for i in rows:
-            if i % 10000 == 0:
-                logger.info('... %d', i+1)
-            toks = [ str(self.data[c][i-1]) for c in columns ]
-            fp.write('\t'.join(toks) + '\n')
+        self.decode_columns(columns)
+        write_table(filename, columns, [ self.data[c] for c in columns ], rows, precision=precision)
+
+def split_gpr_name(file_name):
+    """
+    (base, ext) as for os.path.splitext, except that a compression extension stays with
+    the extension before it, so run_H1.gpr.gz gives (run_H1, .gpr.gz); a gpr file has ext in GPR_EXTENSIONS
+    """
+    (base, ext) = os.path.splitext(file_name)
+    if ext in CODECS:
+        (base, inner) = os.path.splitext(base)
+        ext = inner + ext
+    return(base, ext)
+
+def get_compression(filename):
+    """ the compression extension of filename, or None for a plain file """
+    ext = os.path.splitext(filename)[1]
+    return ext if ext in CODECS else None
+
+class PipeReader:
+    """
+    the standard output of a decompression command, read like a file
+    the text is decompressed by another process while this one parses it
+    """
+    def __init__(self, command, filename):
+        # the command should stop quietly if we close the pipe before the end
+        self.proc = subprocess.Popen(command + [ filename ], stdout=subprocess.PIPE, bufsize=-1, \
+                                     preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        self.fp = self.proc.stdout
+        self.command = command
+
+    def readline(self):
+        return self.fp.readline()
+
+    def read(self):
+        return self.fp.read()
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    def close(self):
+        self.fp.close()
+        ret = self.proc.wait()
+        assert(ret in (0, -signal.SIGPIPE)), '%s failed with exit code %d' % (' '.join(self.command), ret)
+
+def open_gpr(filename):
+    """
+    open a gpr file for reading, decompressing .gz, .xz and .zst files as they are read
+    compressed files are read with a python module when it is installed, otherwise by piping
+    through the command-line decompressor
+    """
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, 'r')
+    (opener, command) = CODECS[compression]
+    if opener is not None:
+        # line iteration over the decompressed stream is much faster with a buffered reader
+        return io.BufferedReader(opener(filename, 'rb'), buffer_size=1 << 20)
+    assert(distutils.spawn.find_executable(command[0]) is not None), \
+        'no decompressor for %s: install the python module or the %s command' % (filename, command[0])
+    return PipeReader(command, filename)
+
+def read_header(fp):
+    """
+    read the header of a gpr file from fp, leaving fp at the first data row
+    return (file_type, version_number, header_list, header_dict, column_list)
+    """
+    # line 1 should be 'ATF 1.0'
+    line1 = fp.readline()
+    toks = line1.strip().split()
+    assert(len(toks) == 2), 'gpr line 1 should be ATF 1.0, got %s' % line1
+    (file_type, version_number) = toks
+    assert(file_type == 'ATF'), 'expecting file_type ATF got %s' % file_type
+    assert(version_number == '1.0'), 'expecting version_number 1.0 got %s' % version_number
+    
+    # line 2 has number of optional header records and data fields (columns)
+    line2 = fp.readline()
+    toks = line2.strip().split()
+    assert(len(toks) == 2), 'gpr line 2 should be <n_header> <n_column>, got %s' % line2
+    (n_header, n_column) = (int(toks[0]), int(toks[1]))
+    
+    # process the header lines
+    # expected format is "<key>=<value>" with double quotes and value possibly empty
+    header_list = list() # to remember the order of the header keys
+    header_dict = dict()
+    for cnt in range(n_header):
+        header_line = fp.readline()
+        toks = header_line.strip().strip('"').split('=')
+        assert(len(toks) == 2), 'header expected "<key>=<value>" got %s' % header_line
+        (k, v) = toks
+        header_list.append(k)
+        header_dict[k] = v
+        logger.debug('header line %d %s = %s', cnt + 1, k, v)
+        
+    column_line = fp.readline()
+    toks = column_line.strip().split('\t')
+    assert(len(toks) == n_column), 'expected %d columns got %d: %s' % (n_column, len(toks), column_line)
+    column_list = [ x.strip('"') for x in toks ]
+    return(file_type, version_number, header_list, header_dict, column_list)
+
+def get_column_type(column_list):
+    """ dict column -> type: str for Name and ID, int for counts and positions, float otherwise """
+    column_type = dict()
+    str_columns = ['Name', 'ID']
+    int_columns = ['Block', 'Column', 'Row', 'X', 'Y', 'Dia.', 'F Pixels', 'B Pixels', 'Circularity', 'Flags', 'Normalize', 'Autoflag']
+    for c in column_list:
+        c_type = np.float
+        if c in str_columns:
+            c_type = type('')
+        elif c in int_columns:
+            c_type = np.int
+        column_type[c] = c_type
+    return column_type
+
+class GPRChunk:
+    """
+    a block of consecutive data rows of a gpr file, from read_chunks
+    it has the n_row, column_list, data and get_columns of a GPR, so spot masks can evaluate it,
+    and first_row, the number of data rows in the file before this block
+    """
+    def __init__(self, column_list, column_type, data, n_row, first_row):
+        self.column_list = column_list
+        self.column_type = column_type
+        self.data = data
+        self.n_row = n_row
+        self.first_row = first_row
+
+    def get_columns(self, request_list):
+        for c in request_list:
+            assert c in self.column_list, 'requested column %s missing' % c
+        return [ self.data[c] for c in request_list ]
+
+# data rows per chunk for read_chunks, a few MB of text for a typical gpr file
+CHUNK_ROWS = 20000
+
+def read_chunks(filename, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    generator of GPRChunk blocks of at most chunk_rows data rows of a gpr file,
+    with the requested columns, or all columns if columns is None
+    only one block of text and its columns are in memory at a time
+    """
+    logger.info('reading %s in chunks of %d rows', filename, chunk_rows)
+    fp = open_gpr(filename)
+    try:
+        (file_type, version_number, header_list, header_dict, file_column_list) = read_header(fp)
+        column_list = file_column_list
+        if columns is not None:
+            for c in columns:
+                assert(c in file_column_list), 'requested column %s missing' % c
+            column_list = [ c for c in file_column_list if c in columns ]
+        column_type = get_column_type(file_column_list)
+        parse_arg = None if (len(column_list) == len(file_column_list)) else column_list
+        first_row = 0
+        while True:
+            lines = list(itertools.islice(fp, chunk_rows))
+            if len(lines) == 0:
+                break
+            (n_row, data) = parse_data(''.join(lines), file_column_list, column_type, parse_arg)
+            lines = None
+            yield GPRChunk(column_list, column_type, data, n_row, first_row)
+            first_row += n_row
+    finally:
         fp.close()
+
+def count_rows(text):
+    """ number of data rows in the text, without decoding anything """
+    n_row = text.count('\n')
+    if (len(text) > 0) and not text.endswith('\n'):
+        n_row += 1
+    return n_row
+
+def parse_data(text, column_list, column_type, columns=None):
+    """
+    parse the data section of a gpr file
+    column_list has every column in the file, in file order
+    columns is the subset of columns to decode, or None to decode all of them
+    all columns are decoded by the bulk parser when possible,
+    a subset is decoded by tokenizing once and converting only the requested columns
+    string columns are returned as Categoricals
+    return the number of rows and a dict with one entry for each decoded column
+    """
+    if '\r' in text:
+        text = text.replace('\r', '')
+    if columns is None:
+        columns = column_list
+        data = bulk_parse(text, column_list, column_type)
+    else:
+        data = extract_columns(text, column_list, column_type, columns)
+    if data is None:
+        rows = text.split('\n')
+        if (len(rows) > 0) and (rows[-1] == ''):
+            rows.pop()
+        index = [ j for (j, c) in enumerate(column_list) if c in columns ]
+        tokens = tokenize_rows(rows, len(column_list), index)
+        rows = None
+        data = dict()
+        for j in index:
+            c = column_list[j]
+            data[c] = convert_column(tokens[j], column_type[c])
+            tokens[j] = None # release the strings as we go
+    for c in columns:
+        if column_type[c] == type(''):
+            data[c] = factorize(data[c])
+    n_row = len(data[columns[0]]) if len(columns) > 0 else count_rows(text)
+    return(n_row, data)
+
+def bulk_parse(text, column_list, column_type):
+    """
+    convert the whole data section with a single numpy call
+    quoted strings are cut out first and replaced by a 0 placeholder
+    decimal points are removed so that every cell parses as an integer mantissa,
+    then cells that had a decimal point are divided by a power of 10,
+    which is exact because both mantissa and power of 10 are exact doubles
+    'Error' cells become nan in float columns
+    return None if the text is not regular enough, so that the caller can
+    parse it column by column and report errors for the offending row
+    """
+    MAX_MANTISSA = 2**53 # larger mantissas are not exact as a double
+    n_column = len(column_list)
+    str_index = [ j for (j, c) in enumerate(column_list) if column_type[c] == type('') ]
+    is_float = np.array([ column_type[c] == np.float for c in column_list ])
+    if (len(text) == 0) or (n_column == 0):
+        return None
+    if not text.endswith('\n'):
+        text = text + '\n'
+    
+    # strings are the odd pieces when splitting on double quotes
+    pieces = text.split('"')
+    if len(pieces) % 2 != 1:
+        return None
+    strings = pieces[1::2]
+    outside = pieces[0::2]
+    body = '0'.join(outside)
+    pieces = None
+    
+    # every cell ends with a tab or a newline, and every row must have n_column cells
+    chars = np.frombuffer(body, dtype=np.uint8)
+    ends = np.flatnonzero((chars == ord('\t')) | (chars == ord('\n')))
+    n_cell = len(ends)
+    if (n_cell % n_column != 0):
+        return None
+    n_row = n_cell // n_column
+    if (body.count('\n') != n_row) or (chars[ends[n_column-1::n_column]] != ord('\n')).any():
+        return None
+    
+    # whitespace after a number would be counted as decimal places below, so such text goes to the column parser
+    if ((chars == ord(' ')) | (chars == ord('\r'))).any():
+        return None
+
+    def cell_info(pos):
+        """ cell number, column, start and length of the cells holding character positions pos """
+        cell = np.searchsorted(ends, pos)
+        start = np.where(cell > 0, ends[cell - 1] + 1, 0)
+        return(cell, cell % n_column, start, ends[cell] - start)
+    
+    # each string column cell must be exactly one quoted string
+    if len(strings) != n_row * len(str_index):
+        return None
+    if len(strings) > 0:
+        str_pos = np.cumsum([ len(x) + 1 for x in outside[:-1] ]) - 1
+        (str_cell, str_column, str_start, str_len) = cell_info(str_pos)
+        if (str_column != np.tile(str_index, n_row)).any() or (str_len != 1).any():
+            return None
+    
+    # 'Error' is allowed as a whole cell in float columns only
+    (err_cell, err_column, err_start, err_len) = cell_info(np.flatnonzero(chars == ord('E')))
+    if (err_len != 5).any() or (err_start != ends[err_cell] - 5).any() or not is_float[err_column].all():
+        return None
+    
+    # at most one decimal point per cell, only in float columns
+    dot_pos = np.flatnonzero(chars == ord('.'))
+    (dot_cell, dot_column, dot_start, dot_len) = cell_info(dot_pos)
+    if (np.diff(dot_cell) == 0).any() or not is_float[dot_column].all():
+        return None
+    chars = None
+    
+    body = body.replace('.', '').replace('Error', '0')
+    values = np.fromstring(body, dtype=np.int64, sep=' ')
+    body = None
+    if (len(values) != n_cell) or (np.abs(values) >= MAX_MANTISSA).any():
+        return None
+    
+    # scale by powers of 10 and fill in nan for errors
+    values = values.astype(np.float)
+    values[dot_cell] /= 10.0 ** (ends[dot_cell] - dot_pos - 1)
+    values[err_cell] = np.nan
+    values = values.reshape((n_row, n_column))
+    
+    data = dict()
+    for (j, c) in enumerate(column_list):
+        c_type = column_type[c]
+        if c_type == type(''):
+            data[c] = strings[str_index.index(j)::len(str_index)]
+        else:
+            data[c] = np.array(values[:, j], dtype=c_type)
+    return data
+
+def extract_columns(text, column_list, column_type, columns):
+    """
+    decode a subset of the columns without tokenizing the others
+    cell boundaries are found with numpy, then the characters of each requested column
+    are gathered into a single string and converted in bulk
+    return None if the text is not regular enough, as for bulk_parse
+    """
+    n_column = len(column_list)
+    if (len(text) == 0) or (n_column == 0):
+        return None
+    if not text.endswith('\n'):
+        text = text + '\n'
+    chars = np.frombuffer(text, dtype=np.uint8)
+    ends = np.flatnonzero((chars == ord('\t')) | (chars == ord('\n')))
+    n_cell = len(ends)
+    if (n_cell % n_column != 0):
+        return None
+    n_row = n_cell // n_column
+    row_ends = ends[n_column-1::n_column]
+    if (text.count('\n') != n_row) or (chars[row_ends] != ord('\n')).any():
+        return None
+    
+    data = dict()
+    for (j, c) in enumerate(column_list):
+        if c not in columns:
+            continue
+        # each cell keeps its trailing tab or newline as the separator
+        cell_end = ends[j::n_column] + 1
+        if j > 0:
+            cell_start = ends[j-1::n_column] + 1
+        else:
+            cell_start = np.concatenate(([ 0 ], row_ends[:-1] + 1))
+        cell_len = cell_end - cell_start
+        offset = np.repeat(cell_start - (np.cumsum(cell_len) - cell_len), cell_len)
+        col_text = chars[offset + np.arange(len(offset))].tostring()
         
+        c_type = column_type[c]
+        if c_type == type(''):
+            toks = col_text.replace('\n', '\t').split('\t')
+            toks.pop()
+            if (j == 0) or (j == n_column - 1):
+                toks = [ tok.strip() for tok in toks ]
+            data[c] = [ tok.strip('"') for tok in toks ]
+        else:
+            if c_type == np.float:
+                col_text = col_text.replace('Error', 'nan')
+            values = np.fromstring(col_text, dtype=c_type, sep=' ')
+            if len(values) != n_row:
+                return None
+            data[c] = values
+    return data
+
+def tokenize_rows(rows, n_column, index=None):
+    """
+    split tab-delimited rows into columns with a single split of the joined text
+    index is the list of column numbers to extract, or None for all columns
+    return a list with n_column entries, a list of string tokens for each extracted column
+    and None for the others
+    """
+    rows = [ r.strip() for r in rows ]
+    n_tab = n_column - 1
+    for row in rows:
+        if row.count('\t') != n_tab:
+            toks = row.split('\t')
+            assert(len(toks) == n_column), 'expected %d columns got %d: %s' % (n_column, len(toks), row)
+    if index is None:
+        index = range(n_column)
+    tokens = [ None ] * n_column
+    if len(rows) == 0:
+        for j in index:
+            tokens[j] = [ ]
+        return tokens
+    toks = '\t'.join(rows).split('\t')
+    for j in index:
+        tokens[j] = toks[j::n_column]
+    return tokens
+
+def convert_column(toks, c_type):
+    """
+    convert a list of string tokens to the column type
+    strings have their double quotes removed and stay as a list
+    numeric columns are parsed in bulk by numpy, with 'Error' as nan for floats
+    if numpy cannot parse every token, fall back to python to report the bad value
+    """
+    if c_type == type(''):
+        return [ tok.strip('"') for tok in toks ]
+    assert(c_type in [ np.int, np.float ]), 'bad data type %s' % str(c_type)
+    text = ' '.join(toks)
+    if c_type == np.float:
+        text = text.replace('Error', 'nan')
+    values = np.fromstring(text, dtype=c_type, sep=' ')
+    if len(values) != len(toks):
+        values = np.array([ np.nan if (c_type == np.float and tok == 'Error') else c_type(tok) for tok in toks ], dtype=c_type)
+    return values
 
 def main():
     gpr = GPR('../data/tmp.gpr')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+On-disk cache of parsed gpr (GenePix Results) columns
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import hashlib
+import json
+import tempfile
+import argparse
+import numpy as np
+
+from gpr import PARSER_VERSION
+from categorical import Categorical
+
+#logging.basicConfig(format='%(levelname)s %(name)s.%(funcName)s: %(message)s')
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='gpr_cache')
+logger.setLevel(logging.INFO)
+
+DEFAULT_CACHE_DIR = os.environ.get('GPR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.gpr_cache'))
+DEFAULT_MAX_MB = 2048
+
+def get_sha1(filename):
+    """ sha1 hex digest of the file contents """
+    sha1 = hashlib.sha1()
+    fp = open(filename, 'rb')
+    while True:
+        block = fp.read(1 << 20)
+        if not block:
+            break
+        sha1.update(block)
+    fp.close()
+    return sha1.hexdigest()
+
+def get_categories_name(npy_file):
+    return os.path.splitext(npy_file)[0] + '.categories.npy'
+
+def save_npy(npy_file, values):
+    """ save under a temporary name and rename, so that readers never see a partial file """
+    (fd, tmp_file) = tempfile.mkstemp(prefix='.tmp-', suffix='.npy', dir=os.path.dirname(npy_file))
+    fp = os.fdopen(fd, 'wb')
+    np.save(fp, values)
+    fp.close()
+    os.rename(tmp_file, npy_file)
+
+class GPRCache:
+    """
+    cache of parsed gpr columns stored as .npy files
+    each gpr file has an entry directory named by the sha1 of its contents and the parser version
+    the entry has meta.json with the number of rows and the file's column list,
+    and one <column number>.npy file for each column parsed so far
+    string columns are Categoricals, stored as the codes plus <column number>.categories.npy
+    numeric columns and codes are memory-mapped when loaded
+    the modification time of meta.json records the last use, and the least recently used
+    entries are evicted when the total size goes over max_mb
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        if not os.path.exists(self.cache_dir):
+            logger.info('making cache directory %s', self.cache_dir)
+            os.makedirs(self.cache_dir)
+
+    def get_key(self, filename, sha1=None):
+        """
+        key for a gpr file: content hash and parser version
+        sha1, if given, is the file's hash from get_sha1, so that the file is not read again
+        """
+        if sha1 is None:
+            sha1 = get_sha1(filename)
+        return '%s-v%d' % (sha1, PARSER_VERSION)
+
+    def get_entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get_meta(self, key):
+        """ return the entry's meta dict and mark the entry as used, or None if the entry is missing """
+        meta_file = os.path.join(self.get_entry(key), 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+        fp = open(meta_file, 'r')
+        meta = json.load(fp)
+        fp.close()
+        os.utime(meta_file, None)
+        return meta
+
+    def load_columns(self, key, column_list, columns):
+        """
+        column_list is the full column list of the gpr file
+        return a dict with the cached subset of columns
+        """
+        entry = self.get_entry(key)
+        data = dict()
+        for c in columns:
+            npy_file = os.path.join(entry, '%03d.npy' % column_list.index(c))
+            if not os.path.isfile(npy_file):
+                continue
+            values = np.load(npy_file, mmap_mode='c')
+            categories_file = get_categories_name(npy_file)
+            if os.path.isfile(categories_file):
+                values = Categorical(values, np.load(categories_file))
+            data[c] = values
+        if len(data) > 0:
+            logger.info('%d of %d columns from cache %s', len(data), len(columns), key)
+        return data
+
+    def store_columns(self, key, column_list, n_row, data):
+        """
+        add the columns in data to the entry for key, creating the entry if needed
+        files are written under a temporary name and renamed so that readers never see partial files
+        """
+        entry = self.get_entry(key)
+        if not os.path.exists(entry):
+            tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+            fp = open(os.path.join(tmp_entry, 'meta.json'), 'w')
+            json.dump({ 'n_row': n_row, 'column_list': column_list, 'parser_version': PARSER_VERSION }, fp)
+            fp.close()
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # another process created the entry first
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+        for (c, values) in data.items():
+            npy_file = os.path.join(entry, '%03d.npy' % column_list.index(c))
+            if os.path.isfile(npy_file):
+                continue
+            # the categories go first, so that they are there once the codes are
+            if isinstance(values, Categorical):
+                save_npy(get_categories_name(npy_file), values.categories)
+                values = values.codes
+            save_npy(npy_file, np.asarray(values))
+        self.evict()
+
+    def get_entries(self):
+        """ list of (last use, size in bytes, entry directory) """
+        entries = [ ]
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            meta_file = os.path.join(entry, 'meta.json')
+            if key.startswith('.tmp-') or not os.path.isfile(meta_file):
+                continue
+            size = sum([ os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry) ])
+            entries.append( (os.path.getmtime(meta_file), size, entry) )
+        return entries
+
+    def evict(self):
+        """ remove least recently used entries until the cache fits in max_bytes """
+        entries = sorted(self.get_entries())
+        total = sum([ x[1] for x in entries ])
+        while (total > self.max_bytes) and (len(entries) > 0):
+            (last_use, size, entry) = entries.pop(0)
+            logger.info('evicting %s, %d bytes', entry, size)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ remove every entry """
+        for key in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        logger.info('cleared %s', self.cache_dir)
+
+def add_cache_arguments(ap):
+    """ command-line options shared by scripts that read gpr files """
+    ap.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR, help='directory for cached gpr columns (default: %(default)s)')
+    ap.add_argument('--cache_mb', type=float, default=DEFAULT_MAX_MB, help='size cap for the gpr cache in MB (default: %(default)s)')
+    ap.add_argument('--no_cache', action='store_true', help='parse gpr files without the cache (default: %(default)s)')
+    ap.add_argument('--clear_cache', action='store_true', help='clear the gpr cache before running (default: %(default)s)')
+
+def get_cache_from_args(args):
+    """ return a GPRCache based on the command-line options, or None if the cache is bypassed """
+    if args.no_cache and not args.clear_cache:
+        return None
+    cache = GPRCache(args.cache_dir, args.cache_mb)
+    if args.clear_cache:
+        cache.clear()
+    if args.no_cache:
+        return None
+    cache.evict()
+    return cache
+
+def main():
+    ap = argparse.ArgumentParser(description='Manage the cache of parsed gpr files.')
+    add_cache_arguments(ap)
+    args = ap.parse_args()
+    cache = GPRCache(args.cache_dir, args.cache_mb)
+    if args.clear_cache:
+        cache.clear()
+    cache.evict()
+    entries = cache.get_entries()
+    logger.info('%d entries, %d bytes in %s', len(entries), sum([ x[1] for x in entries ]), cache.cache_dir)
+
+if __name__ == '__main__':
+    main()
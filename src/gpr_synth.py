@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Synthetic GenePix Results (gpr) files for a pooled experiment, with planted hits
+copyright (c) 2012
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import argparse
+import numpy as np
+
+from dataframe import DataFrame, write_table
+from pooldesign import get_design, DEFAULT_DESIGN
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='gpr_synth')
+logger.setLevel(logging.INFO)
+
+# data columns of a GenePix Results 3 file for wavelengths 635 and 532, see GenePixFileFormats.html
+GPR_COLUMNS = [ 'Block', 'Column', 'Row', 'Name', 'ID', 'X', 'Y', 'Dia.',
+    'F635 Median', 'F635 Mean', 'F635 SD', 'B635 Median', 'B635 Mean', 'B635 SD',
+    '% > B635+1SD', '% > B635+2SD', 'F635 % Sat.',
+    'F532 Median', 'F532 Mean', 'F532 SD', 'B532 Median', 'B532 Mean', 'B532 SD',
+    '% > B532+1SD', '% > B532+2SD', 'F532 % Sat.',
+    'Ratio of Medians (635/532)', 'Ratio of Means (635/532)', 'Median of Ratios (635/532)',
+    'Mean of Ratios (635/532)', 'Ratios SD (635/532)', 'Rgn Ratio (635/532)', 'Rgn R2 (635/532)',
+    'F Pixels', 'B Pixels', 'Circularity', 'Sum of Medians (635/532)', 'Sum of Means (635/532)',
+    'Log Ratio (635/532)', 'F635 Median - B635', 'F532 Median - B532', 'F635 Mean - B635', 'F532 Mean - B532',
+    'F635 Total Intensity', 'F532 Total Intensity', 'SNR 635', 'SNR 532', 'Flags', 'Normalize', 'Autoflag' ]
+
+# spots in each block, and the spacing of spots in um
+BLOCK_ROWS = 24
+BLOCK_COLUMNS = 24
+SPOT_PITCH = 150
+# every CONTROL_EVERY spot is a CONTROL/IgG control, every BSA_EVERY spot a BSA control,
+# and every ND_EVERY id is named ND
+CONTROL_EVERY = 97
+BSA_EVERY = 89
+ND_EVERY = 83
+FLAG_BAD = -100
+# fraction of other spots flagged bad by hand
+BAD_FRACTION = 0.01
+# a planted hit multiplies the foreground of its id in each of its pools by a factor in this range
+HIT_FOLD = (3.0, 6.0)
+
+def get_layout(n_spot, seed=0):
+    """
+    spots shared by every array of an experiment: each id is printed twice, a few names
+    are shared by several ids, and there are controls
+    return (layout, id_code, is_clone_id): layout is a dict of columns Block, Column, Row, X, Y, Name, ID and Flags,
+    id_code numbers the id printed at each spot, and is_clone_id is False for the control spots
+    """
+    rs = np.random.RandomState(seed)
+    spot = np.arange(n_spot)
+    per_block = BLOCK_ROWS * BLOCK_COLUMNS
+    within = spot % per_block
+    n_id = max(n_spot // 2, 1)
+    id_code = spot % n_id
+    name_code = id_code % max((n_id * 9) // 10, 1)
+    ids = np.array([ 'IOH%06d' % k for k in range(n_id) ], dtype=object)[id_code]
+    names = np.array([ 'G%d' % k for k in range(n_id) ], dtype=object)[name_code]
+    flags = np.where(rs.rand(n_spot) < BAD_FRACTION, FLAG_BAD, 0)
+    is_nd = (id_code % ND_EVERY == 0)
+    names[is_nd] = 'ND'
+    is_bsa = (spot % BSA_EVERY == 0)
+    (ids[is_bsa], names[is_bsa], flags[is_bsa]) = ('BSA', '', FLAG_BAD)
+    is_control = (spot % CONTROL_EVERY == 0)
+    (ids[is_control], names[is_control], flags[is_control]) = ('CONTROL', 'IgG', FLAG_BAD)
+    layout = { 'Block': spot // per_block + 1,
+               'Column': within % BLOCK_COLUMNS + 1,
+               'Row': within // BLOCK_COLUMNS + 1,
+               'ID': ids, 'Name': names, 'Flags': flags }
+    layout['X'] = (layout['Column'] + ((layout['Block'] - 1) % 4) * (BLOCK_COLUMNS + 2)) * SPOT_PITCH + rs.randint(-20, 21, n_spot)
+    layout['Y'] = (layout['Row'] + ((layout['Block'] - 1) // 4) * (BLOCK_ROWS + 2)) * SPOT_PITCH + rs.randint(-20, 21, n_spot)
+    is_clone_id = ~(is_control | is_bsa)
+    return(layout, id_code, is_clone_id)
+
+def plant_hits(design, layout, id_code, is_clone_id, n_hit, seed=0):
+    """
+    pick n_hit (clone, id) hits: the id binds the clone, so it is bright in every pool of the clone
+    return a dict pool -> array of id codes that are bright in the pool, and the hits as a data frame
+    with the clone name and the id as ID_Name, as in the intersection hits
+    """
+    rs = np.random.RandomState(seed + 1)
+    candidates = np.unique(id_code[is_clone_id & (layout['Name'] != 'ND')])
+    hit_ids = rs.choice(candidates, n_hit, replace=False)
+    hit_clones = rs.randint(0, design.n_clone, n_hit)
+    pool_ids = dict([ (p, [ ]) for p in design.pools ])
+    for (k, c) in zip(hit_ids, hit_clones):
+        for j in design.clone_pools[c]:
+            pool_ids[design.pools[j]].append(k)
+    id_names = dict(zip(id_code[is_clone_id], [ '%s_%s' % x for x in zip(layout['ID'][is_clone_id], layout['Name'][is_clone_id]) ]))
+    truth = DataFrame(data=[ ('pair', [ design.get_clone_name(c) for c in hit_clones ]),
+                             ('id', [ id_names[k] for k in hit_ids ]) ])
+    return(dict([ (p, np.array(v, dtype=int)) for (p, v) in pool_ids.items() ]), truth)
+
+def get_header(pool, n_column, seed):
+    """ the ATF header records of a gpr file, as GenePix Pro writes them """
+    records = [ 'Type=GenePix Results 3',
+        'DateTime=2012/06/21 %02d:%02d:%02d' % (9 + seed % 8, seed % 60, (7 * seed) % 60),
+        'Settings=C:\\GenePix\\pools.gps',
+        'GalFile=C:\\GenePix\\pools.gal',
+        'PixelSize=10',
+        'Wavelengths=635\t532',
+        'ImageFiles=C:\\GenePix\\%s.tif 0\tC:\\GenePix\\%s.tif 1' % (pool, pool),
+        'NormalizationMethod=None',
+        'NormalizationFactors=1\t1',
+        'JpegImage=C:\\GenePix\\%s.jpg' % pool,
+        'StdDev=Type 1',
+        'RatioFormulation=W1/W2 (635/532)',
+        'FeatureType=Circular',
+        'Barcode=%06d' % seed,
+        'BackgroundSubtraction=LocalFeature',
+        'ImageOrigin=0, 0',
+        'JpegOrigin=390, 4320',
+        'Creator=GenePix Pro 6.0.1.27',
+        'Scanner=GenePix 4000B [84948]',
+        'FocusPosition=0',
+        'Temperature=25.2',
+        'LinesAveraged=1',
+        'Comment=synthetic pool %s' % pool,
+        'PMTGain=600\t500',
+        'ScanPower=100\t100',
+        'LaserPower=3.43\t4.24',
+        'Filters=<Empty>\t<Empty>',
+        'ScanRegion=0,0,2160,7200',
+        'Supplier=' ]
+    lines = [ 'ATF\t1.0', '%d\t%d' % (len(records), n_column) ] + [ '"%s"' % r for r in records ]
+    return '\n'.join(lines) + '\n'
+
+def get_ratio(num, den):
+    """ ratio rounded as GenePix prints it, or Error where the denominator is not positive """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.round(num / den, 3)
+    ret = ratio.astype(object)
+    ret[~(den > 0)] = 'Error'
+    return ret
+
+def get_channel(rs, n_spot, fg_median, bg_median):
+    """ the measurements of one wavelength, given the foreground and background medians """
+    fg_mean = np.maximum(np.round(fg_median * rs.normal(1.0, 0.05, n_spot)), 0).astype(int)
+    bg_mean = np.round(bg_median * rs.normal(1.05, 0.03, n_spot)).astype(int)
+    fg_sd = np.round(fg_median * rs.uniform(0.1, 0.4, n_spot)).astype(int)
+    bg_sd = np.round(bg_median * rs.uniform(0.2, 0.5, n_spot)).astype(int)
+    above1 = np.clip(np.round(100.0 * (fg_median - bg_median) / np.maximum(fg_median, 1)), 0, 100).astype(int)
+    above2 = (above1 * rs.uniform(0.6, 0.9, n_spot)).astype(int)
+    sat = np.zeros(n_spot, dtype=int)
+    return(fg_mean, fg_sd, bg_mean, bg_sd, above1, above2, sat)
+
+def get_columns(layout, pool_ids, id_code, seed):
+    """ every column of GPR_COLUMNS for one array, in order """
+    rs = np.random.RandomState(seed)
+    n_spot = len(id_code)
+    bg635 = rs.randint(80, 200, n_spot)
+    bg532 = rs.randint(80, 200, n_spot)
+    fg635 = bg635 * rs.lognormal(0.3, 0.25, n_spot)
+    bright = np.in1d(id_code, pool_ids)
+    fg635[bright] *= rs.uniform(HIT_FOLD[0], HIT_FOLD[1], bright.sum())
+    # an occasional empty spot
+    fg635[rs.rand(n_spot) < 0.002] = 0
+    fg635 = np.round(fg635).astype(int)
+    fg532 = np.round(bg532 * rs.lognormal(0.5, 0.2, n_spot)).astype(int)
+    (f635_mean, f635_sd, b635_mean, b635_sd, a635_1, a635_2, s635) = get_channel(rs, n_spot, fg635, bg635)
+    (f532_mean, f532_sd, b532_mean, b532_sd, a532_1, a532_2, s532) = get_channel(rs, n_spot, fg532, bg532)
+    (d635, d532) = (fg635 - bg635, fg532 - bg532)
+    (dm635, dm532) = (f635_mean - bg635, f532_mean - bg532)
+    ratio_medians = get_ratio(d635.astype(float), d532.astype(float))
+    ratio_means = get_ratio(dm635.astype(float), dm532.astype(float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio = np.round(np.log2(d635.astype(float) / d532), 3).astype(object)
+    log_ratio[~((d635 > 0) & (d532 > 0))] = 'Error'
+    n_pixel = rs.randint(60, 120, n_spot)
+    values = { 'F635 Median': fg635, 'F635 Mean': f635_mean, 'F635 SD': f635_sd,
+        'B635 Median': bg635, 'B635 Mean': b635_mean, 'B635 SD': b635_sd,
+        '% > B635+1SD': a635_1, '% > B635+2SD': a635_2, 'F635 % Sat.': s635,
+        'F532 Median': fg532, 'F532 Mean': f532_mean, 'F532 SD': f532_sd,
+        'B532 Median': bg532, 'B532 Mean': b532_mean, 'B532 SD': b532_sd,
+        '% > B532+1SD': a532_1, '% > B532+2SD': a532_2, 'F532 % Sat.': s532,
+        'Ratio of Medians (635/532)': ratio_medians, 'Ratio of Means (635/532)': ratio_means,
+        'Median of Ratios (635/532)': ratio_medians, 'Mean of Ratios (635/532)': ratio_means,
+        'Ratios SD (635/532)': np.round(rs.uniform(0.5, 2.0, n_spot), 3),
+        'Rgn Ratio (635/532)': ratio_medians, 'Rgn R2 (635/532)': np.round(rs.uniform(0.0, 1.0, n_spot), 2),
+        'F Pixels': n_pixel, 'B Pixels': n_pixel * 6, 'Circularity': np.repeat(100, n_spot),
+        'Sum of Medians (635/532)': d635 + d532, 'Sum of Means (635/532)': dm635 + dm532,
+        'Log Ratio (635/532)': log_ratio,
+        'F635 Median - B635': d635, 'F532 Median - B532': d532,
+        'F635 Mean - B635': dm635, 'F532 Mean - B532': dm532,
+        'F635 Total Intensity': f635_mean * n_pixel, 'F532 Total Intensity': f532_mean * n_pixel,
+        'SNR 635': np.round((f635_mean - b635_mean) / np.maximum(b635_sd, 1.0), 2),
+        'SNR 532': np.round((f532_mean - b532_mean) / np.maximum(b532_sd, 1.0), 2),
+        'Dia.': np.repeat(100, n_spot), 'Normalize': np.zeros(n_spot, dtype=int), 'Autoflag': np.zeros(n_spot, dtype=int) }
+    for c in [ 'Block', 'Column', 'Row', 'X', 'Y', 'Flags' ]:
+        values[c] = layout[c]
+    # text fields are quoted
+    values['Name'] = np.array([ '"%s"' % x for x in layout['Name'] ], dtype=object)
+    values['ID'] = np.array([ '"%s"' % x for x in layout['ID'] ], dtype=object)
+    return [ values[c] for c in GPR_COLUMNS ]
+
+def write_gpr(filename, pool, columns, seed):
+    write_table(filename, [ '"%s"' % c for c in GPR_COLUMNS ], columns, \
+                preamble=get_header(pool, len(GPR_COLUMNS), seed))
+
+def write_experiment(out_dir, n_spot, design, n_hit, seed=0, pools=None):
+    """
+    write one gpr file for each pool of the design (or just pools, if given) into out_dir,
+    named like the scanner output so that deconv.create_map_file finds the pool,
+    plus control.txt with the controls and planted_hit.txt with the planted (clone, id) hits
+    return the planted hits as a data frame
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    (layout, id_code, is_clone_id) = get_layout(n_spot, seed)
+    (pool_ids, truth) = plant_hits(design, layout, id_code, is_clone_id, n_hit, seed)
+    if pools is None:
+        pools = design.pools
+    for (k, p) in enumerate(design.pools):
+        if p not in pools:
+            continue
+        filename = os.path.join(out_dir, '%d_2012-06-21_%s_synth.gpr' % (2000000000 + 1000 * seed + k, p))
+        logger.info('%s: %d spots, %d bright ids', filename, n_spot, len(pool_ids[p]))
+        write_gpr(filename, p, get_columns(layout, pool_ids[p], id_code, seed * 1000 + k + 2), seed * 1000 + k)
+    DataFrame(data=[ ('id', [ 'CONTROL', 'BSA' ]), ('name', [ 'IgG', '' ]) ]).write(os.path.join(out_dir, 'control.txt'))
+    truth.write(os.path.join(out_dir, 'planted_hit.txt'))
+    return truth
+
+ap = argparse.ArgumentParser(description='Write synthetic gpr files, one for each pool of a pooling design, with planted hits.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('out_dir', help='directory for writing the gpr files, control.txt and planted_hit.txt')
+ap.add_argument('--n_spot', type=int, default=10000, help='spots per array, 10000 to 1000000 are typical (default: %(default)s)')
+ap.add_argument('--n_hit', type=int, default=24, help='number of planted (clone, id) hits (default: %(default)s)')
+ap.add_argument('--design', default=DEFAULT_DESIGN, help='pooling design, as for deconv.py (default: %(default)s)')
+ap.add_argument('--seed', type=int, default=0, help='random seed; the same seed writes the same files (default: %(default)s)')
+
+def main(args):
+    write_experiment(args.out_dir, args.n_spot, get_design(args.design), args.n_hit, args.seed)
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    main(args)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Group-by reductions on factorized group codes
+joel.bader@jhu.edu
+"""
+
+import logging
+import numpy as np
+
+from categorical import Categorical
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='groupby')
+logger.setLevel(logging.INFO)
+
+GROUP_STATS = [ 'count', 'sum', 'mean', 'std', 'stouffer' ]
+# block size of numpy's pairwise summation
+PAIRWISE_BLOCK = 8
+
+class GroupBy:
+    """
+    rows grouped by a key, for example the idname of each spot
+    keys are factorized once into integer codes: groups are numbered in order of first
+    appearance, and the rows of a group keep their original order
+    reductions index the rows sorted by group, so each statistic costs a few numpy passes
+    instead of one python call per group
+    a Categorical key is factorized on its integer codes, without comparing strings
+    """
+    def __init__(self, keys):
+        categories = None
+        if isinstance(keys, Categorical):
+            (keys, categories) = (keys.codes, keys.categories)
+        keys = np.asarray(keys)
+        self.n_row = len(keys)
+        if self.n_row == 0:
+            self.keys = keys if categories is None else categories[:0]
+            self.codes = np.zeros(0, dtype=int)
+        else:
+            (uniques, first, codes) = np.unique(keys, return_index=True, return_inverse=True)
+            if categories is not None:
+                uniques = categories[uniques]
+            # renumber the groups in order of first appearance
+            order = np.argsort(first, kind='mergesort')
+            rank = np.empty(len(order), dtype=int)
+            rank[order] = np.arange(len(order))
+            self.keys = uniques[order]
+            self.codes = rank[codes]
+        self.n_group = len(self.keys)
+        self.counts = np.bincount(self.codes, minlength=self.n_group)
+        # stable sort keeps the original row order within each group
+        self.sort_index = np.argsort(self.codes, kind='mergesort')
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def get_index(self):
+        """ dict from key to group number """
+        return dict(zip(self.keys, range(self.n_group)))
+
+    def lookup(self, keys):
+        """ group number of each of keys, which must all be group keys, found by binary search """
+        keys = np.asarray(keys)
+        if len(keys) == 0:
+            return np.zeros(0, dtype=int)
+        order = np.argsort(self.keys, kind='mergesort')
+        pos = order[np.searchsorted(self.keys[order], keys)]
+        assert(np.all(self.keys[pos] == keys)), 'keys that are not group keys'
+        return pos
+
+    def broadcast(self, group_values):
+        """ the value of each row's group """
+        return np.asarray(group_values)[self.codes]
+
+    def split(self, values, groups=None):
+        """ list with the values of each group, or of each of the group numbers in groups, in row order """
+        if groups is not None:
+            rows = [ self.sort_index[self.starts[g]:(self.starts[g] + self.counts[g])] for g in groups ]
+            return [ np.asarray(values)[r] for r in rows ]
+        values = np.asarray(values)[self.sort_index]
+        return np.split(values, self.starts[1:])
+
+    def sum(self, values):
+        """
+        sum of each group, adding in the same order as np.sum so that means match np.mean exactly:
+        numpy's pairwise summation is a running sum for fewer than PAIRWISE_BLOCK elements,
+        and the few larger groups are summed one at a time with np.add.reduce
+        """
+        if self.n_group == 0:
+            return np.zeros(0)
+        values = np.asarray(values, dtype=float)[self.sort_index]
+        total = np.zeros(self.n_group)
+        small = self.counts < PAIRWISE_BLOCK
+        for k in range(min(self.counts.max(), PAIRWISE_BLOCK)):
+            has_k = small & (self.counts > k)
+            total[has_k] += values[self.starts[has_k] + k]
+        for g in np.nonzero(~small)[0]:
+            total[g] = np.add.reduce(values[self.starts[g]:(self.starts[g] + self.counts[g])])
+        return total
+
+    def max(self, values):
+        """ largest value of each group, nan if the group has a nan """
+        if self.n_group == 0:
+            return np.zeros(0)
+        values = np.asarray(values, dtype=float)[self.sort_index]
+        return np.maximum.reduceat(values, self.starts)
+
+    def mean(self, values):
+        return self.sum(values) / self.counts
+
+    def std(self, values, ddof=0):
+        """ standard deviation within each group, ddof as for np.std """
+        values = np.asarray(values, dtype=float)
+        dev = values - self.broadcast(self.mean(values))
+        return np.sqrt(self.sum(dev * dev) / (self.counts - ddof))
+
+    def stouffer(self, zscores):
+        """ stouffer's combined z-score, sum(z) / sqrt(n), for the replicates in each group """
+        return self.sum(zscores) / np.sqrt(self.counts)
+
+    def aggregate(self, values, stats=('mean',), ddof=0):
+        """
+        stats is a list of names from GROUP_STATS
+        return a dict of stat -> (value for each group, value broadcast to each row)
+        the group sum is computed once and shared by sum, mean, std and stouffer
+        """
+        for s in stats:
+            assert(s in GROUP_STATS), 'unknown group statistic %s' % s
+        values = np.asarray(values, dtype=float)
+        total = self.sum(values)
+        mean = total / self.counts
+        ret = dict()
+        for s in stats:
+            if s == 'count':
+                by_group = self.counts
+            elif s == 'sum':
+                by_group = total
+            elif s == 'mean':
+                by_group = mean
+            elif s == 'std':
+                dev = values - self.broadcast(mean)
+                by_group = np.sqrt(self.sum(dev * dev) / (self.counts - ddof))
+            elif s == 'stouffer':
+                by_group = total / np.sqrt(self.counts)
+            ret[s] = (by_group, self.broadcast(by_group))
+        return ret
@@ -7,29 +7,60 @@ joel.bader@jhu.edu
 import os
 import subprocess
 import copy
-from dataframe import DataFrame
+import argparse
+from dataframe import DataFrame, BINARY_EXT, get_text_name
+from pooldesign import get_design, DEFAULT_DESIGN
 
 import logging
 logging.basicConfig(format='%(funcName)s: %(message)s')
 logger = logging.getLogger(name='deconv')
 logger.setLevel(logging.INFO)
 
+ap = argparse.ArgumentParser(description='Write the intersection hits of each run in RESULTS_DIR as a grid of pools.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('results_dir', nargs='?', default='/Users/joel/Dropbox/GPR_files/results', help='directory with the intersection hit lists (default: %(default)s)')
+ap.add_argument('--old_prefix', default='intersection_hit', help='prefix of the hit lists (default: %(default)s)')
+ap.add_argument('--new_prefix', default='intersection_grid', help='prefix of the grids, replacing OLD_PREFIX (default: %(default)s)')
+ap.add_argument('--design', default=DEFAULT_DESIGN, help='pooling design, as for deconv.py; only 2-D designs have a grid (default: %(default)s)')
 
-def make_grid_for_file(results_dir, list_file, grid_file):
-    POOL_DIRECTIONS = ['H', 'V']
-    POOL_RANGE = range(1, 13)
-    logger.info('%s => %s', list_file, grid_file)
+def get_pool_key(pool):
+    """ sort key of a pool name, direction then number, so that H2 comes before H10 """
+    direction = pool.rstrip('0123456789')
+    number = pool[len(direction):]
+    return (direction, int(number) if number else -1)
+
+def make_grid_for_file(results_dir, list_file, grid_file, design=None):
+    """
+    write the hits of a 2-D design as a grid, one row for each pool of the first layer
+    and one column for each pool of the second
+    the pools are those of design, a PoolDesign, or if design is None those named by the pairs in the file;
+    designs with other than two layers and the batch table of several runs are skipped
+    """
+    if (design is not None) and (design.n_layer != 2):
+        logger.info('skipping %s, design %s has %d layers, not 2', list_file, design.name, design.n_layer)
+        return
     df = DataFrame(filename=os.path.join(results_dir, list_file))
+    if 'run' in df.headers:
+        logger.info('skipping %s, a batch table of several runs', list_file)
+        return
     (pair, id) = df.get_columns('pair', 'id')
+    pools = [ p.split(' x ') for p in pair ]
+    if any([ len(p) != 2 for p in pools ]):
+        logger.info('skipping %s, pairs are not from a 2-D design', list_file)
+        return
+    logger.info('%s => %s', list_file, grid_file)
     logger.info('%d hits', len(pair))
-    col_names = [ 'V' + str(i) for i in POOL_RANGE ]
-    row_names = [ 'H' + str(i) for i in POOL_RANGE ]
+    if design is not None:
+        (row_names, col_names) = design.layer_pools
+    else:
+        row_names = sorted(set([ p[0] for p in pools ]), key=get_pool_key)
+        col_names = sorted(set([ p[1] for p in pools ]), key=get_pool_key)
     data_dict = dict() # will hold a list of the hits for each row, column pair
     for r in row_names:
         for c in col_names:
             data_dict[(r,c)] = [ ]
-    for (mypair, myid) in zip(pair, id):
-        (horiz, vert) = mypair.split(' x ')
+    for ((horiz, vert), myid) in zip(pools, id):
+        assert((horiz, vert) in data_dict), 'pair %s x %s of %s is not in design %s' % (horiz, vert, list_file, design.name)
         data_dict[(horiz, vert)] = data_dict[(horiz, vert)] + [ myid ]
     # now build a new data frame as a list of tuples, column name and column list
     data_by_column = [ ]
@@ -57,19 +88,21 @@ def get_files_with_prefix(directory, prefix):
     match_files = [ f for f in all_files if match_prefix(f, prefix)]
     return match_files
 
-def make_grid_for_dir(results_dir, old_prefix, new_prefix):
+def make_grid_for_dir(results_dir, old_prefix, new_prefix, design=None):
     # get the list of files to process
     logger.info('working on directory %s', results_dir)
     match_files = get_files_with_prefix(results_dir, old_prefix)
     for list_file in match_files:
-        grid_file = new_prefix + list_file[ len(old_prefix) : ]
-        make_grid_for_file(results_dir, list_file, grid_file)
+        (base, ext) = os.path.splitext(list_file)
+        # read the binary copy written by deconv when there is one, instead of the text
+        if (ext != BINARY_EXT) and (base + BINARY_EXT in match_files):
+            continue
+        grid_file = get_text_name(new_prefix + list_file[ len(old_prefix) : ])
+        make_grid_for_file(results_dir, list_file, grid_file, design)
 
-def main(results_dir, old_prefix, new_prefix):
-    make_grid_for_dir(results_dir, old_prefix, new_prefix)
+def main(results_dir, old_prefix, new_prefix, design=None):
+    make_grid_for_dir(results_dir, old_prefix, new_prefix, design)
 
 if __name__ == '__main__':
-    results_dir = '/Users/joel/Dropbox/GPR_files/results'
-    old_prefix = 'intersection_hit'
-    new_prefix = 'intersection_grid'
-    main(results_dir, old_prefix, new_prefix)
+    args = ap.parse_args()
+    main(args.results_dir, args.old_prefix, args.new_prefix, get_design(args.design))
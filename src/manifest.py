@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Run manifest for a deconv results directory
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import json
+import tempfile
+import hashlib
+
+from gpr_cache import get_sha1
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='manifest')
+logger.setLevel(logging.INFO)
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+
+def get_control_sha1(control_dict):
+    """ hash of the control (id, name) pairs, independent of dict order; a ControlIndex has it already """
+    if getattr(control_dict, 'sha1', None) is not None:
+        return control_dict.sha1
+    sha1 = hashlib.sha1()
+    for (i, n) in sorted(control_dict.keys()):
+        sha1.update(('%s\t%s\n' % (i, n)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def get_file_sha1(filename):
+    """ sha1 of the file, or None if it does not exist; a directory hashes the names and hashes of its files """
+    if os.path.isdir(filename):
+        sha1 = hashlib.sha1()
+        for name in sorted(os.listdir(filename)):
+            sha1.update(('%s\t%s\n' % (name, get_file_sha1(os.path.join(filename, name)))).encode('utf-8'))
+        return sha1.hexdigest()
+    if not os.path.isfile(filename):
+        return None
+    return get_sha1(filename)
+
+class RunManifest:
+    """
+    record of what produced the files in a results directory, stored as RESULTS_DIR/manifest.json
+    params: the effective settings (signal and norm columns, norm/log flags, control hash)
+    files: for each gpr file name, its content hash and the output files written from it
+    deconv: content hashes of the map and summary files read by the deconvolution, and its outputs
+    a rerun with the same params only redoes gpr files whose hash changed or whose outputs are missing,
+    and only redoes the deconvolution if one of its inputs changed
+    """
+    def __init__(self, results_dir):
+        self.filename = os.path.join(results_dir, MANIFEST_FILENAME)
+        self.params = None
+        self.files = dict()
+        self.deconv = None
+        if os.path.isfile(self.filename):
+            fp = open(self.filename, 'r')
+            try:
+                data = json.load(fp)
+            except ValueError:
+                logger.warn('ignoring unreadable manifest %s', self.filename)
+                data = dict()
+            fp.close()
+            if data.get('version') == MANIFEST_VERSION:
+                self.params = data['params']
+                self.files = data['files']
+                self.deconv = data['deconv']
+
+    def set_params(self, params, force=False):
+        """ start over if the params changed or if force is True """
+        if force or (params != self.params):
+            if self.params is not None:
+                logger.info('%s: %s, rebuilding everything', self.filename, 'forced' if force else 'parameters changed')
+            self.params = params
+            self.files = dict()
+            self.deconv = None
+
+    def is_current(self, name, sha1, outputs):
+        """ True if the gpr file name with hash sha1 already produced outputs, and they exist """
+        entry = self.files.get(name)
+        if (entry is None) or (entry['sha1'] != sha1) or (entry['outputs'] != outputs):
+            return False
+        return all([ os.path.exists(f) for f in outputs ])
+
+    def set_file(self, name, sha1, outputs):
+        self.files[name] = { 'sha1': sha1, 'outputs': outputs }
+
+    def keep_files(self, names):
+        """ forget gpr files that are no longer in the data directory """
+        for name in list(self.files.keys()):
+            if name not in names:
+                logger.info('%s: %s is gone', self.filename, name)
+                del self.files[name]
+
+    def get_deconv_inputs(self, filenames):
+        """ dict of filename to content hash for the files read by the deconvolution """
+        return dict([ (f, get_file_sha1(f)) for f in filenames ])
+
+    def is_deconv_current(self, inputs):
+        if (self.deconv is None) or (self.deconv['inputs'] != inputs):
+            return False
+        return all([ os.path.exists(f) for f in self.deconv['outputs'] ])
+
+    def set_deconv(self, inputs, outputs):
+        self.deconv = { 'inputs': inputs, 'outputs': outputs }
+
+    def write(self):
+        """ write under a temporary name and rename, so that an interrupted run leaves the old manifest """
+        data = { 'version': MANIFEST_VERSION, 'params': self.params,
+                 'files': self.files, 'deconv': self.deconv }
+        (fd, tmp_file) = tempfile.mkstemp(prefix='.tmp-', suffix='.json', dir=os.path.dirname(self.filename) or '.')
+        fp = os.fdopen(fd, 'w')
+        json.dump(data, fp, indent=1, sort_keys=True)
+        fp.close()
+        os.rename(tmp_file, self.filename)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Pooling designs: which pools each clone is in, and decoding clones from pool hits
+joel.bader@jhu.edu
+"""
+
+import logging
+import itertools
+import numpy as np
+
+from dataframe import DataFrame
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='pooldesign')
+logger.setLevel(logging.INFO)
+
+# a hit must have zscore at least this large in every pool of a clone
+THRESHOLD = 2.5
+
+class PoolDesign:
+    """
+    a pooling design has layers, each a direction with its own pools, for example H1..H12 and V1..V12;
+    every clone is in exactly one pool of each layer
+    layers is a list of (direction, pool names)
+    clones is an int array with one row per clone and one column per layer giving the
+    position of the clone's pool within the layer, or None for a full grid, every combination of pools
+    an id is decoded to a clone when it is a hit in every pool of the clone
+    """
+    def __init__(self, layers, clones=None, name=None):
+        self.directions = [ d for (d, pools) in layers ]
+        self.layer_pools = [ list(pools) for (d, pools) in layers ]
+        self.n_layer = len(layers)
+        self.pools = [ p for pools in self.layer_pools for p in pools ]
+        self.n_pool = len(self.pools)
+        # first pool index of each layer within self.pools
+        self.layer_start = np.cumsum([ 0 ] + [ len(x) for x in self.layer_pools ])[:-1]
+        if clones is None:
+            clones = list(itertools.product(*[ range(len(x)) for x in self.layer_pools ]))
+        self.clones = np.array(clones, dtype=int).reshape(-1, self.n_layer)
+        self.n_clone = len(self.clones)
+        # pool index of each clone in each layer
+        self.clone_pools = self.clones + self.layer_start
+        self.name = name
+        if self.name is None:
+            self.name = 'x'.join([ '%s%d' % (d, len(x)) for (d, x) in zip(self.directions, self.layer_pools) ])
+        self.pool_set = set(self.pools)
+
+    def get_pool_name(self, p):
+        """ the design's name for pool p, allowing numbers written differently such as H01 for H1, or None """
+        if p in self.pool_set:
+            return p
+        for d in self.directions:
+            if p.startswith(d) and (len(p) > len(d)):
+                try:
+                    name = d + str(int(p[len(d):]))
+                except ValueError:
+                    continue
+                if name in self.pool_set:
+                    return name
+        return None
+
+    def is_valid_pool_name(self, p):
+        return self.get_pool_name(p) is not None
+
+    def get_layer_pools(self, direction):
+        return self.layer_pools[self.directions.index(direction)]
+
+    def get_clone_name(self, clone):
+        """ the pools of a clone joined by ' x ', for example H1 x V4 """
+        return ' x '.join([ self.pools[j] for j in self.clone_pools[clone] ])
+
+    def decode(self, pool_hit, threshold=THRESHOLD):
+        """
+        pool_hit is a PoolHit with the hits of each pool
+        return a dict clone name -> id -> zscore and ratio in each direction, and the same as
+        a data frame with columns pair (the clone name), id, then zscore and ratio for each direction,
+        clones in design order and ids sorted within each clone
+        """
+        (ids, id_code, pool_index, zscore, ratio) = get_hit_incidence(pool_hit, self)
+        # a nan zscore is not below the threshold
+        with np.errstate(invalid='ignore'):
+            good = np.flatnonzero(~(zscore < threshold))
+        (id_code, pool_index, zscore, ratio) = (id_code[good], pool_index[good], zscore[good], ratio[good])
+
+        # candidates: each hit in a first-layer pool with each clone in that pool
+        first = np.flatnonzero(pool_index < self.layer_start[1]) if self.n_layer > 1 else np.arange(len(pool_index))
+        (i, clone) = join_codes(pool_index[first], self.clone_pools[:, 0])
+        hit_rows = [ first[i] ]
+
+        # keep the candidates that are also hits in the clone's pool in every other layer
+        key = id_code * self.n_pool + pool_index
+        key_order = np.argsort(key)
+        sorted_key = key[key_order]
+        for layer in range(1, self.n_layer):
+            need = id_code[hit_rows[0]] * self.n_pool + self.clone_pools[clone, layer]
+            pos = np.minimum(np.searchsorted(sorted_key, need), max(len(sorted_key) - 1, 0))
+            found = (sorted_key[pos] == need) if len(sorted_key) > 0 else np.zeros(len(need), dtype=bool)
+            clone = clone[found]
+            hit_rows = [ r[found] for r in hit_rows ] + [ key_order[pos[found]] ]
+
+        order = np.lexsort((id_code[hit_rows[0]], clone))
+        clone = clone[order]
+        hit_rows = [ r[order] for r in hit_rows ]
+
+        pair_list = [ self.get_clone_name(c) for c in clone ]
+        id_list = [ str(x) for x in ids[id_code[hit_rows[0]]] ]
+        zscore_lists = [ zscore[r] for r in hit_rows ]
+        ratio_lists = [ ratio[r] for r in hit_rows ]
+
+        intersection_hit = dict()
+        for (k, (pair, id)) in enumerate(zip(pair_list, id_list)):
+            logger.info('%s %s %s', pair, id, ' '.join([ '%f' % z[k] for z in zscore_lists ]))
+            if pair not in intersection_hit:
+                intersection_hit[pair] = dict()
+            hit = dict()
+            for (d, z, r) in zip(self.directions, zscore_lists, ratio_lists):
+                hit['zscore_' + d] = z[k]
+                hit['ratio_' + d] = r[k]
+            intersection_hit[pair][id] = hit
+        data = [ ('pair', pair_list), ('id', id_list) ]
+        data += [ ('zscore_' + d.lower(), z) for (d, z) in zip(self.directions, zscore_lists) ]
+        data += [ ('ratio_' + d.lower(), r) for (d, r) in zip(self.directions, ratio_lists) ]
+        logger.info('%d clone hits for %d clones in design %s', len(pair_list), len(intersection_hit), self.name)
+        return(intersection_hit, DataFrame(data=data))
+
+class PoolHit:
+    """
+    the hits of every pool as a sparse id x pool incidence, one entry for each (pool, id) hit
+    pools are the pool names, one for each summary file, and pool_index, ids, zscore and ratio are arrays
+    with, for each hit, the index of its pool in pools, its id, and its zscore and ratio
+    """
+    def __init__(self, pools, pool_index, ids, zscore, ratio):
+        self.pools = list(pools)
+        self.pool_index = np.asarray(pool_index, dtype=int)
+        self.ids = np.asarray(ids)
+        self.zscore = np.asarray(zscore, dtype=float)
+        self.ratio = np.asarray(ratio, dtype=float)
+
+    def __len__(self):
+        return len(self.pool_index)
+
+def get_hit_incidence(pool_hit, design):
+    """
+    the hits of pool_hit, a PoolHit, in the pools of design; hits in other pools are dropped
+    return (ids, id_code, pool_index, zscore, ratio):
+    ids are the sorted unique ids and id_code indexes them, pool_index indexes design.pools,
+    and zscore and ratio are the values for each hit
+    """
+    design_index = dict(zip(design.pools, range(design.n_pool)))
+    pool_map = np.array([ design_index.get(design.get_pool_name(str(p)), -1) for p in pool_hit.pools ] + [ -1 ], dtype=int)
+    pool_index = pool_map[pool_hit.pool_index]
+    keep = np.flatnonzero(pool_index >= 0)
+    if len(keep) == 0:
+        (ids, id_code) = (np.array([], dtype=str), np.zeros(0, dtype=int))
+    else:
+        (ids, id_code) = np.unique(pool_hit.ids[keep], return_inverse=True)
+    return(ids, id_code, pool_index[keep], pool_hit.zscore[keep], pool_hit.ratio[keep])
+
+def join_codes(codes_a, codes_b):
+    """
+    every pair (i, j) with codes_a[i] == codes_b[j], as two index arrays ordered by i
+    """
+    order_b = np.argsort(codes_b, kind='mergesort')
+    sorted_b = codes_b[order_b]
+    left = np.searchsorted(sorted_b, codes_a, 'left')
+    n_match = np.searchsorted(sorted_b, codes_a, 'right') - left
+    i = np.repeat(np.arange(len(codes_a)), n_match)
+    # position of each pair within the matches for its i
+    offset = np.arange(len(i)) - np.repeat(np.cumsum(n_match) - n_match, n_match)
+    j = order_b[np.repeat(left, n_match) + offset]
+    return(i, j)
+
+def grid_design(n, directions='HV'):
+    """ n pools in each direction, one clone for every combination: the standard 12 x 12 is grid_design(12) """
+    layers = [ (d, [ d + str(i) for i in range(1, n + 1) ]) for d in directions ]
+    return PoolDesign(layers, name='grid:%d:%s' % (n, directions))
+
+def std_design(n_clone, q, n_layer, directions='ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+    """
+    shifted transversal design (Thierry-Mieg 2006) for n_clone clones with n_layer layers of q pools, q prime
+    clone i has base-q digits i_c, and in layer j it is in pool sum_c i_c j^c mod q
+    """
+    assert(n_layer <= q), 'at most q=%d layers, got %d' % (q, n_layer)
+    assert(all([ q % k != 0 for k in range(2, q) ]) and (q > 1)), 'q must be prime, got %d' % q
+    n_digit = 1
+    while q ** n_digit < n_clone:
+        n_digit += 1
+    clone = np.arange(n_clone)
+    digits = [ (clone // (q ** c)) % q for c in range(n_digit) ]
+    clones = np.zeros((n_clone, n_layer), dtype=int)
+    for j in range(n_layer):
+        for c in range(n_digit):
+            clones[:, j] += digits[c] * (j ** c)
+        clones[:, j] %= q
+    layers = [ (d, [ d + str(i) for i in range(1, q + 1) ]) for d in directions[:n_layer] ]
+    return PoolDesign(layers, clones, name='std:%d:%d:%d' % (n_clone, q, n_layer))
+
+DEFAULT_DESIGN = 'grid:12:HV'
+
+def get_design(spec=DEFAULT_DESIGN):
+    """
+    design from a command-line spec:
+    grid:N[:DIRECTIONS], for example grid:12:HV (the default), grid:24, grid:12:HVD for 3-D
+    std:N_CLONE:Q:N_LAYER, a shifted transversal design
+    """
+    toks = spec.split(':')
+    if toks[0] == 'grid' and len(toks) in (2, 3):
+        directions = toks[2] if len(toks) == 3 else 'HV'
+        return grid_design(int(toks[1]), directions)
+    if toks[0] == 'std' and len(toks) == 4:
+        return std_design(int(toks[1]), int(toks[2]), int(toks[3]))
+    assert(False), 'bad design %s, expected grid:N[:DIRECTIONS] or std:N_CLONE:Q:N_LAYER' % spec
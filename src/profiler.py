@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Wall time, cpu time and peak memory of the stages of an analysis
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import sys
+import time
+import json
+import resource
+import contextlib
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='profiler')
+logger.setLevel(logging.INFO)
+
+PROFILE_VERSION = 1
+PROFILE_FILENAME = 'profile.json'
+PROFILE_DUMP_FILENAME = 'profile_slowest.prof'
+
+def reset_peak():
+    """
+    start a new peak memory measurement; linux resets the peak resident memory
+    when 5 is written to /proc/self/clear_refs, elsewhere the peak is that of the whole process
+    """
+    try:
+        fp = open('/proc/self/clear_refs', 'w')
+        fp.write('5')
+        fp.close()
+    except IOError:
+        pass
+
+def get_peak_mb():
+    """ peak resident memory in MB since reset_peak, or since the process started """
+    try:
+        fp = open('/proc/self/status', 'r')
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                fp.close()
+                return int(line.split()[1]) / 1024.0
+        fp.close()
+    except IOError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, os x bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def get_cpu():
+    """ user plus system cpu seconds of this process """
+    t = os.times()
+    return t[0] + t[1]
+
+class StageProfiler:
+    """
+    records the wall time, cpu time and peak memory of each stage, used as
+        with profiler.stage('parse', file=input_file):
+            gpr = GPR(input_file)
+    each record is a dict with stage, wall, cpu and peak_mb, plus the keyword arguments of stage
+    a profiler made with enabled=False records nothing and costs nothing
+    stages may nest; the peak memory of the outer stage is then only from the end of the inner one
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = [ ]
+
+    @contextlib.contextmanager
+    def stage(self, name, **context):
+        if not self.enabled:
+            yield
+            return
+        reset_peak()
+        (wall, cpu) = (time.time(), get_cpu())
+        try:
+            yield
+        finally:
+            record = dict(context)
+            record.update({ 'stage': name, 'wall': time.time() - wall, 'cpu': get_cpu() - cpu, 'peak_mb': get_peak_mb() })
+            self.records.append(record)
+
+    def get_records(self, results_dir=None):
+        """ records for results_dir and records shared by every results directory, or all records """
+        if results_dir is None:
+            return list(self.records)
+        return [ r for r in self.records if r.get('results_dir') in (None, results_dir) ]
+
+    def get_slowest(self, stage='file', key='file'):
+        """ the value of key, for example the input file, for the slowest record of stage, or None """
+        records = [ r for r in self.records if r['stage'] == stage ]
+        if len(records) == 0:
+            return None
+        return max(records, key=lambda r: r['wall'])[key]
+
+# the profiler used when profiling is off
+NO_PROFILE = StageProfiler(enabled=False)
+
+def get_totals(records):
+    """ dict stage -> total wall, cpu, largest peak_mb and count """
+    totals = dict()
+    for r in records:
+        t = totals.setdefault(r['stage'], { 'wall': 0.0, 'cpu': 0.0, 'peak_mb': 0.0, 'count': 0 })
+        t['wall'] += r['wall']
+        t['cpu'] += r['cpu']
+        t['peak_mb'] = max(t['peak_mb'], r['peak_mb'])
+        t['count'] += 1
+    return totals
+
+def write_report(filename, records):
+    """ json report with every record and the totals for each stage """
+    report = { 'version': PROFILE_VERSION, 'records': records, 'totals': get_totals(records) }
+    fp = open(filename, 'w')
+    json.dump(report, fp, indent=1, sort_keys=True)
+    fp.close()
+    logger.info('wrote %d profile records to %s', len(records), filename)
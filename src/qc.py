@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Quality-control summary of the ids, names and flags of a gpr file
+joel.bader@jhu.edu
+"""
+
+import logging
+import json
+import argparse
+import numpy as np
+
+from gpr import GPR
+from dataframe import DataFrame
+from categorical import factorize
+from spotmask import FLAG_BAD
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='qc')
+logger.setLevel(logging.INFO)
+
+# names with at least this many ids, and ids with at least this many rows, are listed
+MANY = 6
+
+def get_hist(counts):
+    """ list of [count, number of keys with that count], sorted by count """
+    (values, n_key) = np.unique(counts, return_counts=True)
+    return [ [ int(v), int(n) ] for (v, n) in zip(values, n_key) ]
+
+def get_last_code(id_code, name_code, n_id):
+    """ for each id code, the name code on its last row, or -1 for ids without rows """
+    last = -np.ones(n_id, dtype=int)
+    (codes, first) = np.unique(id_code[::-1], return_index=True)
+    last[codes] = name_code[::-1][first]
+    return last
+
+def get_mask_summary(id_keys, id_code, name_keys, name_code, masked, many=MANY):
+    """
+    summary of the rows with one mask value, given the factorized ids and names of those rows:
+    histograms of ids per name, rows per name and rows per id,
+    names with at least many ids and ids with at least many rows
+    """
+    (n_id, n_name) = (len(id_keys), len(name_keys))
+    id_cnt = np.bincount(id_code, minlength=n_id)
+    name_cnt = np.bincount(name_code, minlength=n_name)
+    # codes are int32, so the pair product is taken in int64 as in categorical.join_pairs
+    pairs = np.unique(id_code.astype(np.int64) * n_name + name_code)
+    name_idcnt = np.bincount(pairs % n_name, minlength=n_name) if n_name > 0 else np.zeros(0, dtype=int)
+    last_name = get_last_code(id_code, name_code, n_id)
+    (has_id, has_name) = (id_cnt > 0, name_cnt > 0)
+    many_ids = np.flatnonzero(has_name & (name_idcnt >= many))
+    many_rows = np.flatnonzero(has_id & (id_cnt >= many))
+    return {
+        'masked': masked,
+        'n_row': len(id_code),
+        'ids_per_name': get_hist(name_idcnt[has_name]),
+        'rows_per_name': get_hist(name_cnt[has_name]),
+        'rows_per_id': get_hist(id_cnt[has_id]),
+        'names_with_many_ids': [ [ str(name_keys[j]), int(name_idcnt[j]) ] for j in many_ids ],
+        'ids_with_many_rows': [ [ str(name_keys[last_name[i]]), str(id_keys[i]), int(id_cnt[i]) ] for i in many_rows ],
+    }
+
+def get_summary(gpr, filename=None, many=MANY):
+    """
+    qc summary of a gpr file as a dict of lists, ready for json, labeled with filename
+    masks: a summary from get_mask_summary for the unmasked rows, then for the rows with Flags <= FLAG_BAD
+    multi_mask_ids: [id, name, number of mask values] for ids that are masked on some rows and not others,
+    with the name from the last masked row
+    ids and names are categorical, and everything else is counted on their integer codes
+    """
+    (ids, names, flags) = gpr.get_columns(['ID', 'Name', 'Flags'])
+    (ids, names) = (factorize(ids), factorize(names))
+    (id_keys, id_code) = (ids.categories, ids.codes)
+    (name_keys, name_code) = (names.categories, names.codes)
+    is_masked = np.asarray(flags) <= FLAG_BAD
+    masks = [ get_mask_summary(id_keys, id_code[is_masked == m], name_keys, name_code[is_masked == m], m, many) \
+              for m in (False, True) ]
+    # ids on both masked and unmasked rows
+    n_id = len(id_keys)
+    both = np.flatnonzero((np.bincount(id_code[~is_masked], minlength=n_id) > 0) & \
+                          (np.bincount(id_code[is_masked], minlength=n_id) > 0))
+    last_name = get_last_code(id_code[is_masked], name_code[is_masked], n_id)
+    return {
+        'filename': filename,
+        'n_row': gpr.n_row,
+        'masks': masks,
+        'multi_mask_ids': [ [ str(id_keys[i]), str(name_keys[last_name[i]]), 2 ] for i in both ],
+    }
+
+def print_summary(summary):
+    """ print the summary in the format of the original GPR.print_summary """
+    def print_hist(hist, key_str, value_str):
+        print '%s\t%s' % (key_str, value_str)
+        for (k, v) in hist:
+            print '%d\t%d' % (k, v)
+
+    for mask in summary['masks']:
+        masked = mask['masked']
+        print '\nhistogram for mask = ' + str(masked)
+        print_hist(mask['ids_per_name'], 'ids_per_name', 'number_of_names')
+        print_hist(mask['rows_per_name'], 'rows_per_name', 'number_of_names')
+        print_hist(mask['rows_per_id'], 'rows_per_id', 'number_of_ids')
+
+        print '\nnames with many ids for mask = ' + str(masked)
+        for (name, cnt) in mask['names_with_many_ids']:
+            print '%s\t%d' % (name, cnt)
+
+        print '\nids with many rows for mask = ' + str(masked)
+        for (name, id, cnt) in mask['ids_with_many_rows']:
+            print '%s\t%s\t%d' % (name, id, cnt)
+
+    print 'checking for ids with multiple mask values'
+    for (id, name, nkey) in summary['multi_mask_ids']:
+        print 'id %s named %s has %d masks' % (id, name, nkey)
+
+def get_table(summaries):
+    """ data frame with one row of counts for each summary, for comparing many arrays """
+    def get_max(hist):
+        return hist[-1][0] if len(hist) > 0 else 0
+    data = [ ('filename', [ s['filename'] for s in summaries ]),
+             ('n_row', [ s['n_row'] for s in summaries ]) ]
+    for mask in (False, True):
+        suffix = '_masked' if mask else '_unmasked'
+        rows = [ [ m for m in s['masks'] if m['masked'] == mask ][0] for s in summaries ]
+        data += [ ('n_row' + suffix, [ m['n_row'] for m in rows ]),
+                  ('n_name' + suffix, [ sum([ n for (k, n) in m['rows_per_name'] ]) for m in rows ]),
+                  ('n_id' + suffix, [ sum([ n for (k, n) in m['rows_per_id'] ]) for m in rows ]),
+                  ('max_ids_per_name' + suffix, [ get_max(m['ids_per_name']) for m in rows ]),
+                  ('max_rows_per_id' + suffix, [ get_max(m['rows_per_id']) for m in rows ]),
+                  ('names_with_many_ids' + suffix, [ len(m['names_with_many_ids']) for m in rows ]),
+                  ('ids_with_many_rows' + suffix, [ len(m['ids_with_many_rows']) for m in rows ]) ]
+    data.append( ('multi_mask_ids', [ len(s['multi_mask_ids']) for s in summaries ]) )
+    return DataFrame(data=data)
+
+def write_json(summaries, filename):
+    fp = open(filename, 'w')
+    json.dump(summaries, fp, indent=1, sort_keys=True)
+    fp.close()
+
+ap = argparse.ArgumentParser(description='QC summary of the ids, names and flags of gpr files.', \
+                             epilog = 'copyright (c) 2012 joel.bader@jhu.edu')
+ap.add_argument('gpr_files', nargs='+', help='gpr files to summarize')
+ap.add_argument('--table', help='file for writing one row of counts per gpr file')
+ap.add_argument('--json', help='file for writing the full summaries as json')
+ap.add_argument('--many', type=int, default=MANY, help='list names with at least this many ids and ids with at least this many rows (default: %(default)s)')
+
+def main(args):
+    summaries = [ ]
+    for filename in args.gpr_files:
+        gpr = GPR(filename, columns=['ID', 'Name', 'Flags'])
+        summaries.append(get_summary(gpr, filename, args.many))
+    if args.table is not None:
+        get_table(summaries).write(args.table)
+    if args.json is not None:
+        write_json(summaries, args.json)
+    if (args.table is None) and (args.json is None):
+        for summary in summaries:
+            print_summary(summary)
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    main(args)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Rules for masking out gpr spots before scoring
+joel.bader@jhu.edu
+"""
+
+import logging
+import numpy as np
+
+from controlindex import get_control_index
+from categorical import isin
+
+logging.basicConfig(format='%(name)s.%(funcName)s: %(message)s')
+logger = logging.getLogger(name='spotmask')
+logger.setLevel(logging.INFO)
+
+# user interface permits manual flagging of bad data, usually -100
+FLAG_BAD = -100
+
+# rules added by register_rule, evaluated after the built-in file rules
+registered_rules = [ ]
+
+class SpotMask:
+    """
+    a list of masking rules, each evaluated as a numpy boolean array over the spots
+    a rule is (name, columns, fn): fn is called with the gpr columns as arrays
+    and returns True for the spots to mask out
+    follow the semantics of a numpy masked array: delete where mask is True
+    """
+    def __init__(self, rules=None):
+        self.rules = [ ]
+        if rules is not None:
+            for (name, columns, fn) in rules:
+                self.add_rule(name, columns, fn)
+
+    def add_rule(self, name, columns, fn):
+        assert(name not in [ x[0] for x in self.rules ]), 'rule %s already exists' % name
+        self.rules.append( (name, list(columns), fn) )
+
+    def get_columns(self):
+        """ the gpr columns read by the rules """
+        columns = [ ]
+        for (name, rule_columns, fn) in self.rules:
+            for c in rule_columns:
+                if c not in columns:
+                    columns.append(c)
+        return columns
+
+    def evaluate(self, gpr):
+        """
+        return (mask, counts)
+        mask is True for a spot masked by any rule
+        counts is a list of (rule name, number of spots the rule masks)
+        """
+        mask = np.zeros(gpr.n_row, dtype=bool)
+        counts = [ ]
+        # nan values are not masked, and comparing them should not warn
+        with np.errstate(invalid='ignore'):
+            for (name, columns, fn) in self.rules:
+                rule_mask = np.asarray(fn(*gpr.get_columns(columns)), dtype=bool)
+                assert(len(rule_mask) == gpr.n_row), 'rule %s gave %d values for %d rows' % (name, len(rule_mask), gpr.n_row)
+                counts.append( (name, int(rule_mask.sum())) )
+                mask |= rule_mask
+        return(mask, counts)
+
+def log_counts(counts, n_mask, n_row):
+    logger.info('masked %d of %d spots: %s', n_mask, n_row, ', '.join([ '%s %d' % x for x in counts ]))
+
+def get_control_ids(control_dict):
+    """ sorted array of the ids in control_dict, a dict or ControlIndex; for controls, just worry about ID, not name """
+    return get_control_index(control_dict).control_ids
+
+def register_rule(name, columns, fn):
+    """
+    add a rule to every file mask made by get_file_mask, for example
+    register_rule('saturated', ['F635 % Sat.'], lambda sat: sat > 50)
+    rules registered before a worker pool is started are seen by the workers
+    """
+    registered_rules.append( (name, columns, fn) )
+
+def get_file_mask(control_dict=None):
+    """
+    rules that depend only on the gpr file, so that a sweep evaluates them once per file:
+    control: ID is in control_dict, a dict of (id, name) pairs or a ControlIndex
+    flag: Flags <= FLAG_BAD
+    text: ID is CONTROL, which is clearly a control
+    followed by the rules from register_rule
+    """
+    spot_mask = SpotMask()
+    if control_dict is not None:
+        control_index = get_control_index(control_dict)
+        spot_mask.add_rule('control', ['ID'], control_index.is_control_id)
+    spot_mask.add_rule('flag', ['Flags'], lambda flags: np.asarray(flags) <= FLAG_BAD)
+    spot_mask.add_rule('text', ['ID'], lambda ids: isin(ids, [ 'CONTROL' ]))
+    for (name, columns, fn) in registered_rules:
+        spot_mask.add_rule(name, columns, fn)
+    return spot_mask
+
+def nonpositive(fg, bg):
+    return (np.asarray(fg) <= 0) | (np.asarray(bg) <= 0)
+
+def get_signal_mask(signal_fg, signal_bg, norm_fg, norm_bg, do_norm):
+    """
+    rules that depend on the signal and norm columns:
+    signal: fg or bg is not positive
+    norm: if do_norm, norm fg or bg is not positive
+    """
+    spot_mask = SpotMask()
+    spot_mask.add_rule('signal', [signal_fg, signal_bg], nonpositive)
+    if do_norm:
+        spot_mask.add_rule('norm', [norm_fg, norm_bg], nonpositive)
+    return spot_mask
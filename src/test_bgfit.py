@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Tests for the regression background fit: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import unittest
+import numpy as np
+
+from bgfit import get_design_matrix, fit_foreground, get_fit_ratio, get_fit_mask
+
+logging.disable(logging.INFO)
+
+class TestFit(unittest.TestCase):
+    def test_batched_fits_match_lstsq(self):
+        """ each fit of a batch matches its own least-squares solution, with different sizes and scales """
+        rng = np.random.RandomState(0)
+        bg_list = [ rng.uniform(10, 1000, 500), rng.uniform(50, 60000, 2000), rng.uniform(1, 5, 40) ]
+        fg_list = [ 3.0 + 1.2 * bg_list[0] + rng.normal(0, 5, 500),
+                    100.0 + 0.8 * bg_list[1] + 20 * np.sqrt(bg_list[1]) + rng.normal(0, 50, 2000),
+                    2.0 + 5 * np.log(bg_list[2]) + rng.normal(0, 0.1, 40) ]
+        fits = fit_foreground(bg_list, fg_list)
+        self.assertEqual(len(fits), 3)
+        for (bg, fg, fit) in zip(bg_list, fg_list, fits):
+            x = get_design_matrix(bg)
+            coef = np.linalg.lstsq(x, fg, rcond=None)[0]
+            np.testing.assert_allclose(fit, x.dot(coef), rtol=1e-8, atol=1e-8 * np.abs(fg).max())
+
+    def test_fits_are_independent(self):
+        """ adding another fit to the batch does not change the first one """
+        rng = np.random.RandomState(1)
+        bg = rng.uniform(10, 1000, 300)
+        fg = 5.0 + 2.0 * bg + rng.normal(0, 3, 300)
+        alone = fit_foreground([ bg ], [ fg ])[0]
+        batched = fit_foreground([ bg, 10 * bg ], [ fg, rng.uniform(0, 1, 300) ])[0]
+        np.testing.assert_allclose(alone, batched, rtol=1e-10)
+
+    def test_empty(self):
+        self.assertEqual(fit_foreground([ ], [ ]), [ ])
+
+    def test_fit_ratio_and_mask(self):
+        fg_fit = np.array([ 2.0, -1.0, 0.0, 4.0 ])
+        n_fg_fit = np.array([ 1.0, 1.0, 1.0, -2.0 ])
+        self.assertEqual(list(get_fit_mask(fg_fit)), [ False, True, True, False ])
+        self.assertEqual(list(get_fit_mask(fg_fit, n_fg_fit)), [ False, True, True, True ])
+        np.testing.assert_array_equal(get_fit_ratio([ 3.0, 8.0 ], [ 2.0, 4.0 ]), [ 1.5, 2.0 ])
+        self.assertRaises(AssertionError, get_fit_ratio, [ 1.0, 1.0 ], [ 1.0, 0.0 ])
+
+if __name__ == '__main__':
+    unittest.main()
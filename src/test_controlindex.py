@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Tests for the compiled control index: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from controlindex import load_control_index, get_index_name, ID_NAMES_FILENAME
+
+logging.disable(logging.INFO)
+
+COUNTS = 'id\tname\tcontrol\texptl\nA1\tfoo\t3\t1\nA1\tbar\t0\t4\nB2\tnd\t0\t2\nC3\tzed\t0\t1\n'
+
+class TestCountsIndex(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dirname = tempfile.mkdtemp()
+        os.chdir(self.dirname)
+        self.filename = os.path.join(self.dirname, 'counts.txt')
+        fp = open(self.filename, 'w')
+        fp.write(COUNTS)
+        fp.close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dirname)
+
+    def read_id_names(self):
+        fp = open(ID_NAMES_FILENAME, 'r')
+        text = fp.read()
+        fp.close()
+        return(text)
+
+    def test_id_names_written_from_cached_index(self):
+        """ id_to_names.txt is written when the index is compiled and again when it is loaded from the cache """
+        first = load_control_index(self.filename, simple=False)
+        self.assertTrue(os.path.isdir(get_index_name(self.filename, simple=False)))
+        expected = self.read_id_names()
+        self.assertEqual(expected.splitlines(), [ 'id\tcnt\tnames', 'A1\t2\tbar,foo', 'B2\t1\tnd', 'C3\t1\tzed' ])
+        os.remove(ID_NAMES_FILENAME)
+        second = load_control_index(self.filename, simple=False)
+        self.assertEqual(self.read_id_names(), expected)
+        self.assertEqual(sorted(second.keys()), sorted(first.keys()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Tests for the run directory watcher: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from deconv_watch import GPRWatcher
+
+logging.disable(logging.INFO)
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirname, 'run1'))
+        self.filename = os.path.join(self.dirname, 'run1', 'a.gpr')
+        fp = open(self.filename, 'w')
+        fp.write('ATF\n')
+        fp.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_ready_after_settle(self):
+        """ a file is ready once it has kept its size and time stamp for settle seconds, and not again once done """
+        watcher = GPRWatcher(self.dirname, 30)
+        self.assertEqual(watcher.scan(now=0), [ ])
+        self.assertEqual(watcher.scan(now=10), [ ])
+        ready = watcher.scan(now=100)
+        self.assertEqual([ (r, sorted(f.keys())) for (r, f) in ready ], [ (os.path.join(self.dirname, 'run1'), [ self.filename ]) ])
+        watcher.set_done(ready[0][1])
+        self.assertEqual(watcher.scan(now=200), [ ])
+        self.assertEqual(len(watcher.pending), 0)
+
+    def test_removed_file_leaves_pending(self):
+        """ a file removed after its first scan is no longer pending """
+        watcher = GPRWatcher(self.dirname, 30)
+        watcher.scan(now=0)
+        self.assertEqual(list(watcher.pending.keys()), [ self.filename ])
+        os.remove(self.filename)
+        self.assertEqual(watcher.scan(now=100), [ ])
+        self.assertEqual(len(watcher.pending), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Tests for the gpr parsers: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from gpr import GPR, read_chunks, bulk_parse, get_column_type
+
+logging.disable(logging.INFO)
+
+COLUMNS = [ 'Name', 'ID', 'F635 Median', 'B635 Median', 'Flags' ]
+ROWS = [ [ '"a"', '"ID1"', '1.5', '2', '0' ],
+         [ '"b"', '"ID2"', '10.25', '3.5', '-100' ],
+         [ '"c"', '"ID3"', 'Error', '0.125', '0' ] ]
+
+def get_text(rows, line_end='\n'):
+    header = 'ATF\t1.0\n1\t%d\n"Type=GenePix Results 3"\n' % len(COLUMNS)
+    header += '\t'.join([ '"%s"' % c for c in COLUMNS ]) + '\n'
+    return header.replace('\n', line_end) + ''.join([ '\t'.join(r) + line_end for r in rows ])
+
+def expected_value(tok):
+    tok = tok.strip()
+    return np.nan if tok == 'Error' else float(tok)
+
+class TestParse(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, rows, line_end='\n'):
+        filename = os.path.join(self.work_dir, 'test.gpr')
+        fp = open(filename, 'wb')
+        fp.write(get_text(rows, line_end))
+        fp.close()
+        return filename
+
+    def check(self, filename, rows):
+        """ every parser gives the values of float() on the stripped tokens """
+        chunks = list(read_chunks(filename, chunk_rows=2))
+        for (j, c) in enumerate(COLUMNS[2:4], 2):
+            expected = np.array([ expected_value(r[j]) for r in rows ])
+            np.testing.assert_array_equal(GPR(filename).get_columns([ c ])[0], expected)
+            np.testing.assert_array_equal(GPR(filename, columns=[ 'ID', c ]).get_columns([ c ])[0], expected)
+            np.testing.assert_array_equal(np.concatenate([ x.get_columns([ c ])[0] for x in chunks ]), expected)
+        np.testing.assert_array_equal(GPR(filename).get_columns([ 'Flags' ])[0], [ int(r[4]) for r in rows ])
+        self.assertEqual(list(GPR(filename).get_columns([ 'ID' ])[0]), [ 'ID1', 'ID2', 'ID3' ])
+
+    def test_plain(self):
+        self.check(self.write(ROWS), ROWS)
+
+    def test_spaces(self):
+        rows = [ [ r[0], r[1], ' ' + r[2], r[3] + ' ', r[4] ] for r in ROWS ]
+        self.check(self.write(rows), rows)
+
+    def test_crlf(self):
+        self.check(self.write(ROWS, '\r\n'), ROWS)
+
+    def test_crlf_spaces(self):
+        rows = [ [ r[0], r[1], r[2] + '  ', ' ' + r[3], r[4] ] for r in ROWS ]
+        self.check(self.write(rows, '\r\n'), rows)
+
+    def test_bulk_parse_fallback(self):
+        """ the bulk parser leaves text with a space after a number to the column parser """
+        column_type = get_column_type(COLUMNS)
+        text = ''.join([ '\t'.join(r) + '\n' for r in ROWS ])
+        self.assertEqual(bulk_parse(text, COLUMNS, column_type)['F635 Median'][0], 1.5)
+        self.assertTrue(bulk_parse(text.replace('1.5', '1.5 '), COLUMNS, column_type) is None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Tests for the group-by reductions: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import unittest
+import numpy as np
+
+from groupby import GroupBy
+from categorical import factorize
+import deconv
+
+logging.disable(logging.INFO)
+
+class TestGroupBy(unittest.TestCase):
+    def test_lookup_and_split_subset(self):
+        """ lookup finds the group number of keys, and split with groups gives only those groups' rows """
+        keys = [ 'b', 'a', 'c', 'a', 'b', 'a' ]
+        values = np.arange(6.0)
+        for k in [ keys, factorize(keys) ]:
+            groups = GroupBy(k)
+            self.assertEqual(groups.lookup([ 'c', 'b' ]).tolist(), [ 2, 0 ])
+            subset = groups.split(values, groups.lookup([ 'a', 'c' ]))
+            self.assertEqual([ x.tolist() for x in subset ], [ [ 1.0, 3.0, 5.0 ], [ 2.0 ] ])
+            self.assertEqual(groups.lookup([ ]).tolist(), [ ])
+
+    def test_apply_by_group(self):
+        """ the vectorized and per-group paths of apply_by_group agree """
+        keys = [ 'b', 'a', 'c', 'a', 'b', 'a' ]
+        values = np.array([ 1.0, 2.0, 4.0, 8.0, 16.0, 32.0 ])
+        (by_group, by_row, data) = deconv.apply_by_group(np.mean, keys, values)
+        self.assertTrue(data is None)
+        (by_group_fn, by_row_fn, data_fn) = deconv.apply_by_group(lambda x: np.mean(x), keys, values)
+        self.assertEqual(by_group, by_group_fn)
+        self.assertEqual(list(by_row), list(by_row_fn))
+        self.assertEqual(data_fn['a'], [ 2.0, 8.0, 32.0 ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Tests for writing hit lists as grids: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from dataframe import DataFrame
+from pooldesign import get_design
+from list_to_grid import make_grid_for_dir
+
+logging.disable(logging.INFO)
+
+class TestGrid(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write_hits(self, name, data):
+        DataFrame(data=data).write(os.path.join(self.dirname, name))
+
+    def read_grid(self, name):
+        fp = open(os.path.join(self.dirname, name), 'r')
+        rows = [ line.rstrip('\n').split('\t') for line in fp ]
+        fp.close()
+        return(rows)
+
+    def test_labels_from_pairs(self):
+        """ pools beyond 12 are allowed, and 3-D hits and the batch table are skipped """
+        self.write_hits('intersection_hit_g24.txt', [ ('pair', [ 'H13 x V5', 'H2 x V24', 'H13 x V5' ]), ('id', [ 'a', 'b', 'c' ]) ])
+        self.write_hits('intersection_hit_d3.txt', [ ('pair', [ 'H1 x V1 x D1' ]), ('id', [ 'a' ]) ])
+        self.write_hits('intersection_hit_batch.txt', [ ('run', [ 'r1' ]), ('pair', [ 'H1 x V1' ]), ('id', [ 'a' ]) ])
+        make_grid_for_dir(self.dirname, 'intersection_hit', 'intersection_grid')
+        self.assertEqual(sorted([ f for f in os.listdir(self.dirname) if f.startswith('intersection_grid') ]), [ 'intersection_grid_g24.txt' ])
+        self.assertEqual(self.read_grid('intersection_grid_g24.txt'), [ [ 'intersection_grid_g24.txt', 'V5', 'V24' ], [ 'H2', '', 'b' ], [ 'H13', 'a c', '' ] ])
+
+    def test_labels_from_design(self):
+        """ a design gives every pool a row or column, and a 3-D design has no grid """
+        self.write_hits('intersection_hit_g24.txt', [ ('pair', [ 'H13 x V5' ]), ('id', [ 'a' ]) ])
+        make_grid_for_dir(self.dirname, 'intersection_hit', 'intersection_grid', get_design('grid:24'))
+        rows = self.read_grid('intersection_grid_g24.txt')
+        self.assertEqual((len(rows), len(rows[0])), (25, 25))
+        self.assertEqual(rows[13][5], 'a')
+        os.remove(os.path.join(self.dirname, 'intersection_grid_g24.txt'))
+        make_grid_for_dir(self.dirname, 'intersection_hit', 'intersection_grid', get_design('grid:12:HVD'))
+        self.assertFalse(os.path.exists(os.path.join(self.dirname, 'intersection_grid_g24.txt')))
+
+if __name__ == '__main__':
+    unittest.main()
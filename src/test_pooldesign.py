@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Tests for pooling designs and decoding: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from dataframe import DataFrame, get_binary_name
+from pooldesign import grid_design, PoolHit
+import deconv
+
+logging.disable(logging.INFO)
+
+class TestDecode(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def get_pool_to_file(self, summaries):
+        """ save a summary for each (pool, ids, zscores) and return the map of pools to files """
+        paths = [ ]
+        for (pool, ids, zscores) in summaries:
+            path = get_binary_name(os.path.join(self.dirname, pool + '-summary.txt'))
+            DataFrame(data=[ ('IDName', ids), ('zscore', zscores), ('ratio', [ 2.0 * z for z in zscores ]) ]).save(path)
+            paths.append(path)
+        return DataFrame(data=[ ('pool', [ s[0] for s in summaries ]), ('file', [ s[0] for s in summaries ]), ('full_path', paths) ])
+
+    def test_decode_pool_hit(self):
+        """ an id decodes to the clones whose pools all have it as a hit, from pool names written as H01 too """
+        pool_to_file = self.get_pool_to_file([ ('H01', [ 'a', 'b' ], [ 3.0, 3.0 ]), ('H2', [ 'a' ], [ 1.0 ]),
+                                               ('V1', [ 'b', 'c' ], [ 4.0, 3.0 ]), ('V2', [ 'a', 'b' ], [ 5.0, 2.0 ]) ])
+        pool_hit = deconv.get_pool_hit(pool_to_file)
+        self.assertEqual(len(pool_hit), 7)
+        (hits, df) = grid_design(2).decode(pool_hit)
+        self.assertEqual(list(zip(df.data['pair'], df.data['id'])), [ ('H1 x V1', 'b'), ('H1 x V2', 'a') ])
+        self.assertEqual(list(df.data['zscore_v']), [ 4.0, 5.0 ])
+        self.assertEqual(hits['H1 x V2']['a']['ratio_H'], 6.0)
+
+    def test_duplicated_id(self):
+        """ an id may be a hit only once in a pool """
+        pool_to_file = self.get_pool_to_file([ ('H1', [ 'a', 'a' ], [ 3.0, 3.0 ]) ])
+        self.assertRaises(AssertionError, deconv.get_pool_hit, pool_to_file)
+
+    def test_empty(self):
+        (hits, df) = grid_design(2).decode(PoolHit([ ], [ ], [ ], [ ], [ ]))
+        self.assertEqual(len(hits), 0)
+        self.assertEqual(len(df.data['pair']), 0)
+
+if __name__ == '__main__':
+    unittest.main()
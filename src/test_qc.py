@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+Tests for the mask summaries: python -m unittest discover -s src
+joel.bader@jhu.edu
+"""
+
+import logging
+import unittest
+import numpy as np
+
+from qc import get_mask_summary
+
+logging.disable(logging.INFO)
+
+class TestMaskSummary(unittest.TestCase):
+    def test_many_ids_and_names(self):
+        """ pair codes do not overflow when n_id * n_name is above 2**31 """
+        n = 70000
+        keys = np.array([ 'k%05d' % i for i in range(n) ])
+        # two ids share the last name, and the last id has two rows
+        id_code = np.array([ n - 2, n - 1, n - 1 ], dtype=np.int32)
+        name_code = np.array([ n - 1, n - 1, n - 1 ], dtype=np.int32)
+        summary = get_mask_summary(keys, id_code, keys, name_code, False, many=2)
+        self.assertEqual(summary['ids_per_name'], [ [ 2, 1 ] ])
+        self.assertEqual(summary['rows_per_id'], [ [ 1, 1 ], [ 2, 1 ] ])
+        self.assertEqual(summary['names_with_many_ids'], [ [ keys[n - 1], 2 ] ])
+        self.assertEqual(summary['ids_with_many_rows'], [ [ keys[n - 1], keys[n - 1], 2 ] ])
+
+if __name__ == '__main__':
+    unittest.main()